@@ -0,0 +1,453 @@
+""" Benchmark cases.
+
+Every case is a setup function that takes a benchmark input and returns
+the callable that is timed, so that preparing the image (e.g. setting an
+EXIF orientation) is not part of the measurement. The `covers` attribute
+lists the :py:class:`jpegtran.JPEGImage` members a case exercises, which
+``run.py --list`` uses to report members without a benchmark.
+"""
+from __future__ import division
+
+import collections
+import os
+import shutil
+import sys
+import tempfile
+
+import jpegtran.lib as lib
+import jpegtran.triage as triage
+from jpegtran import JPEGImage
+
+Case = collections.namedtuple('Case', ['name', 'setup', 'applies', 'covers'])
+
+CASES = collections.OrderedDict()
+
+
+def _always(inp):
+    return True
+
+
+def _with_exif(inp):
+    return inp.exif
+
+
+def _baseline(inp):
+    return not inp.progressive
+
+
+def case(name, applies=_always, covers=()):
+    def decorator(setup):
+        CASES[name] = Case(name, setup, applies, tuple(covers))
+        return setup
+    return decorator
+
+
+_tempdir = None
+
+
+def _tempfile(name):
+    global _tempdir
+    if _tempdir is None:
+        _tempdir = tempfile.mkdtemp(prefix='jpegtran-bench-')
+    return os.path.join(_tempdir, name)
+
+
+def cleanup():
+    """ Remove the files written by the cases. """
+    global _tempdir
+    if _tempdir is not None:
+        shutil.rmtree(_tempdir, ignore_errors=True)
+        _tempdir = None
+
+
+def _aligned(value, step):
+    return value - value % step
+
+
+def _center_region(image, fraction, transposed=False):
+    """ Get a region in the center of the image aligned to the MCU size,
+    optionally of the transposed image. """
+    image_width, image_height = image.width, image.height
+    mcu_width, mcu_height = image.header.mcu_size
+    if transposed:
+        image_width, image_height = image_height, image_width
+        mcu_width, mcu_height = mcu_height, mcu_width
+    width = _aligned(int(image_width*fraction), mcu_width) or mcu_width
+    height = _aligned(int(image_height*fraction), mcu_height) or mcu_height
+    x = _aligned((image_width - width)//2, mcu_width)
+    y = _aligned((image_height - height)//2, mcu_height)
+    return x, y, width, height
+
+
+def _rendition_sizes(image):
+    return [(image.width//divisor, image.height//divisor)
+            for divisor in (2, 3, 5, 8, 16)]
+
+
+@case('open', covers=('__init__', 'header', 'width', 'height'))
+def open_image(inp):
+    def run():
+        image = JPEGImage(blob=inp.data)
+        return image.width, image.height
+    return run
+
+
+@case('open_mmap', covers=('open',))
+def open_mmap(inp):
+    fname = _tempfile('open.jpg')
+    JPEGImage(blob=inp.data).save(fname)
+
+    def run():
+        image = JPEGImage.open(fname)
+        return image.width, image.height
+    return run
+
+
+@case('scan_file')
+def scan_file(inp):
+    fname = _tempfile('scan.jpg')
+    JPEGImage(blob=inp.data).save(fname)
+    return lambda: triage.scan_file(fname)
+
+
+@case('scan_file_validate')
+def scan_file_validate(inp):
+    fname = _tempfile('validate.jpg')
+    JPEGImage(blob=inp.data).save(fname)
+    return lambda: triage.scan_file(fname, validate=True)
+
+
+@case('get_dimensions')
+def get_dimensions(inp):
+    return lambda: lib.Transformation(inp.data).get_dimensions()
+
+
+@case('as_blob', covers=('as_blob',))
+def as_blob(inp):
+    image = JPEGImage(blob=bytearray(inp.data))
+    return image.as_blob
+
+
+@case('save', covers=('save',))
+def save(inp):
+    image = JPEGImage(blob=inp.data)
+    fname = _tempfile('save.jpg')
+    return lambda: image.save(fname)
+
+
+@case('exif_read', applies=_with_exif, covers=('exif',))
+def exif_read(inp):
+    def run():
+        exif = JPEGImage(blob=inp.data).exif
+        return exif['Model'], exif['DateTime']
+    return run
+
+
+@case('exif_orientation_read', applies=_with_exif,
+      covers=('exif_orientation',))
+def exif_orientation_read(inp):
+    return lambda: JPEGImage(blob=inp.data).exif_orientation
+
+
+@case('exif_write', applies=_with_exif,
+      covers=('exif_orientation', 'set_exif'))
+def exif_write(inp):
+    def run():
+        image = JPEGImage(blob=bytearray(inp.data))
+        image.exif_orientation = 6
+        image.set_exif('Model', 'benchmark')
+    return run
+
+
+@case('exif_thumbnail_read', applies=_with_exif, covers=('exif_thumbnail',))
+def exif_thumbnail_read(inp):
+    return lambda: JPEGImage(blob=inp.data).exif_thumbnail
+
+
+@case('exif_thumbnail_write', applies=_with_exif,
+      covers=('exif_thumbnail',))
+def exif_thumbnail_write(inp):
+    thumbnail = JPEGImage(blob=inp.data).exif_thumbnail.flip('vertical')
+
+    def run():
+        image = JPEGImage(blob=inp.data)
+        image.exif_thumbnail = thumbnail
+    return run
+
+
+@case('exif_autotransform', applies=_with_exif,
+      covers=('exif_autotransform',))
+def exif_autotransform(inp):
+    image = JPEGImage(blob=bytearray(inp.data))
+    image.exif_orientation = 6
+    return image.exif_autotransform
+
+
+@case('rotate_90', covers=('rotate',))
+def rotate_90(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.rotate(90)
+
+
+@case('rotate_180', covers=('rotate',))
+def rotate_180(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.rotate(180)
+
+
+@case('rotate_90_keep_thumbnail', applies=_with_exif,
+      covers=('rotate', 'thumbnail_policy'))
+def rotate_90_keep_thumbnail(inp):
+    """ Rotation without updating the thumbnail, to tell the cost of the
+    thumbnail update from that of the rotation. """
+    image = JPEGImage(blob=inp.data)
+    image.thumbnail_policy = 'keep'
+    return lambda: image.rotate(90)
+
+
+@case('rotate_90_progressive_output', covers=('rotate',))
+def rotate_90_progressive_output(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.rotate(90, progressive=True)
+
+
+@case('rotate_90_buffer_arena', covers=('rotate', 'buffer_arena'))
+def rotate_90_buffer_arena(inp):
+    image = JPEGImage(blob=inp.data)
+    image.buffer_arena = lib.BufferArena()
+    return lambda: image.rotate(90)
+
+
+@case('flip_horizontal', covers=('flip',))
+def flip_horizontal(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.flip('horizontal')
+
+
+@case('flip_vertical', covers=('flip',))
+def flip_vertical(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.flip('vertical')
+
+
+@case('transpose', covers=('transpose',))
+def transpose(inp):
+    image = JPEGImage(blob=inp.data)
+    return image.transpose
+
+
+@case('transverse', covers=('transverse',))
+def transverse(inp):
+    image = JPEGImage(blob=inp.data)
+    return image.transverse
+
+
+@case('crop', covers=('crop',))
+def crop(inp):
+    image = JPEGImage(blob=inp.data)
+    region = _center_region(image, 0.5)
+    return lambda: image.crop(*region)
+
+
+@case('crop_many', covers=('crop_many',))
+def crop_many(inp):
+    image = JPEGImage(blob=inp.data)
+    mcu_width, mcu_height = image.header.mcu_size
+    width = _aligned(image.width//4, mcu_width) or mcu_width
+    height = _aligned(image.height//4, mcu_height) or mcu_height
+    regions = [(x, y, width, height)
+               for y in range(0, image.height - height + 1, height)
+               for x in range(0, image.width - width + 1, width)]
+    return lambda: image.crop_many(regions)
+
+
+@case('multi_transform', covers=('multi_transform', 'pipeline'))
+def multi_transform(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.multi_transform([
+        image.pipeline().rotate(90), image.pipeline().flip('vertical'),
+        image.pipeline().transpose()])
+
+
+@case('pipeline', covers=('pipeline',))
+def pipeline(inp):
+    image = JPEGImage(blob=inp.data)
+    # Rotating and flipping amounts to transposing
+    region = _center_region(image, 0.5, transposed=True)
+    return lambda: (image.pipeline().rotate(90).flip('horizontal')
+                    .crop(*region).execute())
+
+
+@case('optimize', covers=('optimize',))
+def optimize(inp):
+    image = JPEGImage(blob=inp.data)
+    return image.optimize
+
+
+@case('optimize_progressive', covers=('optimize',))
+def optimize_progressive(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.optimize(progressive=True)
+
+
+@case('downscale_quarter', covers=('downscale',))
+def downscale_quarter(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.downscale(image.width//4, image.height//4)
+
+
+@case('downscale_turbo', covers=('downscale', 'scale_engine',
+                                 'scale_profile'))
+def downscale_turbo(inp):
+    """ Non power of two factor, which the 'turbo' engine is for. """
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.downscale(image.width//3, image.height//3,
+                                   engine='turbo')
+
+
+@case('downscale_region', covers=('downscale',))
+def downscale_region(inp):
+    image = JPEGImage(blob=inp.data)
+    region = (image.width//3, image.height//3, image.width//3,
+              image.height//3)
+    return lambda: image.downscale(region[2]//2, region[3]//2,
+                                   region=region)
+
+
+@case('downscale_max_memory', applies=_baseline,
+      covers=('downscale', 'max_memory'))
+def downscale_max_memory(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.downscale(image.width//4, image.height//4,
+                                   max_memory=1024*1024)
+
+
+@case('downscale_max_bytes', covers=('downscale',))
+def downscale_max_bytes(inp):
+    """ Quality search for a budget halfway between the sizes at quality 75
+    and 25, which is reachable even for small images, where the headers
+    take up much of the size.
+    """
+    image = JPEGImage(blob=inp.data)
+    width, height = image.width//4, image.height//4
+    budget = sum(len(image.downscale(width, height, quality).data)
+                 for quality in (75, 25))//2
+    return lambda: image.downscale(width, height, max_bytes=budget)
+
+
+@case('downscale_many', covers=('downscale_many',))
+def downscale_many(inp):
+    """ Responsive image renditions, to compare with 'downscale_renditions'.
+    """
+    image = JPEGImage(blob=inp.data)
+    sizes = _rendition_sizes(image)
+    return lambda: image.downscale_many(sizes)
+
+
+@case('downscale_renditions', covers=('downscale',))
+def downscale_renditions(inp):
+    image = JPEGImage(blob=inp.data)
+    sizes = _rendition_sizes(image)
+    return lambda: [image.downscale(width, height, engine='turbo')
+                    for width, height in sizes]
+
+
+@case('to_array_eighth', covers=('to_array',))
+def to_array_eighth(inp):
+    image = JPEGImage(blob=inp.data)
+    size = (image.width//8, image.height//8)
+    return lambda: image.to_array(size)
+
+
+@case('to_array_half', covers=('to_array',))
+def to_array_half(inp):
+    image = JPEGImage(blob=inp.data)
+    size = (image.width//2, image.height//2)
+    return lambda: image.to_array(size)
+
+
+@case('dct_coefficients', covers=('dct_coefficients',))
+def dct_coefficients(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.dct_coefficients()
+
+
+@case('dct_coefficients_dc', covers=('dct_coefficients',))
+def dct_coefficients_dc(inp):
+    image = JPEGImage(blob=inp.data)
+    return lambda: image.dct_coefficients(dc_only=True)
+
+
+@case('phash', covers=('phash',))
+def phash(inp):
+    image = JPEGImage(blob=inp.data)
+    return image.phash
+
+
+@case('dhash', covers=('dhash',))
+def dhash(inp):
+    image = JPEGImage(blob=inp.data)
+    return image.dhash
+
+
+if sys.version_info >= (3, 5):
+    import asyncio
+
+    _loop = None
+
+    def _run_async(make_awaitable):
+        global _loop
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+        return lambda: _loop.run_until_complete(make_awaitable())
+
+    @case('aopen', covers=('aopen',))
+    def aopen(inp):
+        fname = _tempfile('aopen.jpg')
+        JPEGImage(blob=inp.data).save(fname)
+        return _run_async(lambda: JPEGImage.aopen(fname))
+
+    @case('asave', covers=('asave',))
+    def asave(inp):
+        image = JPEGImage(blob=inp.data)
+        fname = _tempfile('asave.jpg')
+        return _run_async(lambda: image.asave(fname))
+
+    @case('arotate', covers=('arotate',))
+    def arotate(inp):
+        image = JPEGImage(blob=inp.data)
+        return _run_async(lambda: image.arotate(90))
+
+    @case('aflip', covers=('aflip',))
+    def aflip(inp):
+        image = JPEGImage(blob=inp.data)
+        return _run_async(lambda: image.aflip('vertical'))
+
+    @case('atranspose', covers=('atranspose',))
+    def atranspose(inp):
+        image = JPEGImage(blob=inp.data)
+        return _run_async(image.atranspose)
+
+    @case('atransverse', covers=('atransverse',))
+    def atransverse(inp):
+        image = JPEGImage(blob=inp.data)
+        return _run_async(image.atransverse)
+
+    @case('acrop', covers=('acrop',))
+    def acrop(inp):
+        image = JPEGImage(blob=inp.data)
+        region = _center_region(image, 0.5)
+        return _run_async(lambda: image.acrop(*region))
+
+    @case('adownscale', covers=('adownscale',))
+    def adownscale(inp):
+        image = JPEGImage(blob=inp.data)
+        return _run_async(lambda: image.adownscale(image.width//4,
+                                                   image.height//4))
+
+    @case('aexif_autotransform', applies=_with_exif,
+          covers=('aexif_autotransform',))
+    def aexif_autotransform(inp):
+        image = JPEGImage(blob=bytearray(inp.data))
+        image.exif_orientation = 6
+        return _run_async(image.aexif_autotransform)
@@ -0,0 +1,140 @@
+""" Generated benchmark inputs.
+
+Images are synthesized instead of shipped with the repository, so that the
+whole matrix of sizes, subsamplings, encodings and EXIF variants is
+available without downloading anything. The content is a noisy gradient,
+which compresses roughly like a photograph.
+"""
+from __future__ import division
+
+import collections
+import math
+import random
+import struct
+
+import jpegtran.lib as lib
+from jpegtran import JPEGImage
+
+SIZES = (0.1, 1, 10, 100)
+SUBSAMPLINGS = ('4:4:4', '4:2:2', '4:2:0')
+
+# Distinct pixel rows the images are assembled from
+_ROW_POOL = 61
+
+Input = collections.namedtuple(
+    'Input', ['name', 'megapixels', 'subsampling', 'progressive', 'exif',
+              'data'])
+
+
+def dimensions(megapixels):
+    """ Get the dimensions of a 4:3 image with the given number of
+    megapixels. """
+    width = int(round(math.sqrt(megapixels*1e6*4/3)))
+    return width, int(round(width*3/4))
+
+
+def _pixels(width, height, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for idx in range(_ROW_POOL):
+        base = 255*idx/_ROW_POOL
+        row = bytearray(width*3)
+        for x in range(width):
+            gradient = 255*x/width
+            noise = rng.randint(-24, 24)
+            row[3*x] = int(min(255, max(0, gradient + noise)))
+            row[3*x+1] = int(min(255, max(0, base + noise)))
+            row[3*x+2] = int(min(255, max(0, (gradient+base)/2 - noise)))
+        rows.append(bytes(row))
+    # Vary the row order so that neighbouring blocks differ
+    return b''.join(rows[(y*7 + y//_ROW_POOL) % _ROW_POOL]
+                    for y in range(height))
+
+
+def encode(pixels, width, height, subsampling, quality=90):
+    """ Encode RGB pixels to a baseline JPEG. """
+    pdata = lib.ffi.gc(lib.ffi.new("unsigned char **"),
+                       lib._turbojpeg_cleanup)
+    psize = lib.ffi.new("unsigned long*")
+    with lib.handle_pool.handle() as tjhandle:
+        if lib.lib.tjCompress2(
+                tjhandle, lib._from_buffer(pixels), width, 0, height,
+                lib.lib.TJPF_RGB, pdata, psize,
+                lib._TJ_SUBSAMPLING[subsampling], quality, 0) < 0:
+            raise Exception("Compression failed: {0}".format(
+                lib.ffi.string(lib.lib.tjGetErrorStr())))
+    return bytes(lib._native_buffer(pdata, psize[0]))
+
+
+def exif_segment(thumbnail, orientation=1):
+    """ Build an APP1 segment with a little endian TIFF structure holding
+    the camera model, the date, the orientation and a JPEG thumbnail. """
+    model = b'jpegtran benchmark\x00'
+    date = b'2020:01:02 03:04:05\x00'
+    ifd0_offset = 8
+    ifd0_size = 2 + 3*12 + 4
+    model_offset = ifd0_offset + ifd0_size
+    date_offset = model_offset + len(model)
+    ifd1_offset = date_offset + len(date)
+    ifd1_size = 2 + 3*12 + 4
+    thumb_offset = ifd1_offset + ifd1_size
+
+    tiff = bytearray(b'II*\x00' + struct.pack('<I', ifd0_offset))
+    tiff += struct.pack('<H', 3)
+    tiff += struct.pack('<HHII', 0x110, 2, len(model), model_offset)
+    tiff += struct.pack('<HHIHH', 0x112, 3, 1, orientation, 0)
+    tiff += struct.pack('<HHII', 0x132, 2, len(date), date_offset)
+    tiff += struct.pack('<I', ifd1_offset)
+    tiff += model + date
+    tiff += struct.pack('<H', 3)
+    tiff += struct.pack('<HHIHH', 0x103, 3, 1, 6, 0)
+    tiff += struct.pack('<HHII', 0x201, 4, 1, thumb_offset)
+    tiff += struct.pack('<HHII', 0x202, 4, 1, len(thumbnail))
+    tiff += struct.pack('<I', 0)
+    tiff += thumbnail
+    payload = b'Exif\x00\x00' + bytes(tiff)
+    return b'\xff\xe1' + struct.pack('>H', len(payload)+2) + payload
+
+
+def add_exif(data, orientation=1):
+    """ Insert an EXIF segment with a 160 pixel wide thumbnail after the
+    JFIF segment. """
+    image = JPEGImage(blob=data)
+    thumbnail = image.downscale(160, max(1, 160*image.height//image.width))
+    segment = exif_segment(thumbnail.as_blob(), orientation)
+    app0 = image.header.segments[1]
+    if app0[0] == lib.MARKER_APP0:
+        offset = app0[1] + app0[2]
+    else:
+        offset = 2
+    return data[:offset] + segment + data[offset:]
+
+
+def generate(sizes=SIZES, subsamplings=SUBSAMPLINGS,
+             progressive=(False, True), exif=(False, True)):
+    """ Generate the matrix of inputs, one size at a time.
+
+    :return:    iterator over :py:class:`Input` tuples
+    """
+    for megapixels in sizes:
+        width, height = dimensions(megapixels)
+        pixels = _pixels(width, height)
+        for subsampling in subsamplings:
+            baseline = encode(pixels, width, height, subsampling)
+            for is_progressive in progressive:
+                data = baseline
+                if is_progressive:
+                    data = JPEGImage(blob=baseline).optimize(
+                        progressive=True).as_blob()
+                for has_exif in exif:
+                    if has_exif:
+                        data_exif = add_exif(data)
+                    else:
+                        data_exif = data
+                    name = '{0}MP-{1}-{2}{3}'.format(
+                        megapixels, subsampling,
+                        'progressive' if is_progressive else 'baseline',
+                        '-exif' if has_exif else '')
+                    yield Input(name, megapixels, subsampling,
+                                is_progressive, has_exif, data_exif)
+        del pixels
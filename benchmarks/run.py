@@ -0,0 +1,236 @@
+""" Run the benchmark suite and compare results.
+
+Run with the package installed, e.g. with ``pip install -e .``::
+
+    python benchmarks/run.py --sizes 0.1,1 --output before.json
+    # ... change something ...
+    python benchmarks/run.py --sizes 0.1,1 --output after.json
+    python benchmarks/run.py --compare before.json after.json
+
+The results are written as JSON: run metadata (commit, Python version,
+platform) and, for every combination of case and input, the number of
+runs and the minimum, median, mean and standard deviation of the time
+per run in seconds. Combinations that raise an exception are recorded
+with the error instead and do not stop the run.
+"""
+from __future__ import division, print_function
+
+import argparse
+import fnmatch
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import cases
+import inputs
+from jpegtran import JPEGImage
+
+FORMAT_VERSION = 1
+
+
+def measure(func, min_time, min_runs, max_runs):
+    """ Time a function, running it until it has taken at least `min_time`
+    seconds and at least `min_runs` times, after one warm-up run.
+
+    :return:    Times of the individual runs in seconds
+    """
+    timer = timeit.default_timer
+    func()
+    times = []
+    while len(times) < max_runs and (len(times) < min_runs or
+                                     sum(times) < min_time):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return times
+
+
+def summarize(times):
+    ordered = sorted(times)
+    mid = len(ordered)//2
+    if len(ordered) % 2:
+        median = ordered[mid]
+    else:
+        median = (ordered[mid-1] + ordered[mid])/2
+    mean = sum(times)/len(times)
+    stdev = 0.0
+    if len(times) > 1:
+        stdev = math.sqrt(sum((t - mean)**2 for t in times)/(len(times)-1))
+    return {'runs': len(times), 'min': ordered[0], 'median': median,
+            'mean': mean, 'stdev': stdev}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    return {'format_version': FORMAT_VERSION, 'commit': _commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'machine': platform.machine()}
+
+
+def run(args):
+    """ Run the selected cases on the generated inputs.
+
+    :return:    Number of combinations of case and input that failed
+    """
+    selected = [c for c in cases.CASES.values()
+                if any(fnmatch.fnmatch(c.name, p) for p in args.cases)]
+    if not selected:
+        raise SystemExit("No cases match {0}".format(args.cases))
+    results = []
+    failures = 0
+    try:
+        for inp in inputs.generate(args.sizes, args.subsamplings,
+                                   args.progressive, args.exif):
+            for bench in selected:
+                if not bench.applies(inp):
+                    continue
+                try:
+                    times = measure(bench.setup(inp), args.min_time,
+                                    args.min_runs, args.max_runs)
+                except Exception as e:
+                    result = {'error': '{0}: {1}'.format(type(e).__name__,
+                                                         e)}
+                    failures += 1
+                    print('{0:<32} {1:<36} {2}'.format(
+                        bench.name, inp.name, result['error']))
+                else:
+                    result = summarize(times)
+                    print('{0:<32} {1:<36} {2:>10.3f} ms'.format(
+                        bench.name, inp.name, result['median']*1000))
+                result.update({
+                    'case': bench.name, 'input': inp.name,
+                    'megapixels': inp.megapixels,
+                    'subsampling': inp.subsampling,
+                    'progressive': inp.progressive, 'exif': inp.exif,
+                    'bytes': len(inp.data)})
+                results.append(result)
+    finally:
+        cases.cleanup()
+    report = {'metadata': metadata(), 'results': results}
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+    print("Results written to {0}".format(args.output))
+    if failures:
+        print("Failed combinations of case and input: {0}".format(failures))
+    return failures
+
+
+def compare(old_path, new_path, threshold):
+    """ Print the change of the median times between two result files.
+
+    :return:    Number of regressions, i.e. combinations of case and input
+                that got slower by more than `threshold` (a fraction)
+    """
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    old_results = dict(((r['case'], r['input']), r)
+                       for r in old['results'])
+    regressions = 0
+    for result in new['results']:
+        key = (result['case'], result['input'])
+        if key not in old_results:
+            continue
+        if 'error' in result or 'error' in old_results[key]:
+            # No times to compare
+            print('{0:<32} {1:<36} {2}'.format(
+                key[0], key[1], result.get('error') or 'failed before'))
+            continue
+        before = old_results[key]['median']
+        after = result['median']
+        change = after/before - 1 if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = 'slower'
+            regressions += 1
+        elif change < -threshold:
+            flag = 'faster'
+        print('{0:<32} {1:<36} {2:>10.3f} {3:>10.3f} ms {4:>+7.1%} {5}'
+              .format(key[0], key[1], before*1000, after*1000, change,
+                      flag))
+    return regressions
+
+
+def list_cases():
+    covered = set()
+    for bench in cases.CASES.values():
+        covered.update(bench.covers)
+        print(bench.name)
+    members = set(name for name in dir(JPEGImage)
+                  if not name.startswith('_')) | set(['__init__'])
+    missing = sorted(members - covered)
+    if missing:
+        print("\nJPEGImage members without a benchmark: {0}"
+              .format(", ".join(missing)))
+
+
+def _floats(value):
+    return tuple(float(v) if '.' in v else int(v) for v in value.split(','))
+
+
+def _strings(value):
+    return tuple(value.split(','))
+
+
+def _flags(value):
+    try:
+        return {'yes': (True,), 'no': (False,), 'both': (False, True)}[value]
+    except KeyError:
+        raise argparse.ArgumentTypeError("must be 'yes', 'no' or 'both'")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='benchmark.json',
+                        help="file to write the results to")
+    parser.add_argument('--cases', type=_strings, default=('*',),
+                        help="comma-separated case name patterns")
+    parser.add_argument('--sizes', type=_floats, default=inputs.SIZES,
+                        help="comma-separated image sizes in megapixels")
+    parser.add_argument('--subsamplings', type=_strings,
+                        default=inputs.SUBSAMPLINGS)
+    parser.add_argument('--progressive', type=_flags, default='both',
+                        help="'yes', 'no' or 'both'")
+    parser.add_argument('--exif', type=_flags, default='both',
+                        help="'yes', 'no' or 'both'")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimum total time per case and input")
+    parser.add_argument('--min-runs', type=int, default=3)
+    parser.add_argument('--max-runs', type=int, default=100)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files instead of running")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative change that counts as a regression")
+    parser.add_argument('--list', action='store_true',
+                        help="list the cases and uncovered JPEGImage "
+                             "members")
+    args = parser.parse_args(argv)
+    if args.list:
+        list_cases()
+    elif args.compare:
+        regressions = compare(args.compare[0], args.compare[1],
+                              args.threshold)
+        sys.exit(1 if regressions else 0)
+    else:
+        sys.exit(1 if run(args) else 0)
+
+
+if __name__ == '__main__':
+    main()
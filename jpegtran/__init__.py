@@ -1,2 +1,3 @@
 from jpegtran.transform import JPEGImage
-__all__ = [JPEGImage]
+from jpegtran.triage import scan
+__all__ = [JPEGImage, scan]
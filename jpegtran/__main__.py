@@ -0,0 +1,5 @@
+import sys
+
+from jpegtran.cli import main
+
+sys.exit(main())
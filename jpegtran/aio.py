@@ -0,0 +1,72 @@
+import asyncio
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_lock = threading.Lock()
+_executor = None
+_limit = multiprocessing.cpu_count()
+_pending = 0
+
+
+def set_limit(limit):
+    """ Set the maximum number of operations that are executed concurrently,
+    shared by all event loops in the process.
+
+    Operations that are currently running are not affected, new operations
+    are run on a fresh executor.
+
+    :param limit:   maximum number of concurrent operations
+    :type limit:    int
+
+    """
+    global _executor, _limit
+    if limit < 1:
+        raise ValueError("Limit must be at least 1")
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _limit = limit
+
+
+def get_limit():
+    """ Get the maximum number of concurrently executed operations. """
+    return _limit
+
+
+def pending():
+    """ Get the number of operations that are running or waiting for a
+    free worker, e.g. for shedding load before latency gets out of hand.
+    """
+    return _pending
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_limit)
+        return _executor
+
+
+async def run(func, *args, **kwargs):
+    """ Run a blocking function on the shared executor.
+
+    Cancelling the awaiting task before a worker picks up the function
+    prevents it from running at all. Once the native routine has started it
+    runs to completion, but its result is discarded.
+    """
+    global _pending
+    # get_running_loop() was added in Python 3.7, before that
+    # get_event_loop() returns the running loop inside a coroutine
+    loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+    with _lock:
+        _pending += 1
+    try:
+        return await loop.run_in_executor(
+            _get_executor(), functools.partial(func, *args, **kwargs))
+    finally:
+        with _lock:
+            _pending -= 1
@@ -0,0 +1,300 @@
+import collections
+import multiprocessing
+import os
+import pickle
+
+# On Python 2 this requires the `futures` backport
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+import jpegtran.lib as lib
+from jpegtran.transform import JPEGImage
+
+
+class BatchResult(collections.namedtuple(
+        'BatchResult', ['index', 'source', 'image', 'error'])):
+    """ Result of a single item of a batch.
+
+    :ivar index:    position of the item in the inputs
+    :ivar source:   the input item
+    :ivar image:    transformed image, None if it was written to the output
+                    or if the transformation failed
+    :ivar error:    exception raised while processing the item or None
+    """
+    __slots__ = ()
+
+
+def _load(source):
+    if isinstance(source, JPEGImage):
+        return source
+    elif isinstance(source, (str, type(u''))):
+        return JPEGImage.open(source)
+    else:
+        return JPEGImage(blob=source)
+
+
+def apply_ops(ops, image):
+    """ Apply an operation spec to an image.
+
+    :param ops:     either a callable taking and returning a
+                    :py:class:`jpegtran.JPEGImage`, or a sequence of
+                    operations, each being either the name of a
+                    :py:class:`jpegtran.JPEGImage` method or a tuple of the
+                    name followed by the positional arguments, e.g.
+                    ``['exif_autotransform', ('downscale', 320, 240)]``
+    :param image:   image to transform
+    :type image:    jpegtran.JPEGImage
+    :return:        transformed image
+    :rtype:         jpegtran.JPEGImage
+
+    """
+    if callable(ops):
+        return ops(image)
+    for op in ops:
+        if isinstance(op, (str, type(u''))):
+            name, args = op, ()
+        else:
+            name, args = op[0], op[1:]
+        if name.startswith('_'):
+            raise ValueError("Invalid operation: {0}".format(name))
+        image = getattr(image, name)(*args)
+    return image
+
+
+def _output_path(output, source):
+    if callable(output):
+        return output(source)
+    if not isinstance(source, (str, type(u''))):
+        raise ValueError("Output directory can only be used with file "
+                         "names as inputs")
+    return os.path.join(output, os.path.basename(source))
+
+
+def _run(ops, source, output, as_bytes, cache):
+    if cache is not None:
+        image = cache.apply(ops, _load(source))
+    else:
+        image = apply_ops(ops, _load(source))
+    if output is not None:
+        image.save(_output_path(output, source))
+        return None
+    if as_bytes:
+        return bytes(image.data)
+    return image
+
+
+def _picklable(obj):
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def map(ops, inputs, workers=None, backend='thread', max_pending=None,
+        output=None, cache=None):
+    """ Apply an operation spec to many images on a pool of workers.
+
+    Since the native routines release the GIL, threads are used by default.
+    Processes have to be requested, either always with the 'process'
+    backend or with the 'auto' backend for callable operation specs, which
+    may spend most of their time in Python code, if they can be pickled
+    (lambdas and closures cannot, so they still run on threads).
+    Results are yielded in the order in which they complete, a failing
+    item does not stop the batch but is reported through the `error`
+    attribute of its result. At most `max_pending` items are read and
+    processed at the same time, so memory usage stays bounded no matter how
+    many inputs there are. Files are mapped into memory (see
+    :py:meth:`jpegtran.JPEGImage.open`), so items in flight do not keep
+    file descriptors open.
+
+    :param ops:         operation spec, see :py:func:`apply_ops`, must be
+                        picklable for the 'process' backend
+    :param inputs:      file names, JPEG data or
+                        :py:class:`jpegtran.JPEGImage` instances
+    :type inputs:       iterable
+    :param workers:     number of workers, defaults to the number of CPUs
+    :type workers:      int
+    :param backend:     'thread', 'process' or 'auto'
+    :type backend:      str
+    :param max_pending: maximum number of items in flight, defaults to
+                        twice the number of workers
+    :type max_pending:  int
+    :param output:      directory to save the results to (using the
+                        input's file name) or a callable mapping the input
+                        to the output path, must be picklable for the
+                        'process' backend
+    :param cache:       cache for the results, only its disk tier is shared
+                        with the workers of the 'process' backend
+    :type cache:        jpegtran.cache.ResultCache
+    :return:            iterator over :py:class:`BatchResult` instances
+    """
+    if backend == 'auto':
+        backend = ('process' if callable(ops) and _picklable(ops) else
+                   'thread')
+    if backend == 'thread':
+        executor_cls = ThreadPoolExecutor
+    elif backend == 'process':
+        executor_cls = ProcessPoolExecutor
+    else:
+        raise ValueError("Backend must be 'thread', 'process' or 'auto'")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+    if max_pending is None:
+        max_pending = 2*workers
+    if max_pending < 1:
+        raise ValueError("Maximum number of pending items must be at least 1")
+    # Arguments are checked right away, the work only starts on iteration
+    return _map(ops, inputs, executor_cls, workers, max_pending, output,
+                cache, backend == 'process')
+
+
+def _map(ops, inputs, executor_cls, workers, max_pending, output, cache,
+         as_bytes):
+    def jobs():
+        for index, source in enumerate(inputs):
+            job = source
+            if as_bytes and isinstance(source, JPEGImage):
+                job = bytes(source.data)
+            yield (index, source), (ops, job, output, as_bytes, cache)
+
+    executor = executor_cls(workers)
+    try:
+        for (index, source), image, error in _imap_unordered(
+                executor, _run, jobs(), max_pending):
+            if as_bytes and image is not None:
+                image = JPEGImage(blob=image)
+            yield BatchResult(index, source, image, error)
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _imap_unordered(executor, func, jobs, max_pending):
+    """ Call a function for many jobs on an executor, with a bounded number
+    of jobs in flight.
+
+    :param executor:    a :py:class:`concurrent.futures.Executor`
+    :param func:        function to call, must be picklable for a process
+                        pool
+    :param jobs:        (key, arguments) tuples, the jobs are only taken
+                        from the iterable as there is room for them
+    :type jobs:         iterable
+    :param max_pending: maximum number of jobs in flight
+    :type max_pending:  int
+    :return:            iterator over (key, result, error) tuples in the
+                        order in which the jobs complete, either the result
+                        or the error (the exception raised) is None
+    """
+    pending = {}
+    try:
+        jobs = iter(jobs)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    key, args = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, *args)] = key
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                result, error = None, None
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                yield key, result, error
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def to_arrays(inputs, out, colorspace='RGB', workers=None):
+    """ Decode many images into a preallocated array, e.g. a batch of
+    samples for machine learning.
+
+    Every image is decoded at the smallest DCT scale that covers the size
+    of the output frames and then scaled to exactly that size, so images
+    with a different aspect ratio are stretched. Every image is decoded
+    into a native buffer of the frame size, which is copied into its frame
+    of `out` and freed right away, so only as many of these buffers as
+    there are workers exist at a time. Python 3 only.
+
+    :param inputs:      file names, JPEG data or
+                        :py:class:`jpegtran.JPEGImage` instances, not larger
+                        than the output frames
+    :type inputs:       sequence
+    :param out:         C-contiguous, writable buffer of shape
+                        (N, height, width, components) and type uint8, e.g. a
+                        NumPy array, N must match the number of inputs
+    :param colorspace:  'RGB', 'GRAY', 'YUV' or 'CMYK', must match the
+                        number of components of `out`
+    :type colorspace:   str
+    :param workers:     number of threads, defaults to the number of CPUs
+    :type workers:      int
+    :return:            `out`
+    """
+    view = memoryview(out)
+    if view.ndim != 4 or view.shape[0] != len(inputs):
+        raise ValueError("Output must be of shape (number of inputs, height, "
+                         "width, components)")
+    num, height, width, components = view.shape
+    if colorspace not in lib.PIXEL_FORMATS:
+        raise ValueError("Invalid colorspace, must be one of {0}"
+                         .format(", ".join(sorted(lib.PIXEL_FORMATS))))
+    if lib.PIXEL_FORMATS[colorspace][1] != components:
+        raise ValueError("Colorspace {0} does not have {1} components"
+                         .format(colorspace, components))
+    flat = view.cast('B')
+    frame_size = height*width*components
+
+    def decode(index):
+        image = _load(inputs[index])
+        if width > image.width or height > image.height:
+            raise ValueError("Input {0} is smaller than the output frames"
+                             .format(index))
+        pixels = lib.Transformation(image.data).get_pixels(
+            width, height, colorspace)
+        flat[index*frame_size:(index+1)*frame_size] = pixels
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    with ThreadPoolExecutor(workers) as executor:
+        # Consume the results to propagate errors
+        for _ in executor.map(decode, range(num)):
+            pass
+    return out
+
+
+def hashes(inputs, method='phash', size=8, workers=None):
+    """ Compute the perceptual hashes of many images from their DC
+    coefficients, e.g. for finding near-duplicates.
+
+    :param inputs:  file names, JPEG data or :py:class:`jpegtran.JPEGImage`
+                    instances
+    :type inputs:   iterable
+    :param method:  'phash' or 'dhash', see :py:mod:`jpegtran.hashing`
+    :type method:   str
+    :param size:    number of bits per row and column
+    :type size:     int
+    :param workers: number of threads, defaults to the number of CPUs
+    :type workers:  int
+    :return:        hashes, in the order of the inputs
+    :rtype:         list of int
+    """
+    if method not in ('phash', 'dhash'):
+        raise ValueError("Method must be 'phash' or 'dhash'")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def compute(source):
+        return getattr(_load(source), method)(size)
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(compute, inputs))
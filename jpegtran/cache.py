@@ -0,0 +1,460 @@
+import collections
+import errno
+import hashlib
+import inspect
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import jpegtran.lib as lib
+from jpegtran.batch import apply_ops
+from jpegtran.transform import JPEGImage
+
+# Settings of the source image that change the result of an operation
+_RESULT_SETTINGS = ('thumbnail_policy', 'scale_engine', 'scale_profile',
+                    'max_memory')
+
+# Attributes set on the result by some operations, which are stored with
+# the cached data
+_RESULT_ATTRIBUTES = ('bytes_saved', 'quality')
+
+# Marks entries that end with the result attributes, see _pack_entry
+_ATTRIBUTES_MAGIC = b'JTCA'
+
+# Temporary files of writers that died are removed after this many seconds
+_STALE_TEMP_AGE = 3600
+
+
+def _canonical(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((k, _canonical(v)) for k, v in value.items()))
+    return value
+
+
+def normalize_ops(ops):
+    """ Bring an operation spec into a canonical form, in which all
+    arguments, including the defaults, are given by name, so that
+    equivalent specs like ``[('rotate', -90)]`` and ``[('rotate', 270)]`` or
+    ``[('downscale', 320, 240)]`` and ``[('downscale', 320, 240, 75)]`` have
+    the same form.
+
+    Operations are not merged, since applying them one at a time handles
+    the metadata differently than applying the combined operation.
+
+    :param ops:     operation spec, see :py:func:`jpegtran.batch.apply_ops`,
+                    callables are not supported
+    :return:        tuple of (name, ((argument, value), ...)) tuples
+    :rtype:         tuple
+
+    """
+    if callable(ops):
+        raise ValueError("Callable operation specs can not be cached")
+    normalized = []
+    for op in ops:
+        if isinstance(op, (str, type(u''))):
+            name, args = op, ()
+        else:
+            name, args = op[0], tuple(op[1:])
+        func = getattr(JPEGImage, name, None)
+        if name.startswith('_') or not callable(func):
+            raise ValueError("Invalid operation: {0}".format(name))
+        func = getattr(func, '__func__', func)
+        if lib.PY2:
+            bound = inspect.getcallargs(func, None, *args)
+            names = inspect.getargspec(func).args
+            arguments = [(n, bound[n]) for n in names]
+            arguments += [(n, v) for n, v in sorted(bound.items())
+                          if n not in names]
+        else:
+            bound = inspect.signature(func).bind(None, *args)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())
+        arguments = [(n, _canonical(v)) for n, v in arguments[1:]]
+        if name == 'rotate' and arguments[0][1] == -90:
+            arguments[0] = ('angle', 270)
+        normalized.append((name, tuple(arguments)))
+    return tuple(normalized)
+
+
+def _pack_entry(image):
+    """ Get the cached form of a result: the image data, followed by the
+    result attributes as JSON, their length and a magic number if there are
+    any. Decoders ignore the data after the EOI marker, so entries remain
+    valid JPEG files.
+    """
+    attributes = dict((name, getattr(image, name))
+                      for name in _RESULT_ATTRIBUTES if name in vars(image))
+    if not attributes:
+        return image.data
+    payload = json.dumps(attributes, sort_keys=True).encode('ascii')
+    return (bytes(image.data) + payload + struct.pack('>I', len(payload)) +
+            _ATTRIBUTES_MAGIC)
+
+
+def _unpack_entry(data):
+    """ Split a cached entry into the image data and the result
+    attributes, see :py:func:`_pack_entry`.
+    """
+    if bytes(data[-4:]) != _ATTRIBUTES_MAGIC:
+        return data, {}
+    length, = struct.unpack('>I', bytes(data[-8:-4]))
+    end = len(data) - 8 - length
+    return data[:end], json.loads(bytes(data[end:-8]).decode('ascii'))
+
+
+class MemoryCache(object):
+    """ Thread-safe in-memory store for encoded images, evicting the least
+    recently used entries once their total size exceeds a limit. Pickled
+    instances are empty.
+
+    :param max_bytes:   maximum total size of the stored images
+    :type max_bytes:    int
+
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self._init_state()
+
+    def _init_state(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """ Get the data stored for a key and mark it as recently used.
+
+        :return:    data or None if the key is not in the cache
+        :rtype:     bytes
+
+        """
+        with self._lock:
+            data = self._items.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """ Store data for a key, unless it is larger than the cache. """
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove all entries and reset the statistics. """
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Get the cache statistics.
+
+        :return:    Number of entries, their total size, maximum size, hits,
+                    misses and evictions
+        :rtype:     dict
+
+        """
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self._size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class DiskCache(object):
+    """ Store for encoded images in a directory, evicting the least recently
+    used entries once their total size exceeds a limit.
+
+    The directory can be shared by any number of processes: entries are
+    written atomically and every process evicts entries on its own, based
+    on the modification times, which are updated on every hit. Instances
+    can be pickled, e.g. to pass them to the workers of
+    :py:func:`jpegtran.batch.map`, the statistics are per instance.
+
+    :param directory:   directory to store the entries in, created if it
+                        does not exist
+    :type directory:    str
+    :param max_bytes:   maximum total size of the stored images
+    :type max_bytes:    int
+
+    """
+    def __init__(self, directory, max_bytes=1024*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._init_state()
+
+    def _init_state(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Total size as of the last scan plus what was written since, None
+        # until the directory is scanned for the first time
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.jpg')
+
+    def get(self, key):
+        """ Get the data stored for a key and mark it as recently used.
+
+        :return:    data or None if the key is not in the cache
+        :rtype:     bytearray
+
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                data = bytearray(os.fstat(fp.fileno()).st_size)
+                fp.readinto(data)
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Missing, or evicted by another process in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """ Store data for a key, unless it is larger than the cache. """
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        subdir = os.path.dirname(path)
+        try:
+            os.makedirs(subdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=subdir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            # Atomic, readers never see a partially written entry
+            getattr(os, 'replace', os.rename)(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            needs_eviction = self._size is None or self._size > self.max_bytes
+        if needs_eviction:
+            self._evict()
+
+    def _scan(self):
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.jpg'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                elif (filename.endswith('.tmp') and
+                        now - stat.st_mtime > _STALE_TEMP_AGE):
+                    _unlink(path)
+        return entries
+
+    def _evict(self):
+        """ Scan the directory and remove the least recently used entries
+        until the total size is below 90% of the limit, so that the next
+        scan is not needed right away.
+        """
+        entries = self._scan()
+        size = sum(s for _, s, _ in entries)
+        evictions = 0
+        if size > self.max_bytes:
+            entries.sort()
+            for _, entry_size, path in entries:
+                if size <= 0.9*self.max_bytes:
+                    break
+                if _unlink(path):
+                    evictions += 1
+                size -= entry_size
+        with self._lock:
+            self._size = size
+            self.evictions += evictions
+
+    def clear(self):
+        """ Remove all entries and reset the statistics. """
+        for _, _, path in self._scan():
+            _unlink(path)
+        with self._lock:
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Get the cache statistics.
+
+        :return:    Estimated total size of the entries, maximum size, hits,
+                    misses and evictions of this instance
+        :rtype:     dict
+
+        """
+        with self._lock:
+            return {'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return True
+    except OSError:
+        return False
+
+
+class ResultCache(object):
+    """ Content-addressed cache for the results of operation specs.
+
+    Results are keyed by a digest of the source image data, the normalized
+    operation spec (see :py:func:`normalize_ops`) and the settings of the
+    source image that affect the result (e.g. `scale_engine`), so they are
+    shared between different images with the same content. Lookups go to
+    the memory tier first and to the disk tier after that, disk hits are
+    promoted to the memory tier. Attributes of the results like
+    `bytes_saved` (see :py:meth:`jpegtran.JPEGImage.optimize`) are cached
+    along with the data. Instances can be pickled, the disk tier is
+    shared with the copies, the memory tier is not.
+
+    ::
+
+        cache = ResultCache(directory='/var/cache/thumbs')
+        thumb = cache.apply([('downscale', 320, 240, 80)], img)
+
+    :param max_bytes:       maximum size of the memory tier, 0 to disable it
+    :type max_bytes:        int
+    :param directory:       directory of the disk tier or None to disable
+                            it, see :py:class:`DiskCache`
+    :type directory:        str
+    :param disk_max_bytes:  maximum size of the disk tier
+    :type disk_max_bytes:   int
+
+    """
+    def __init__(self, max_bytes=64*1024*1024, directory=None,
+                 disk_max_bytes=1024*1024*1024):
+        self.memory = MemoryCache(max_bytes) if max_bytes else None
+        self.disk = (DiskCache(directory, disk_max_bytes)
+                     if directory is not None else None)
+
+    def key(self, ops, image):
+        """ Get the cache key for applying an operation spec to an image.
+
+        :return:    hex digest
+        :rtype:     str
+
+        """
+        data = image.data
+        digest = hashlib.sha256(buffer(data) if lib.PY2 else data)
+        # Class-level settings count as well, they apply to the image
+        settings = tuple((name, getattr(image, name))
+                         for name in _RESULT_SETTINGS)
+        digest.update(repr((normalize_ops(ops), settings)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def apply(self, ops, image):
+        """ Apply an operation spec to an image, unless the result is
+        already in the cache.
+
+        :param ops:     operation spec, see
+                        :py:func:`jpegtran.batch.apply_ops`, callables are
+                        not supported
+        :param image:   source image
+        :type image:    jpegtran.JPEGImage
+        :return:        transformed image
+        :rtype:         jpegtran.JPEGImage
+
+        """
+        key = self.key(ops, image)
+        data = None
+        if self.memory is not None:
+            data = self.memory.get(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None and self.memory is not None:
+                self.memory.put(key, data)
+        if data is not None:
+            data, attributes = _unpack_entry(data)
+            result = JPEGImage._from_result(data, source=image)
+            for name, value in attributes.items():
+                setattr(result, name, value)
+            return result
+
+        result = apply_ops(ops, image)
+        entry = _pack_entry(result)
+        if self.memory is not None:
+            self.memory.put(key, entry)
+        if self.disk is not None:
+            self.disk.put(key, entry)
+        return result
+
+    def clear(self):
+        """ Remove all entries from both tiers. """
+        for tier in (self.memory, self.disk):
+            if tier is not None:
+                tier.clear()
+
+    def stats(self):
+        """ Get the cache statistics.
+
+        :return:    Hits (in any tier) and misses, as well as the statistics
+                    of the 'memory' and 'disk' tiers (None if disabled)
+        :rtype:     dict
+
+        """
+        memory = self.memory.stats() if self.memory is not None else None
+        disk = self.disk.stats() if self.disk is not None else None
+        hits = 0
+        misses = None
+        for tier in (memory, disk):
+            if tier is not None:
+                hits += tier['hits']
+                # Only misses of the last tier are misses of the cache
+                misses = tier['misses']
+        return {'hits': hits, 'misses': misses or 0, 'memory': memory,
+                'disk': disk}
@@ -0,0 +1,341 @@
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from jpegtran.transform import JPEGImage
+
+#: Operations available on the command line, mapping to the
+#: :py:class:`jpegtran.JPEGImage` methods
+OPERATIONS = {
+    'autotransform': 'exif_autotransform',
+    'rotate': 'rotate',
+    'flip': 'flip',
+    'transpose': 'transpose',
+    'transverse': 'transverse',
+    'crop': 'crop',
+    'downscale': 'downscale',
+    'optimize': 'optimize',
+    'optimise': 'optimize',
+}
+
+_EXTENSIONS = ('.jpg', '.jpeg')
+
+_replace = getattr(os, 'replace', os.rename)
+
+USAGE_EXAMPLES = """
+operations are given as NAME[:ARG,...], arguments as positional values or
+KEY=VALUE pairs, e.g.:
+
+  %(prog)s --in-place -o autotransform -o optimize photos/
+  %(prog)s --output thumbs -o downscale:320,240,85 'photos/**/*.jpg'
+  %(prog)s --in-place -o rotate:90,progressive=true a.jpg b.jpg
+"""
+
+
+def _parse_value(text):
+    lowered = text.lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    if lowered == 'none':
+        return None
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_operation(text):
+    """ Parse an operation given as NAME[:ARG,...], where every argument is
+    either a positional value or a KEY=VALUE pair.
+
+    :return:    (method name, positional arguments, keyword arguments)
+    :rtype:     tuple
+    """
+    name, _, arguments = text.partition(':')
+    if name not in OPERATIONS:
+        raise ValueError("Unknown operation '{0}', must be one of {1}"
+                         .format(name, ", ".join(sorted(OPERATIONS))))
+    args, kwargs = [], {}
+    for argument in arguments.split(',') if arguments else ():
+        key, sep, value = argument.partition('=')
+        if sep:
+            kwargs[key] = _parse_value(value)
+        elif kwargs:
+            raise ValueError("Positional argument after keyword argument "
+                             "in '{0}'".format(text))
+        else:
+            args.append(_parse_value(argument))
+    return OPERATIONS[name], tuple(args), kwargs
+
+
+def apply_operations(operations, image):
+    """ Apply parsed operations (see :py:func:`parse_operation`) to an
+    image.
+
+    Unlike :py:meth:`jpegtran.JPEGImage.exif_autotransform`, 'autotransform'
+    leaves images without an EXIF orientation as they are (apart from the
+    output options), as if their orientation was 1, since directories of
+    photos usually contain some.
+
+    :rtype: jpegtran.JPEGImage
+    """
+    for name, args, kwargs in operations:
+        if name == 'exif_autotransform' and image.exif_orientation is None:
+            image = image.pipeline(*args, **kwargs).execute()
+        else:
+            image = getattr(image, name)(*args, **kwargs)
+    return image
+
+
+def _is_jpeg(path):
+    return path.lower().endswith(_EXTENSIONS)
+
+
+def expand_inputs(inputs):
+    """ Expand files, directories (recursively) and glob patterns to JPEG
+    files.
+
+    :return:    iterator over (path, relative path) tuples, where the
+                relative path is relative to the directory given or to the
+                fixed part of the glob pattern
+    """
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for fname in sorted(files):
+                    if _is_jpeg(fname):
+                        path = os.path.join(root, fname)
+                        yield path, os.path.relpath(path, item)
+        elif glob.has_magic(item):
+            base = item
+            while glob.has_magic(base):
+                base = os.path.dirname(base)
+            if sys.version_info < (3, 5):
+                matches = glob.glob(item)
+            else:
+                matches = glob.glob(item, recursive=True)
+            for path in sorted(matches):
+                if os.path.isfile(path) and _is_jpeg(path):
+                    yield path, os.path.relpath(path, base or os.curdir)
+        else:
+            yield item, os.path.basename(item)
+
+
+def save_atomic(image, fname, mode_from=None, fsync=False):
+    """ Save an image by writing it to a temporary file in the same
+    directory and renaming that over `fname`, so that readers (and later
+    runs, after a crash) only ever see either the old or the new file.
+
+    :param image:       image to save
+    :type image:        jpegtran.JPEGImage
+    :param fname:       path of the file
+    :param mode_from:   file to copy the permission bits from, e.g. the
+                        original of an image saved in place
+    :param fsync:       flush the data to disk before renaming the file
+    :type fsync:        bool
+    """
+    directory, basename = os.path.split(fname)
+    fd, temp_name = tempfile.mkstemp(suffix='.tmp', prefix='.' + basename,
+                                     dir=directory or os.curdir)
+    try:
+        try:
+            image.save(fd)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        if mode_from is not None:
+            shutil.copymode(mode_from, temp_name)
+        _replace(temp_name, fname)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+def _process(operations, source, target, fsync):
+    image = JPEGImage.open(source)
+    bytes_in = len(image.data)
+    result = apply_operations(operations, image)
+    if result is image and target == source:
+        return bytes_in, bytes_in
+    directory = os.path.dirname(target)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another worker in the meantime
+            if not os.path.isdir(directory):
+                raise
+    save_atomic(result, target, mode_from=source, fsync=fsync)
+    return bytes_in, len(result.data)
+
+
+class Manifest(object):
+    """ Progress manifest of a run, a file with a JSON object per line for
+    every processed file, so that an interrupted run can be resumed by
+    skipping the files that were already done.
+
+    :param fname:   path of the manifest, which is created if it does not
+                    exist and appended to otherwise
+    """
+    def __init__(self, fname):
+        #: Paths of the files that were processed successfully
+        self.done = set()
+        line = '\n'
+        if os.path.exists(fname):
+            with open(fname) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written by an interrupted run
+                        continue
+                    if entry.get('error') is None:
+                        self.done.add(entry['source'])
+        self._fp = open(fname, 'a')
+        if not line.endswith('\n'):
+            self._fp.write('\n')
+
+    def add(self, source, bytes_in=None, bytes_out=None, error=None):
+        """ Record a processed file and flush the manifest. """
+        self._fp.write(json.dumps({
+            'source': source, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+            'error': None if error is None else str(error)},
+            sort_keys=True) + '\n')
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+def run(operations, inputs, output=None, workers=None, manifest=None,
+        fsync=False, stderr=None):
+    """ Process many files on a pool of threads.
+
+    :param operations:  parsed operations, see :py:func:`parse_operation`
+    :param inputs:      (path, relative path) tuples, see
+                        :py:func:`expand_inputs`
+    :param output:      directory to write the results to (keeping their
+                        relative paths) or None for saving them in place
+    :param workers:     number of threads, defaults to the number of CPUs
+    :param manifest:    progress manifest, files recorded as done are
+                        skipped
+    :type manifest:     Manifest
+    :param fsync:       flush every result to disk, see
+                        :py:func:`save_atomic`
+    :param stderr:      stream to report failed files to, defaults to
+                        standard error
+    :return:            summary with the number of files processed, failed
+                        and skipped, the bytes read and written and the
+                        elapsed time in seconds
+    :rtype:             dict
+    """
+    # On Python 2 this requires the `futures` backport
+    from concurrent.futures import ThreadPoolExecutor
+    from jpegtran.batch import _imap_unordered
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if stderr is None:
+        stderr = sys.stderr
+    summary = dict(processed=0, failed=0, skipped=0, bytes_in=0,
+                   bytes_out=0)
+
+    def jobs():
+        for source, relative in inputs:
+            if manifest is not None and source in manifest.done:
+                summary['skipped'] += 1
+                continue
+            target = source if output is None else os.path.join(output,
+                                                                relative)
+            yield source, (operations, source, target, fsync)
+
+    start = timeit.default_timer()
+    executor = ThreadPoolExecutor(workers)
+    try:
+        for source, sizes, error in _imap_unordered(executor, _process,
+                                                    jobs(), 2*workers):
+            if error is not None:
+                summary['failed'] += 1
+                print("{0}: {1}".format(source, error), file=stderr)
+                sizes = (None, None)
+            else:
+                summary['processed'] += 1
+                summary['bytes_in'] += sizes[0]
+                summary['bytes_out'] += sizes[1]
+            if manifest is not None:
+                manifest.add(source, sizes[0], sizes[1], error)
+    finally:
+        executor.shutdown(wait=True)
+    summary['elapsed'] = timeit.default_timer() - start
+    return summary
+
+
+def format_summary(summary):
+    elapsed = max(summary['elapsed'], 1e-9)
+    return ("{processed} files processed, {failed} failed, {skipped} "
+            "skipped in {elapsed:.2f} s: {files:.1f} files/s, {mb:.1f} MB/s, "
+            "{saved} bytes saved".format(
+                files=summary['processed']/elapsed,
+                mb=summary['bytes_in']/elapsed/1e6,
+                saved=summary['bytes_in'] - summary['bytes_out'],
+                **summary))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='jpegtran-cffi',
+        description="Apply a chain of (mostly) lossless operations to many "
+                    "JPEG files in parallel.",
+        epilog=USAGE_EXAMPLES,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', metavar='INPUT',
+                        help="JPEG file, directory (searched recursively "
+                             "for .jpg and .jpeg files) or glob pattern")
+    parser.add_argument('-o', '--op', dest='operations', action='append',
+                        required=True, metavar='OPERATION',
+                        help="operation to apply, in the order given, one "
+                             "of {0}".format(", ".join(sorted(OPERATIONS))))
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--in-place', action='store_true',
+                        help="replace the input files")
+    target.add_argument('--output', metavar='DIR',
+                        help="directory to write the results to")
+    parser.add_argument('-j', '--workers', type=int,
+                        help="number of threads, defaults to the number of "
+                             "CPUs")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="progress manifest for resuming an interrupted "
+                             "run, files recorded as done are skipped")
+    parser.add_argument('--fsync', action='store_true',
+                        help="flush every result to disk before replacing "
+                             "the target file")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="do not print the summary")
+    args = parser.parse_args(argv)
+    try:
+        operations = [parse_operation(op) for op in args.operations]
+    except ValueError as e:
+        parser.error(str(e))
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    try:
+        summary = run(operations, expand_inputs(args.inputs), args.output,
+                      args.workers, manifest, args.fsync)
+    finally:
+        if manifest is not None:
+            manifest.close()
+    if not args.quiet:
+        print(format_summary(summary))
+    return 1 if summary['failed'] else 0
@@ -0,0 +1,98 @@
+from __future__ import division
+
+import math
+
+import jpegtran.lib as lib
+
+# Cosine tables of the DCT, by (number of samples, number of frequencies)
+_cosines = {}
+
+
+def _dc_thumbnail(data, width, height):
+    """ Get the luma of an image area filtered to the given size, as a list
+    of rows. It is computed from the DC coefficients, which form the image
+    at 1/8 of its size, so the image is not decoded (no IDCT, upsampling or
+    color conversion).
+    """
+    pixels, dc_width, dc_height = lib.Transformation(data).get_dc_pixels(0)
+    resized = lib.ffi.new("unsigned char[]", width*height)
+    if lib.lib.resize_area(pixels, dc_width, dc_height, dc_width, 1, 0, 0,
+                           dc_width, dc_height, resized, width,
+                           height) != 0:
+        raise MemoryError()
+    values = list(bytearray(lib.ffi.buffer(resized)))
+    return [values[y*width:(y+1)*width] for y in range(height)]
+
+
+def _dct(values, frequencies):
+    """ Get the lowest frequencies of the DCT-II of a sequence. """
+    count = len(values)
+    table = _cosines.get((count, frequencies))
+    if table is None:
+        table = [[math.cos(math.pi*(2*n + 1)*k/(2*count))
+                  for n in range(count)] for k in range(frequencies)]
+        _cosines[(count, frequencies)] = table
+    return [sum(v*c for v, c in zip(values, row)) for row in table]
+
+
+def _to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bit
+    return value
+
+
+def dhash(data, size=8):
+    """ Compute the difference hash of an image, i.e. whether each pixel of
+    its luma scaled to (size + 1) x size is brighter than its right
+    neighbour.
+
+    The hashes follow the common definitions (e.g. those of the `imagehash`
+    package), but are computed from the block means (see
+    :py:meth:`jpegtran.JPEGImage.dct_coefficients`) instead of the decoded
+    pixels, so their values differ slightly from hashes computed in the
+    pixel domain.
+
+    :param data:    JPEG data
+    :param size:    number of bits per row and column
+    :type size:     int
+    :return:        hash with size*size bits, row by row, first bit highest
+    :rtype:         int
+    """
+    rows = _dc_thumbnail(data, size + 1, size)
+    return _to_int(int(row[x] > row[x+1])
+                   for row in rows for x in range(size))
+
+
+def phash(data, size=8, highfreq_factor=4):
+    """ Compute the perceptual hash of an image, i.e. whether each of the
+    lowest size x size frequencies of the DCT of its luma scaled to
+    (size*highfreq_factor)^2 is above their median, see :py:func:`dhash`.
+
+    :param data:    JPEG data
+    :param size:    number of bits per row and column
+    :type size:     int
+    :param highfreq_factor: ratio of the size of the scaled image to the
+                            number of frequencies kept
+    :type highfreq_factor:  int
+    :return:        hash with size*size bits, row by row, first bit highest
+    :rtype:         int
+    """
+    dim = size*highfreq_factor
+    rows = [_dct(row, size) for row in _dc_thumbnail(data, dim, dim)]
+    columns = [_dct(column, size) for column in zip(*rows)]
+    # Transposed back to rows of frequencies
+    coefficients = [v for row in zip(*columns) for v in row]
+    ordered = sorted(coefficients)
+    mid = len(ordered)//2
+    if len(ordered) % 2:
+        median = ordered[mid]
+    else:
+        median = (ordered[mid-1] + ordered[mid])/2
+    return _to_int(int(v > median) for v in coefficients)
+
+
+def distance(hash1, hash2):
+    """ Get the Hamming distance between two hashes, i.e. the number of
+    differing bits. """
+    return bin(hash1 ^ hash2).count('1')
@@ -8,14 +8,34 @@ with open(os.path.join(os.path.dirname(__file__), 'jpegtran.cdef')) as fp:
 SOURCE = """
 #include "Epeg.h"
 #include "epeg_private.h"
+#include "coefficients.h"
 #include "jpeglib.h"
+#include "optimize.h"
+#include "resize.h"
 #include "turbojpeg.h"
+#include "validate.h"
+
+/* Optimized Huffman tables for transformations were added in turbojpeg 3.0,
+   older versions need a separate pass with optimize_coding() */
+#ifndef TJXOPT_OPTIMIZE
+#define TJXOPT_OPTIMIZE 0
+#endif
+
+/* Per-handle error messages were added in turbojpeg 2.0, along with
+   TJFLAG_STOPONWARNING, older versions only have the global one */
+#ifndef TJFLAG_STOPONWARNING
+static char *tjGetErrorStr2(tjhandle handle)
+{
+    return tjGetErrorStr();
+}
+#endif
 """
 
 ffi = FFI()
 ffi.set_source(
     "_jpegtran", SOURCE,
-    sources=["src/epeg.c"],
+    sources=["src/coefficients.c", "src/epeg.c", "src/optimize.c",
+             "src/resize.c", "src/validate.c"],
     include_dirs=["src"],
     define_macros=[("HAVE_UNSIGNED_CHAR", "1")],
     libraries=["jpeg", "turbojpeg"])
@@ -1,6 +1,10 @@
+import copy
 import struct
 import sys
+import threading
+import timeit
 import weakref
+from contextlib import contextmanager
 from functools import wraps
 
 from _jpegtran import ffi, lib
@@ -13,6 +17,33 @@ if PY2:
 
 _weak_keydict = weakref.WeakKeyDictionary()
 
+MARKER_SOF0 = 0xc0
+MARKER_DHT = 0xc4
+MARKER_SOI = 0xd8
+MARKER_EOI = 0xd9
+MARKER_SOS = 0xda
+MARKER_DQT = 0xdb
+MARKER_APP0 = 0xe0
+MARKER_APP1 = 0xe1
+MARKER_APP2 = 0xe2
+MARKER_APP14 = 0xee
+MARKER_APP15 = 0xef
+MARKER_COM = 0xfe
+
+# Start of frame markers, i.e. all markers from 0xc0 to 0xcf except for DHT,
+# JPG and DAC
+SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+PROGRESSIVE_SOF_MARKERS = frozenset((0xc2, 0xc6, 0xca, 0xce))
+
+# Chroma subsampling by ratio of luma to chroma sampling factors
+SUBSAMPLING_NAMES = {
+    (1, 1): '4:4:4',
+    (2, 1): '4:2:2',
+    (2, 2): '4:2:0',
+    (1, 2): '4:4:0',
+    (4, 1): '4:1:1',
+}
+
 
 class ExifException(Exception):
     pass
@@ -30,14 +61,241 @@ class NoExifDataFound(ExifException):
     pass
 
 
-class Exif(object):
+def _iter_segments(buf):
+    """ Iterate over the header segments of a JPEG image.
+
+    Only the segments up to and including the first SOS segment are
+    visited, so the entropy-coded data never has to be touched. Works with
+    any object supporting the buffer protocol.
+
+    :return:    Iterator over (marker, offset, length) tuples, where the
+                length includes the marker itself
+    """
+    if PY2:
+        buf = buffer(buf)
+    size = len(buf)
+    if size < 2 or struct.unpack_from('>H', buf, 0)[0] != 0xffd8:
+        return
+    yield (MARKER_SOI, 0, 2)
+    offset = 2
+    while offset+2 <= size:
+        prefix, code = struct.unpack_from('BB', buf, offset)
+        if prefix != 0xff:
+            return
+        if code == 0xff:  # Fill byte
+            offset += 1
+            continue
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            # TEM and RSTn markers don't have a segment
+            yield (code, offset, 2)
+            offset += 2
+            continue
+        if code == MARKER_EOI:
+            yield (code, offset, 2)
+            return
+        if offset+4 > size:
+            return
+        # Segment length includes the length field itself, but not the
+        # marker (2 bytes)
+        length = struct.unpack_from('>H', buf, offset+2)[0] + 2
+        yield (code, offset, length)
+        if code == MARKER_SOS:
+            return
+        offset += length
+
+
+def _find_segment(buf, marker):
+    """ Get the offset of the first header segment with the given marker.
+
+    :return:    Offset of the segment's marker or -1 if it was not found
+    """
+    for code, offset, _ in _iter_segments(buf):
+        if code == marker:
+            return offset
+    return -1
+
+
+class JPEGHeader(object):
+    """ Header information of a JPEG image.
+
+    Obtained by scanning the marker segments preceding the scan data, the
+    image data itself is neither copied nor decoded.
+
+    :ivar width:        Width of the image in pixels
+    :ivar height:       Height of the image in pixels
+    :ivar components:   List of (id, horizontal sampling factor, vertical
+                        sampling factor) tuples for every component
+    :ivar subsampling:  Chroma subsampling, e.g. '4:2:0', 'gray' for
+                        grayscale images or None if it is non-standard
+    :ivar colorspace:   'GRAY', 'YCbCr', 'RGB', 'CMYK' or 'YCCK'
+    :ivar progressive:  Whether the image is progressively encoded
+    :ivar mcu_size:     Width and height of a MCU in pixels
+    :ivar segments:     List of (marker, offset, length) tuples for the
+                        header segments, the first SOS segment and, if the
+                        image is not truncated, the EOI marker
+    """
     def __init__(self, blob):
+        buf = buffer(blob) if PY2 else blob
+        self.width = self.height = None
+        self.components = []
+        self.progressive = False
+        self.segments = []
+        adobe_transform = None
+        size = len(buf)
+        for marker, offset, length in _iter_segments(buf):
+            self.segments.append((marker, offset, length))
+            if marker in SOF_MARKERS and self.width is None:
+                # Marker (2 bytes), length (2 bytes), precision (1 byte),
+                # height, width (2 bytes each), number of components (1 byte)
+                # and 3 bytes per component
+                if length < 10 or offset+length > size:
+                    raise ValueError("Truncated JPEG frame header")
+                self.progressive = marker in PROGRESSIVE_SOF_MARKERS
+                self.height, self.width, num_components = struct.unpack_from(
+                    '>HHB', buf, offset+5)
+                if 10+3*num_components > length:
+                    raise ValueError("Invalid number of components in JPEG "
+                                     "frame header")
+                for idx in range(num_components):
+                    component_id, sampling = struct.unpack_from(
+                        'BB', buf, offset+10+3*idx)
+                    self.components.append(
+                        (component_id, sampling >> 4, sampling & 0x0f))
+            elif (marker == MARKER_APP14 and length >= 16 and
+                    offset+16 <= size and
+                    buf[offset+4:offset+9] == b'Adobe'):
+                adobe_transform = struct.unpack_from('B', buf, offset+15)[0]
+        if self.width is None:
+            raise ValueError("Could not find JPEG frame header")
+        if (self.segments[-1][0] == MARKER_SOS and size >= 4 and
+                struct.unpack_from('>H', buf, size-2)[0] == 0xffd9):
+            self.segments.append((MARKER_EOI, size-2, 2))
+
+        if len(self.components) == 1:
+            self.colorspace = 'GRAY'
+            self.subsampling = 'gray'
+            self.mcu_size = (8, 8)
+            return
+        max_h = max(h for _, h, _ in self.components)
+        max_v = max(v for _, _, v in self.components)
+        self.mcu_size = (8*max_h, 8*max_v)
+        if len(self.components) == 4:
+            self.colorspace = 'YCCK' if adobe_transform == 2 else 'CMYK'
+        elif (adobe_transform == 0 or
+                [c[0] for c in self.components] == [ord('R'), ord('G'),
+                                                     ord('B')]):
+            self.colorspace = 'RGB'
+        else:
+            self.colorspace = 'YCbCr'
+        _, luma_h, luma_v = self.components[0]
+        chroma = set((h, v) for _, h, v in self.components[1:])
+        if len(chroma) != 1:
+            self.subsampling = None
+        else:
+            chroma_h, chroma_v = chroma.pop()
+            if luma_h % chroma_h or luma_v % chroma_v:
+                self.subsampling = None
+            else:
+                self.subsampling = SUBSAMPLING_NAMES.get(
+                    (luma_h // chroma_h, luma_v // chroma_v))
+
+    def find(self, marker):
+        """ Get the offset of the first segment with the given marker.
+
+        :return:    Offset of the segment's marker or -1 if it was not found
+        """
+        for code, offset, _ in self.segments:
+            if code == marker:
+                return offset
+        return -1
+
+
+#: Names of commonly used EXIF tags, mapping to the IFD the tag is stored in
+#: and its number. 'IFD0' holds the main image's attributes, 'IFD1' the
+#: thumbnail's, 'Exif' and 'GPS' are the sub-IFDs referenced from IFD0 and
+#: 'Interop' is referenced from the Exif IFD.
+EXIF_TAGS = {
+    'ImageDescription': ('IFD0', 0x010e),
+    'Make': ('IFD0', 0x010f),
+    'Model': ('IFD0', 0x0110),
+    'Orientation': ('IFD0', 0x0112),
+    'XResolution': ('IFD0', 0x011a),
+    'YResolution': ('IFD0', 0x011b),
+    'ResolutionUnit': ('IFD0', 0x0128),
+    'Software': ('IFD0', 0x0131),
+    'DateTime': ('IFD0', 0x0132),
+    'Artist': ('IFD0', 0x013b),
+    'Copyright': ('IFD0', 0x8298),
+    'ExposureTime': ('Exif', 0x829a),
+    'FNumber': ('Exif', 0x829d),
+    'ISOSpeedRatings': ('Exif', 0x8827),
+    'DateTimeOriginal': ('Exif', 0x9003),
+    'DateTimeDigitized': ('Exif', 0x9004),
+    'SubSecTimeOriginal': ('Exif', 0x9291),
+    'Flash': ('Exif', 0x9209),
+    'FocalLength': ('Exif', 0x920a),
+    'PixelXDimension': ('Exif', 0xa002),
+    'PixelYDimension': ('Exif', 0xa003),
+    'LensModel': ('Exif', 0xa434),
+    'GPSLatitudeRef': ('GPS', 0x0001),
+    'GPSLatitude': ('GPS', 0x0002),
+    'GPSLongitudeRef': ('GPS', 0x0003),
+    'GPSLongitude': ('GPS', 0x0004),
+    'GPSAltitudeRef': ('GPS', 0x0005),
+    'GPSAltitude': ('GPS', 0x0006),
+    'GPSTimeStamp': ('GPS', 0x0007),
+    'GPSDateStamp': ('GPS', 0x001d),
+    'JPEGInterchangeFormat': ('IFD1', 0x0201),
+    'JPEGInterchangeFormatLength': ('IFD1', 0x0202),
+}
+
+# Tags in an IFD pointing to another IFD
+_SUB_IFDS = {
+    'IFD0': ((0x8769, 'Exif'), (0x8825, 'GPS')),
+    'Exif': ((0xa005, 'Interop'),),
+}
+
+# Order in which IFDs are searched for tags given by number only
+_IFD_ORDER = ('IFD0', 'Exif', 'GPS', 'Interop', 'IFD1')
+
+# Size in bytes and struct format of the TIFF field types, rationals
+# consist of two values
+_EXIF_TYPES = {
+    1: (1, 'B'),    # BYTE
+    2: (1, 's'),    # ASCII
+    3: (2, 'H'),    # SHORT
+    4: (4, 'I'),    # LONG
+    5: (8, 'II'),   # RATIONAL
+    6: (1, 'b'),    # SBYTE
+    7: (1, 's'),    # UNDEFINED
+    8: (2, 'h'),    # SSHORT
+    9: (4, 'i'),    # SLONG
+    10: (8, 'ii'),  # SRATIONAL
+    11: (4, 'f'),   # FLOAT
+    12: (8, 'd'),   # DOUBLE
+}
+
+
+class Exif(object):
+    """ Index of the EXIF metadata of a JPEG image.
+
+    The IFDs are parsed once, on initialization, into an index of the
+    offsets of all tags, so accessing a tag only ever unpacks the tag's
+    value. Values are read from and written to the image data directly.
+
+    :param blob:    JPEG image data, must be writable for modifications
+    :param app1:    offset of the APP1 segment if already known
+    :type app1:     int
+
+    """
+    def __init__(self, blob, app1=None):
         self._buf = blob
-        # EXIF struct starts after APP1 marker (2 bytes) and size (2 bytes)
-        try:
-            header = self._buf.index(b'\xff\xe1')+4
-        except ValueError:
+        self._app1 = _find_segment(self._buf, MARKER_APP1) if app1 is None \
+            else app1
+        if self._app1 < 0:
             raise NoExifDataFound("Could not find EXIF data")
+        # EXIF struct starts after APP1 marker (2 bytes) and size (2 bytes)
+        header = self._app1+4
         if not self._buf[header:header+6] == b'Exif\x00\x00':
             raise InvalidExifData("Invalid start of EXIF data")
         # EXIF data begins after EXIF header (6 bytes)
@@ -50,74 +308,297 @@ class Exif(object):
         else:
             raise InvalidExifData("Invalid byte alignment: {0}"
                                   .format(alignstr))
+        self._byteorder = '>' if self._motorola else '<'
+        # The segment may extend past the end of truncated data
+        self._end = min(self._app1 + 2 + self._unpack('>H', self._app1+2),
+                        len(self._buf))
+        # IFD0 pointer starts after alignment (2 bytes) and tag mark (2 bytes)
         self._ifd0 = self._unpack('I', self._exif_start+4)+self._exif_start
+        self._ifds = {}
+        self._index = {}
+        self._read_ifd('IFD0', self._ifd0)
+
+    def _read_ifd(self, name, offset):
+        """ Add the tags of an IFD and of the IFDs it refers to to the
+        index. Broken or looping references are ignored.
+        """
+        if name in self._ifds or not self._exif_start < offset < self._end-2:
+            return
+        self._ifds[name] = offset
+        num_entries = self._unpack('H', offset)
+        # Entries consist of tag (2 bytes), type (2 bytes), count (4 bytes)
+        # and value or offset (4 bytes), followed by the next IFD pointer
+        num_entries = min(num_entries, (self._end-offset-2)//12)
+        entries = struct.unpack_from(
+            '{0}{1}'.format(self._byteorder, 'HHII'*num_entries),
+            buffer(self._buf) if PY2 else self._buf, offset+2)
+        for idx in range(num_entries):
+            self._index.setdefault((name, entries[4*idx]), offset+2+12*idx)
+        for tag, sub_ifd in _SUB_IFDS.get(name, ()):
+            if (name, tag) in self._index:
+                self._read_ifd(sub_ifd, self._exif_start + self._unpack(
+                    'I', self._index[(name, tag)]+8))
+        next_offset = offset+2+12*num_entries
+        if name == 'IFD0' and next_offset+4 <= self._end:
+            next_ifd = self._unpack('I', next_offset)
+            if next_ifd:
+                self._read_ifd('IFD1', self._exif_start+next_ifd)
+
+    def _resolve(self, tag):
+        """ Get the (IFD, number) key of a tag given by name, by number or as
+        a (IFD, number) tuple.
+        """
+        if isinstance(tag, tuple):
+            return tag
+        if not isinstance(tag, int):
+            try:
+                return EXIF_TAGS[tag]
+            except KeyError:
+                raise ExifTagNotFound("Unknown EXIF tag name {0}"
+                                      .format(tag))
+        for ifd in _IFD_ORDER:
+            if (ifd, tag) in self._index:
+                return (ifd, tag)
+        return (None, tag)
+
+    def _get_tag_offset(self, tag):
+        key = self._resolve(tag)
+        try:
+            return self._index[key]
+        except KeyError:
+            raise ExifTagNotFound("Could not find EXIF Tag {0}"
+                                  .format(key[1]))
+
+    def _value_offset(self, entry):
+        """ Get the type, number of values and offset of the values of an
+        IFD entry.
+        """
+        field_type = self._unpack('H', entry+2)
+        count = self._unpack('I', entry+4)
+        if field_type not in _EXIF_TYPES:
+            raise InvalidExifData("Unknown field type {0}"
+                                  .format(field_type))
+        size = _EXIF_TYPES[field_type][0]*count
+        # Values of up to 4 bytes are stored in the entry itself
+        if size <= 4:
+            offset = entry+8
+        else:
+            offset = self._exif_start + self._unpack('I', entry+8)
+        if offset+size > self._end:
+            raise InvalidExifData("Tag value points outside of EXIF data")
+        return field_type, count, offset
+
+    def keys(self):
+        """ Get the keys of all tags.
+
+        :return:    List of (IFD, tag number) tuples
+        """
+        return list(self._index)
+
+    def __contains__(self, tag):
+        try:
+            return self._resolve(tag) in self._index
+        except ExifTagNotFound:
+            return False
+
+    def get(self, tag, default=None):
+        """ Get the value of a tag, see :py:meth:`__getitem__`, or `default`
+        if the image does not have the tag.
+        """
+        try:
+            return self[tag]
+        except ExifTagNotFound:
+            return default
+
+    def __getitem__(self, tag):
+        """ Get the value of a tag.
+
+        :param tag: tag name (see :py:data:`EXIF_TAGS`), number or (IFD,
+                    number) tuple
+        :return:    text for ASCII tags, bytes for BYTE and UNDEFINED tags,
+                    otherwise a number or, for RATIONAL tags, a (numerator,
+                    denominator) tuple, or a tuple of those for tags with
+                    multiple values
+        """
+        field_type, count, offset = self._value_offset(
+            self._get_tag_offset(tag))
+        size, fmt = _EXIF_TYPES[field_type]
+        if fmt == 's':
+            value = bytes(self._buf[offset:offset+count])
+            if field_type == 2:
+                value = value.split(b'\x00', 1)[0].decode('latin-1')
+            return value
+        values = struct.unpack_from(
+            '{0}{1}'.format(self._byteorder, fmt*count),
+            buffer(self._buf) if PY2 else self._buf, offset)
+        if len(fmt) == 2:
+            values = tuple(zip(values[::2], values[1::2]))
+        return values[0] if count == 1 else values
+
+    def __setitem__(self, tag, value):
+        """ Change the value of a tag in place.
+
+        Since the layout of the EXIF data is left untouched, the new value
+        must fit into the space of the old one: text may be shorter than
+        the old text, all other values must have the same number of values.
+
+        :param tag:     tag name (see :py:data:`EXIF_TAGS`), number or (IFD,
+                        number) tuple
+        :param value:   new value in the format returned by
+                        :py:meth:`__getitem__`
+        """
+        field_type, count, offset = self._value_offset(
+            self._get_tag_offset(tag))
+        size, fmt = _EXIF_TYPES[field_type]
+        if fmt == 's':
+            if field_type == 2:
+                value = value.encode('latin-1')
+            value = bytes(value)
+            if len(value) > count - (field_type == 2):
+                raise ValueError("Value does not fit into the existing tag")
+            self._buf[offset:offset+count] = value.ljust(count, b'\x00')
+            return
+        values = value if count > 1 else (value,)
+        if len(values) != count:
+            raise ValueError("Tag requires {0} values".format(count))
+        packed = struct.Struct('{0}{1}'.format(self._byteorder, fmt*count))
+        try:
+            if len(fmt) == 2:
+                values = [number for pair in values for number in pair]
+            data = packed.pack(*values)
+        except (TypeError, struct.error):
+            raise ValueError("Invalid value for tag: {0!r}".format(value))
+        self._buf[offset:offset+packed.size] = data
 
     @property
     def orientation(self):
         # Orientation data follows after tag (2 bytes), format (2 bytes) and
         # number of components (4 bytes)
-        return self._unpack('H', self._get_tag_offset(0x112)+8)
+        return self._unpack('H', self._get_tag_offset(('IFD0', 0x112))+8)
 
     @orientation.setter
     def orientation(self, value):
         if not 0 < value < 9:
             raise ValueError("Orientation value must be between 1 and 8")
-        self._pack('H', self._get_tag_offset(0x112)+8, value)
+        self._pack('H', self._get_tag_offset(('IFD0', 0x112))+8, value)
+
+    def _thumbnail_location(self):
+        offset = (self._exif_start +
+                  self._unpack('I', self._get_tag_offset(('IFD1', 0x201))+8))
+        size = self._unpack('I', self._get_tag_offset(('IFD1', 0x202))+8)
+        return offset, size
 
     @property
     def thumbnail(self):
-        offset = (self._exif_start +
-                  self._unpack('I', self._get_tag_offset(0x201)+8))
-        size = self._unpack('I', self._get_tag_offset(0x202)+8)
-        if self._buf[:2] != b'\xff\xd8':
-            raise ValueError("Thumbnail is not in JPEG format.")
+        offset, size = self._thumbnail_location()
+        if self._buf[offset:offset+2] != b'\xff\xd8':
+            raise InvalidExifData("Thumbnail is not in JPEG format.")
         return self._buf[offset:offset+size]
 
     @thumbnail.setter
     def thumbnail(self, data):
-        offset = (self._exif_start +
-                  self._unpack('I', self._get_tag_offset(0x201)+8))
-        old_size = self._unpack('I', self._get_tag_offset(0x202)+8)
-        app1_size_offset = self._buf.index(b'\xff\xe1')+2
+        offset, old_size = self._thumbnail_location()
+        app1_size_offset = self._app1+2
         app1_size = self._unpack('>H', app1_size_offset)
         # Strip everything between the JFIF APP1 and the quant table
-        try:
-            jfif_start = data.index(b'\xff\xe0')
-            quant_start = data.index(b'\xff\xdb')
-            stripped_data = data[0:jfif_start] + data[quant_start:]
-        except ValueError:
+        jfif_start = _find_segment(data, MARKER_APP0)
+        quant_start = _find_segment(data, MARKER_DQT)
+        if jfif_start >= 0 and quant_start >= 0:
+            stripped_data = (bytearray(data[0:jfif_start]) +
+                             data[quant_start:])
+        else:
             stripped_data = data
         self._pack('>H', app1_size_offset,
                    app1_size+(len(stripped_data)-old_size))
-        self._pack('I', self._get_tag_offset(0x202)+8, len(stripped_data))
+        self._pack('I', self._get_tag_offset(('IFD1', 0x202))+8,
+                   len(stripped_data))
         self._buf[offset:offset+old_size] = stripped_data
+        self._end += len(stripped_data)-old_size
 
-    def _get_tag_offset(self, tagnum):
-        # IFD0 pointer starts after alignment (2 bytes) and tag mark (2 bytes)
-        p_ifd = self._unpack('I', self._exif_start+4)+self._exif_start
-        while True:
-            num_entries = self._unpack('H', p_ifd)
-            # Start after number of entries (2 bytes)
-            idx = p_ifd + 2
-            for _ in range(num_entries):
-                tag_num = self._unpack('H', idx)
-                # Check if we're at the desired tag
-                if tag_num == tagnum:
-                    return idx
-                idx += 12
-            p_ifd = self._unpack('I', idx)
-            if p_ifd == 0:  # This means there are no more IFDs
-                raise ExifTagNotFound("Could not find EXIF Tag {0}"
-                                      .format(tagnum))
-            p_ifd += self._exif_start
+    def remove_thumbnail(self):
+        """ Remove the thumbnail and unlink IFD1, which describes it.
+
+        The data following the thumbnail is moved down and the offsets
+        referring to it are adjusted, unless it holds a MakerNote, whose
+        internal offsets cannot be known, in which case the thumbnail data
+        is left in place.
+        """
+        offset, size = self._thumbnail_location()
+        # Unlink IFD1, which describes the thumbnail, from IFD0
+        num_entries = self._unpack('H', self._ifd0)
+        self._pack('I', self._ifd0+2+12*num_entries, 0)
+        self._index = dict((key, entry) for key, entry in self._index.items()
+                           if key[0] != 'IFD1')
+        del self._ifds['IFD1']
+        end = offset+size
+        if end > self._end or not self._can_move(end):
+            return
+        self._shift_offsets(end, -size)
+        app1_size_offset = self._app1+2
+        self._pack('>H', app1_size_offset,
+                   self._unpack('>H', app1_size_offset)-size)
+        del self._buf[offset:end]
+        self._end -= size
+        # The IFDs following the thumbnail have moved
+        self._ifds = {}
+        self._index = {}
+        self._read_ifd('IFD0', self._ifd0)
+
+    def _can_move(self, start):
+        """ Check whether the data from `start` on can be moved, i.e. does
+        not hold a MakerNote. """
+        if ('Exif', 0x927c) not in self._index:
+            return True
+        try:
+            _, count, value = self._value_offset(self._index[('Exif',
+                                                              0x927c)])
+        except InvalidExifData:
+            return False
+        return value+count <= start
+
+    def _shift_offsets(self, start, delta):
+        """ Adjust all offsets that refer to data from `start` on by `delta`
+        bytes: the IFD0 pointer, the pointers to the next IFD and to the
+        sub-IFDs and the offsets of values that are not stored in their
+        entries.
+        """
+        start -= self._exif_start
+        pointers = [self._exif_start+4]
+        for name, ifd in self._ifds.items():
+            num_entries = self._unpack('H', ifd)
+            if ifd+6+12*num_entries <= self._end:
+                pointers.append(ifd+2+12*num_entries)
+            for tag, _ in _SUB_IFDS.get(name, ()):
+                if (name, tag) in self._index:
+                    pointers.append(self._index[(name, tag)]+8)
+        sub_ifd_entries = set(pointers)
+        for entry in self._index.values():
+            if entry+8 in sub_ifd_entries:
+                continue
+            try:
+                field_type, count, _ = self._value_offset(entry)
+            except InvalidExifData:
+                continue
+            if _EXIF_TYPES[field_type][0]*count > 4:
+                pointers.append(entry+8)
+        for pointer in pointers:
+            value = self._unpack('I', pointer)
+            if value >= start:
+                self._pack('I', pointer, value+delta)
+        if self._ifd0 >= start+self._exif_start:
+            self._ifd0 += delta
 
     def _unpack(self, fmt, offset):
         if '>' not in fmt and '<' not in fmt:
             fmt = ('>' if self._motorola else '<')+fmt
-        if PY2:
-            return struct.unpack_from(fmt, buffer(self._buf), offset)[0]
-        else:
-            return struct.unpack_from(fmt, self._buf, offset)[0]
+        try:
+            if PY2:
+                return struct.unpack_from(fmt, buffer(self._buf), offset)[0]
+            else:
+                return struct.unpack_from(fmt, self._buf, offset)[0]
+        except struct.error:
+            raise InvalidExifData("EXIF data ends at offset {0}"
+                                  .format(offset))
 
     def _pack(self, fmt, offset, value):
         if '>' not in fmt and '<' not in fmt:
@@ -125,44 +606,880 @@ class Exif(object):
         struct.pack_into(fmt, self._buf, offset, value)
 
 
+def _from_buffer(data):
+    """ Get a pointer to the contents of an object supporting the buffer
+    protocol (bytes, bytearray, memoryview, mmap, ...) without copying it.
+    """
+    return ffi.from_buffer("unsigned char[]", data)
+
+
+def _native_buffer(pointer, size, allocated=True):
+    """ Expose a natively allocated output buffer as a memoryview without
+    copying it.
+
+    `pointer` is the garbage-collected pointer to the output buffer that
+    was handed to the native routine, it is kept alive (and thus the buffer
+    is not freed) for as long as the memoryview or any slice of it exists.
+    `allocated` tells whether the native routine allocated the buffer, as
+    opposed to writing to a preallocated one.
+    """
+    data = pointer[0]
+    _weak_keydict[data] = pointer
+    if instrumentation.enabled:
+        instrumentation._track(pointer, size, allocated)
+    return memoryview(ffi.buffer(data, size))
+
+
 def _turbojpeg_cleanup(buffers):
     lib.tjFree(buffers[0])
 
 
-def jpegtran_op(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        # Setup variables
-        in_data_len = len(self._data)
-        in_data_p = ffi.new("unsigned char[]", in_data_len)
-        inbuf = ffi.buffer(in_data_p, in_data_len)
-        inbuf[:] = self._data
+def _turbojpeg_error(tjhandle):
+    """ Get the message of the last error of a turbojpeg handle, rather
+    than the global one, which may belong to another thread's failure.
+    """
+    if tjhandle == ffi.NULL:
+        return ffi.string(lib.tjGetErrorStr())
+    return ffi.string(lib.tjGetErrorStr2(tjhandle))
 
-        out_bufs = ffi.gc(ffi.new("unsigned char**"), _turbojpeg_cleanup)
-        out_bufs[0] = ffi.NULL
-        out_sizes = ffi.new("unsigned long*")
 
-        tjhandle = ffi.gc(lib.tjInitTransform(), lib.tjDestroy)
+class TransformHandlePool(object):
+    """ Thread-safe pool of turbojpeg transform handles.
 
-        # Call the wrapped function with the transformoption struct
-        transformoption = func(self, *args, **kwargs)
+    Transform handles can be used for compression and decompression as
+    well. Handles are checked out for the duration of a single operation, so
+    every handle is only ever used by one thread at a time. Handles that
+    were involved in a failed operation are discarded instead of being
+    returned to the pool.
 
-        # Execute transformation
-        rv = lib.tjTransform(tjhandle, in_data_p, in_data_len, 1,
-                             out_bufs, out_sizes, transformoption, 0)
+    :param maxsize:     Maximum number of idle handles kept around
+    :type maxsize:      int
+
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._handles = []
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """ Number of idle handles in the pool. """
+        return len(self._handles)
+
+    @contextmanager
+    def handle(self):
+        """ Check out a handle, creating a new one if the pool is empty. """
+        with self._lock:
+            if self._handles:
+                tjhandle = self._handles.pop()
+                self.hits += 1
+            else:
+                tjhandle = None
+                self.misses += 1
+        if tjhandle is None:
+            tjhandle = ffi.gc(lib.tjInitTransform(), lib.tjDestroy)
+            if tjhandle == ffi.NULL:
+                raise Exception("Could not initialize transformation: {0}"
+                                .format(_turbojpeg_error(tjhandle)))
+        yield tjhandle
+        with self._lock:
+            if len(self._handles) < self.maxsize:
+                self._handles.append(tjhandle)
+
+    def clear(self):
+        """ Release all idle handles and reset the statistics. """
+        with self._lock:
+            del self._handles[:]
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Get the pool statistics.
+
+        :return:    Pool size, maximum size, hits and misses
+        :rtype:     dict
+
+        """
+        with self._lock:
+            return {'size': len(self._handles), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+handle_pool = TransformHandlePool()
+
+# turbojpeg constants for the subsampling names used by JPEGHeader
+_TJ_SUBSAMPLING = {
+    '4:4:4': lib.TJSAMP_444,
+    '4:2:2': lib.TJSAMP_422,
+    '4:2:0': lib.TJSAMP_420,
+    'gray': lib.TJSAMP_GRAY,
+    '4:4:0': lib.TJSAMP_440,
+    '4:1:1': lib.TJSAMP_411,
+}
+
+
+def buffer_size(width, height, subsampling):
+    """ Get the size of an output buffer that is large enough for any
+    lossless transformation resulting in an image of the given dimensions,
+    as required by turbojpeg for writing to a preallocated buffer.
+
+    :param subsampling: Chroma subsampling of the source image, see
+                        :py:attr:`JPEGHeader.subsampling`
+    :return:            Size in bytes or None for non-standard subsampling
+    """
+    tjsamp = _TJ_SUBSAMPLING.get(subsampling)
+    if tjsamp is None:
+        return None
+    # Depending on the transformation, turbojpeg bounds the size with either
+    # the source or the result orientation
+    return max(lib.tjBufSize(width, height, tjsamp),
+               lib.tjBufSize(height, width, tjsamp))
+
+
+class BufferArena(object):
+    """ Thread-safe pool of native output buffers for lossless
+    transformations.
+
+    Transformations writing to a buffer leased from the arena do so in
+    place (TJFLAG_NOREALLOC), instead of having turbojpeg grow its output
+    buffer with repeated calls to realloc. The buffer is used as the data of
+    the resulting image without copying it and goes back to the arena once
+    it is no longer referenced, so a steady stream of similarly sized images
+    is transformed without any allocations. Buffers are sized for the worst
+    case (see :py:func:`buffer_size`), which is several times the size of a
+    typical result, so results should not be kept around for long.
+
+    :param maxsize:     Maximum number of idle buffers kept around
+    :type maxsize:      int
+
+    """
+    #: Buffer sizes are rounded up to a multiple of this, so that buffers can
+    #: be reused for images of slightly different sizes
+    granularity = 64*1024
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._buffers = []
+        # Reentrant, since buffers can be released by the garbage collector
+        # while the arena is locked
+        self._lock = threading.RLock()
+
+    @property
+    def size(self):
+        """ Number of idle buffers in the arena. """
+        return len(self._buffers)
+
+    def lease(self, size):
+        """ Get a buffer of at least `size` bytes, preferring the smallest
+        idle one.
+
+        :return:    Garbage-collected pointer to the buffer and its capacity,
+                    the buffer is returned to the arena once the pointer is
+                    collected
+        :rtype:     (cdata, int) tuple
+
+        """
+        with self._lock:
+            fitting = [idx for idx, (capacity, _) in enumerate(self._buffers)
+                       if capacity >= size]
+            if fitting:
+                idx = min(fitting, key=lambda idx: self._buffers[idx][0])
+                capacity, buf = self._buffers.pop(idx)
+                self.hits += 1
+            else:
+                buf = None
+                self.misses += 1
+        if buf is None:
+            capacity = -(-size // self.granularity) * self.granularity
+            buf = lib.tjAlloc(capacity)
+            if buf == ffi.NULL:
+                raise MemoryError()
+            if instrumentation.enabled:
+                instrumentation._count_allocation()
+        pointer = ffi.gc(ffi.new("unsigned char**"),
+                         lambda pointer: self._release(pointer[0], capacity))
+        pointer[0] = buf
+        return pointer, capacity
+
+    def _release(self, buf, capacity):
+        with self._lock:
+            if len(self._buffers) < self.maxsize:
+                self._buffers.append((capacity, buf))
+                return
+        lib.tjFree(buf)
+
+    def clear(self):
+        """ Free all idle buffers and reset the statistics. """
+        with self._lock:
+            for _, buf in self._buffers:
+                lib.tjFree(buf)
+            del self._buffers[:]
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Get the arena statistics.
+
+        :return:    Number of idle buffers, maximum number, hits, misses and
+                    total capacity of the idle buffers in bytes
+        :rtype:     dict
+
+        """
+        with self._lock:
+            return {'size': len(self._buffers), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses,
+                    'capacity': sum(c for c, _ in self._buffers)}
+
+
+#: Default arena, see :py:attr:`jpegtran.JPEGImage.buffer_arena`
+buffer_arena = BufferArena()
+
+#: Phases the time of an operation is split into, see
+#: :py:class:`Instrumentation`
+PHASES = ('copy_in', 'native', 'copy_out', 'thumbnail')
+
+_timer = timeit.default_timer
+
+
+class Profile(object):
+    """ Statistics recorded by :py:class:`Instrumentation`, either for the
+    whole process or while a profile (see :py:meth:`Instrumentation.profile`)
+    was active.
+
+    :ivar operations:           dict mapping operation names to dicts with
+                                the number of 'calls', 'bytes_in',
+                                'bytes_out' and the seconds spent in each of
+                                the :py:data:`PHASES`
+    :ivar native_allocations:   number of native output buffers allocated
+    :ivar peak_native_bytes:    maximum number of bytes in native output
+                                buffers that were referenced at the same
+                                time
+    """
+    def __init__(self, native_bytes=0):
+        self.operations = {}
+        self.native_allocations = 0
+        self.peak_native_bytes = native_bytes
+
+    def _add(self, operation, key, value):
+        counters = self.operations.get(operation)
+        if counters is None:
+            counters = dict.fromkeys(('calls', 'bytes_in', 'bytes_out'), 0)
+            counters.update(dict.fromkeys(PHASES, 0.0))
+            self.operations[operation] = counters
+        counters[key] += value
+
+    def stats(self):
+        """ Get the recorded statistics.
+
+        :return:    'operations', 'native_allocations' and
+                    'peak_native_bytes', see above
+        :rtype:     dict
+
+        """
+        return {'operations': copy.deepcopy(self.operations),
+                'native_allocations': self.native_allocations,
+                'peak_native_bytes': self.peak_native_bytes}
+
+    def report(self):
+        """ Format the time spent per operation and phase as a table.
+
+        :rtype:     str
+        """
+        lines = ['{0:<16} {1:>7} {2:>12} {3:>12}'.format(
+            'operation', 'calls', 'bytes in', 'bytes out') +
+            ''.join(' {0:>12}'.format(p + ' ms') for p in PHASES)]
+        for operation in sorted(self.operations):
+            counters = self.operations[operation]
+            lines.append('{0:<16} {1:>7} {2:>12} {3:>12}'.format(
+                operation, counters['calls'], counters['bytes_in'],
+                counters['bytes_out']) + ''.join(
+                ' {0:>12.3f}'.format(counters[p]*1000) for p in PHASES))
+        lines.append('{0} native allocations, peak {1} native bytes'.format(
+            self.native_allocations, self.peak_native_bytes))
+        return '\n'.join(lines)
+
+
+class Instrumentation(object):
+    """ Opt-in instrumentation of the native operations.
+
+    The operations ('transform', 'optimize_coding', 'epeg_scale',
+    'turbo_scale', 'decode', 'coefficients' and 'validate', as well as
+    'private_copy' for copying the data of an image before modifying it in
+    place and 'as_blob') are timed in :py:data:`PHASES`: 'copy_in'
+    (getting the input to the native code), 'native' (the native calls),
+    'copy_out' (wrapping or copying the output) and 'thumbnail'
+    (maintaining the EXIF thumbnail of the result, which includes
+    operations on the thumbnail that are recorded on their own as well).
+    The calls, the bytes passed in and out, the native output buffers
+    allocated and the bytes in native output buffers that are still
+    referenced are counted as well.
+
+    Nothing is recorded unless instrumentation is enabled with
+    :py:meth:`enable`, a hook is installed or a profile is active, in which
+    case the instrumented code only checks the `enabled` attribute. ::
+
+        with jpegtran.lib.instrumentation.profile() as prof:
+            img.rotate(90)
+        print(prof.report())
+
+    """
+    def __init__(self):
+        #: Whether anything is recorded, read-only
+        self.enabled = False
+        self._explicit = False
+        self._hooks = []
+        self._profiles = []
+        self._totals = Profile()
+        self._native_bytes = 0
+        self._buffer_refs = set()
+        # Reentrant, since buffers can be freed by the garbage collector
+        # while the statistics are locked
+        self._lock = threading.RLock()
+
+    def _update(self):
+        self.enabled = bool(self._explicit or self._hooks or self._profiles)
+
+    def enable(self):
+        """ Record statistics until :py:meth:`disable` is called. """
+        with self._lock:
+            self._explicit = True
+            self._update()
+
+    def disable(self):
+        """ Stop recording statistics, unless hooks are installed or a
+        profile is active. """
+        with self._lock:
+            self._explicit = False
+            self._update()
+
+    def add_hook(self, hook):
+        """ Install a callback that is passed every measurement as it is
+        recorded, e.g. to feed a metrics system::
+
+            def hook(operation, metric, value):
+                if metric in jpegtran.lib.PHASES:
+                    statsd.timing('jpegtran.{0}.{1}'.format(
+                        operation, metric), value*1000)
+                else:
+                    statsd.incr('jpegtran.{0}.{1}'.format(
+                        operation, metric), value)
+
+        :param hook:    callable taking the operation name, the metric (one
+                        of :py:data:`PHASES` for times in seconds, or
+                        'calls', 'bytes_in' or 'bytes_out') and the value;
+                        called from the thread running the operation
+        """
+        with self._lock:
+            self._hooks.append(hook)
+            self._update()
+
+    def remove_hook(self, hook):
+        """ Remove a callback installed with :py:meth:`add_hook`. """
+        with self._lock:
+            self._hooks.remove(hook)
+            self._update()
+
+    @contextmanager
+    def profile(self):
+        """ Context manager recording the operations of all threads while
+        it is active.
+
+        :return:    statistics recorded so far
+        :rtype:     :py:class:`Profile`
+        """
+        prof = Profile(self._native_bytes)
+        with self._lock:
+            self._profiles.append(prof)
+            self._update()
+        try:
+            yield prof
+        finally:
+            with self._lock:
+                self._profiles.remove(prof)
+                self._update()
+
+    def start(self):
+        """ Get the time the first phase of an operation starts at, or None
+        if instrumentation is disabled. """
+        if self.enabled:
+            return _timer()
+        return None
+
+    def record(self, operation, phase, start):
+        """ Record the end of a phase that started at `start`, as returned
+        by :py:meth:`start` or the previous call.
+
+        :return:    the current time, i.e. the start of the next phase, or
+                    None if instrumentation is disabled
+        """
+        if start is None or not self.enabled:
+            return None
+        now = _timer()
+        self._emit(operation, phase, now - start)
+        return now
+
+    def count(self, operation, bytes_in=0, bytes_out=0):
+        """ Count a call of an operation and the bytes passed in and out.
+        """
+        if not self.enabled:
+            return
+        self._emit(operation, 'calls', 1)
+        self._emit(operation, 'bytes_in', bytes_in)
+        self._emit(operation, 'bytes_out', bytes_out)
+
+    def _emit(self, operation, metric, value):
+        with self._lock:
+            for prof in [self._totals] + self._profiles:
+                prof._add(operation, metric, value)
+            hooks = list(self._hooks)
+        for hook in hooks:
+            hook(operation, metric, value)
+
+    def _track(self, pointer, size, allocated=True):
+        """ Count a native output buffer until its pointer is collected.
+        """
+        with self._lock:
+            if allocated:
+                self._count_allocation()
+            self._native_bytes += size
+            for prof in [self._totals] + self._profiles:
+                prof.peak_native_bytes = max(prof.peak_native_bytes,
+                                             self._native_bytes)
+            self._buffer_refs.add(weakref.ref(
+                pointer, lambda ref: self._untrack(ref, size)))
+
+    def _untrack(self, ref, size):
+        with self._lock:
+            self._buffer_refs.discard(ref)
+            self._native_bytes -= size
+
+    def _count_allocation(self):
+        with self._lock:
+            for prof in [self._totals] + self._profiles:
+                prof.native_allocations += 1
+
+    def clear(self):
+        """ Reset the statistics, except for the number of bytes in
+        referenced native output buffers. """
+        with self._lock:
+            self._totals = Profile(self._native_bytes)
+
+    def stats(self):
+        """ Get the statistics recorded since the module was loaded or
+        :py:meth:`clear` was called.
+
+        :return:    the statistics described for :py:meth:`Profile.stats`
+                    and 'native_bytes', the number of bytes in native output
+                    buffers that are currently referenced
+        :rtype:     dict
+
+        """
+        with self._lock:
+            stats = self._totals.stats()
+            stats['native_bytes'] = self._native_bytes
+            return stats
+
+
+#: Instrumentation of the native operations, disabled by default
+instrumentation = Instrumentation()
+
+
+def _transform(data, transformoptions, n=1, buffers=None):
+    """ Run `n` transformations on the same input with a single call to
+    tjTransform, which only has to read the input once.
+
+    :param buffers: List with a preallocated output buffer for every
+                    transformation, as returned by
+                    :py:meth:`BufferArena.lease`, or None to let turbojpeg
+                    allocate them
+    :return:    List with a buffer for every transformation's output
+    """
+    start = instrumentation.start()
+    in_data = _from_buffer(data)
+    out_bufs = ffi.new("unsigned char*[]", n)
+    out_sizes = ffi.new("unsigned long[]", n)
+    flags = 0
+    if buffers is not None:
+        flags |= lib.TJFLAG_NOREALLOC
+        for idx, (pointer, capacity) in enumerate(buffers):
+            out_bufs[idx] = pointer[0]
+            out_sizes[idx] = capacity
+
+    with handle_pool.handle() as tjhandle:
+        start = instrumentation.record('transform', 'copy_in', start)
+        rv = lib.tjTransform(tjhandle, in_data, len(in_data), n,
+                             out_bufs, out_sizes, transformoptions, flags)
+        start = instrumentation.record('transform', 'native', start)
+        if buffers is not None:
+            pointers = [pointer for pointer, _ in buffers]
+        else:
+            # Every output buffer is freed independently, even if the
+            # transformation failed halfway through
+            pointers = []
+            for idx in range(n):
+                pointer = ffi.gc(ffi.new("unsigned char**"),
+                                 _turbojpeg_cleanup)
+                pointer[0] = out_bufs[idx]
+                pointers.append(pointer)
         if rv < 0:
             raise Exception("Transformation failed: {0}"
-                            .format(ffi.string(lib.tjGetErrorStr())))
+                            .format(_turbojpeg_error(tjhandle)))
+
+    outputs = [_native_buffer(pointer, out_sizes[idx], buffers is None)
+               for idx, pointer in enumerate(pointers)]
+    instrumentation.record('transform', 'copy_out', start)
+    instrumentation.count('transform', len(in_data),
+                          sum(len(o) for o in outputs))
+    return outputs
+
+
+def _optimize_coding(data):
+    """ Losslessly re-encode JPEG data with optimized Huffman tables, for
+    versions of turbojpeg that cannot do this while transforming.
+    """
+    start = instrumentation.start()
+    in_data = _from_buffer(data)
+    pdata = ffi.gc(ffi.new("unsigned char **"), _epeg_free_buffer)
+    psize = ffi.new("unsigned long*")
+    start = instrumentation.record('optimize_coding', 'copy_in', start)
+    if lib.optimize_coding(in_data, len(in_data), pdata, psize) != 0:
+        raise Exception("Optimization failed")
+    start = instrumentation.record('optimize_coding', 'native', start)
+    output = _native_buffer(pdata, psize[0])
+    instrumentation.record('optimize_coding', 'copy_out', start)
+    instrumentation.count('optimize_coding', len(in_data), len(output))
+    return output
+
 
-        _weak_keydict[out_bufs[0]] = out_bufs
-        return bytearray(ffi.buffer(out_bufs[0], out_sizes[0])[:])
+def jpegtran_op(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        # Call the wrapped function with the transformoption struct
+        transformoption = func(self, *args, **kwargs)
+
+        # Execute transformation
+        return _transform(self._data, transformoption)[0]
     return wrapper
 
 
+# Orientation transformations as matrices (a, b, c, d) that map coordinates
+# relative to the image center, with the y axis pointing downwards, to
+# (a*x + b*y, c*x + d*y)
+_OP_MATRICES = {
+    lib.TJXOP_NONE: (1, 0, 0, 1),
+    lib.TJXOP_HFLIP: (-1, 0, 0, 1),
+    lib.TJXOP_VFLIP: (1, 0, 0, -1),
+    lib.TJXOP_TRANSPOSE: (0, 1, 1, 0),
+    lib.TJXOP_TRANSVERSE: (0, -1, -1, 0),
+    lib.TJXOP_ROT90: (0, -1, 1, 0),
+    lib.TJXOP_ROT180: (-1, 0, 0, -1),
+    lib.TJXOP_ROT270: (0, 1, -1, 0),
+}
+_MATRIX_OPS = dict((matrix, op) for op, matrix in _OP_MATRICES.items())
+
+
+def compose_ops(*ops):
+    """ Collapse a sequence of orientation transformations into a single
+    equivalent one, which is possible since they form a closed group.
+
+    :param ops:     TJXOP_* values in order of application
+    :return:        Equivalent TJXOP_* value
+    """
+    a, b, c, d = _OP_MATRICES[lib.TJXOP_NONE]
+    for op in ops:
+        e, f, g, h = _OP_MATRICES[op]
+        a, b, c, d = e*a + f*c, e*b + f*d, g*a + h*c, g*b + h*d
+    return _MATRIX_OPS[(a, b, c, d)]
+
+
+def is_perfect(op, width, height, mcu_size):
+    """ Check whether an orientation transformation can be applied to an
+    image without leaving partial MCUs at its edges untransformed.
+
+    :param op:          TJXOP_* value
+    :param mcu_size:    width and height of a MCU of the image
+    """
+    mcu_width, mcu_height = mcu_size
+    if op in (lib.TJXOP_HFLIP, lib.TJXOP_ROT270, lib.TJXOP_TRANSVERSE,
+              lib.TJXOP_ROT180) and width % mcu_width:
+        return False
+    if op in (lib.TJXOP_VFLIP, lib.TJXOP_ROT90, lib.TJXOP_TRANSVERSE,
+              lib.TJXOP_ROT180) and height % mcu_height:
+        return False
+    return True
+
+
+def _transform_region(op, region, width, height):
+    """ Get the position of a region after applying an orientation
+    transformation to an image of the given dimensions.
+    """
+    a, b, c, d = _OP_MATRICES[op]
+    x, y, w, h = region
+    # Work with doubled coordinates relative to the image center to stay
+    # in integer arithmetic
+    xs, ys = [], []
+    for px, py in ((x, y), (x+w, y+h)):
+        cx, cy = 2*px - width, 2*py - height
+        xs.append(a*cx + b*cy)
+        ys.append(c*cx + d*cy)
+    new_width, new_height = (width, height) if a else (height, width)
+    return ((min(xs) + new_width)//2, (min(ys) + new_height)//2,
+            abs(xs[0] - xs[1])//2, abs(ys[0] - ys[1])//2)
+
+
+class TransformChain(object):
+    """ Sequence of lossless transformations, normalized to a single
+    orientation transformation followed by an optional crop, which is what
+    a single call to tjTransform can do.
+
+    If the MCU size is given, an orientation transformation following a
+    crop is only folded into the chain if it transforms the cropped region
+    perfectly (see :py:func:`is_perfect`) and the region still starts on
+    the MCU grid afterwards, so that the result is the same as cropping
+    first. Otherwise the chain so far is moved to `passes` and the chain
+    continues on its result.
+
+    :ivar op:       Equivalent TJXOP_* value
+    :ivar region:   Crop region (x, y, width, height) in the coordinates of
+                    the transformed image or None
+    :ivar gray:     Whether the result is converted to grayscale
+    :ivar rotated:  Whether the chain includes a rotation
+    :ivar width:    Width of the result
+    :ivar height:   Height of the result
+    :ivar progressive:      Whether the result is progressive
+    :ivar optimize:         Whether the result uses optimized Huffman tables
+    :ivar strip_metadata:   Whether APPn and COM markers are dropped
+    :ivar passes:   Chains to apply before this one, in order, each to the
+                    result of the previous one
+    """
+    def __init__(self, width, height, progressive=False, optimize=False,
+                 strip_metadata=False, mcu_size=None):
+        self.op = lib.TJXOP_NONE
+        self.region = None
+        self.gray = False
+        self.rotated = False
+        self.progressive = progressive
+        self.optimize = optimize
+        self.strip_metadata = strip_metadata
+        self.width = width
+        self.height = height
+        self.passes = []
+        # Dimensions of the transformed image before cropping
+        self._full_size = (width, height)
+        # MCU size of the transformed image, None if unknown, in which case
+        # crops are always folded
+        self._mcu_size = mcu_size
+
+    @property
+    def is_noop(self):
+        return (self.op == lib.TJXOP_NONE and self.region is None and
+                not (self.gray or self.progressive or self.optimize or
+                     self.strip_metadata))
+
+    def _can_fold(self, op):
+        _, _, width, height = self.region
+        if not is_perfect(op, width, height, self._mcu_size):
+            return False
+        x, y, _, _ = _transform_region(op, self.region, *self._full_size)
+        mcu_width, mcu_height = self._mcu_size
+        if _OP_MATRICES[op][0] == 0:
+            mcu_width, mcu_height = mcu_height, mcu_width
+        return x % mcu_width == 0 and y % mcu_height == 0
+
+    def _split(self):
+        """ Move the transformations so far to a pass of their own and
+        continue on its result.
+        """
+        done = copy.copy(self)
+        done.passes = []
+        done.progressive = done.optimize = False
+        self.passes.append(done)
+        self.op = lib.TJXOP_NONE
+        self.region = None
+        self._full_size = (self.width, self.height)
+        if self.gray:
+            # Grayscale images have a single component with 8x8 blocks
+            self._mcu_size = (8, 8)
+            self.gray = False
+
+    def _apply(self, op):
+        if (self.region is not None and self._mcu_size is not None and
+                not self._can_fold(op)):
+            self._split()
+        full_width, full_height = self._full_size
+        if self.region is not None:
+            self.region = _transform_region(op, self.region, full_width,
+                                            full_height)
+        if _OP_MATRICES[op][0] == 0:
+            # Transformation swaps the axes
+            self._full_size = (full_height, full_width)
+            self.width, self.height = self.height, self.width
+            if self._mcu_size is not None:
+                self._mcu_size = self._mcu_size[::-1]
+        self.op = compose_ops(self.op, op)
+        return self
+
+    def rotate(self, angle):
+        if angle == 90:
+            op = lib.TJXOP_ROT90
+        elif angle == 180:
+            op = lib.TJXOP_ROT180
+        elif angle in (-90, 270):
+            op = lib.TJXOP_ROT270
+        else:
+            raise ValueError("Invalid angle, must be -90, 90, 180 or 270")
+        self.rotated = True
+        return self._apply(op)
+
+    def flip(self, direction):
+        if direction == 'vertical':
+            return self._apply(lib.TJXOP_VFLIP)
+        elif direction == 'horizontal':
+            return self._apply(lib.TJXOP_HFLIP)
+        else:
+            raise ValueError("Invalid direction, must be 'vertical' or "
+                             "'horizontal'")
+
+    def transpose(self):
+        return self._apply(lib.TJXOP_TRANSPOSE)
+
+    def transverse(self):
+        return self._apply(lib.TJXOP_TRANSVERSE)
+
+    def crop(self, x, y, width, height):
+        valid_crop = (0 <= x < self.width and 0 <= y < self.height and
+                      x+width <= self.width and y+height <= self.height)
+        if not valid_crop:
+            raise ValueError("Crop parameters point outside of the image")
+        if self.region is not None:
+            x += self.region[0]
+            y += self.region[1]
+        self.region = (x, y, width, height)
+        self.width, self.height = width, height
+        return self
+
+    def grayscale(self):
+        self.gray = True
+        return self
+
+
 def _epeg_free_buffer(buffer):
     lib.free(buffer[0])
 
 
+#: Colorspaces of decoded pixel data, mapping the name to the epeg
+#: colorspace and the number of components
+PIXEL_FORMATS = {
+    'GRAY': (lib.EPEG_GRAY8, 1),
+    'RGB': (lib.EPEG_RGB8, 3),
+    'YUV': (lib.EPEG_YUV8, 3),
+    'CMYK': (lib.EPEG_CMYK, 4),
+}
+
+# Scratch buffers for pixel data are completely overwritten by the native
+# routines, so they do not need to be zeroed
+_alloc_uninitialized = ffi.new_allocator(should_clear_after_alloc=False)
+
+#: Profiles of the 'turbo' scaling engine, mapping the name to the
+#: decompression flags, the compression flags and the minimum ratio between
+#: the size the image is decoded at (using DCT scaling) and the target size
+#: that is then reached with the area filter
+SCALE_PROFILES = {
+    'fast': (lib.TJFLAG_FASTDCT | lib.TJFLAG_FASTUPSAMPLE,
+             lib.TJFLAG_FASTDCT, 1),
+    'balanced': (lib.TJFLAG_FASTDCT, 0, 1),
+    'quality': (lib.TJFLAG_ACCURATEDCT, lib.TJFLAG_ACCURATEDCT, 2),
+}
+
+
+def _scaling_factors():
+    num = ffi.new("int*")
+    factors = lib.tjGetScalingFactors(num)
+    return [(factors[idx].num, factors[idx].denom) for idx in range(num[0])]
+
+
+def _pick_scaling_factor(factors, width, height, min_width, min_height):
+    """ Get the smallest DCT scaling factor (not larger than 1) at which the
+    image is decoded to at least the minimum size.
+    """
+    for num, denom in sorted(factors, key=lambda f: f[0]/float(f[1])):
+        if num > denom:
+            continue
+        if (width*num + denom - 1)//denom < min_width:
+            continue
+        if (height*num + denom - 1)//denom < min_height:
+            continue
+        return num, denom
+    return 1, 1
+
+
+def _compress(pixels, width, height, pixel_format, subsampling, quality,
+              flags):
+    """ Encode pixels to JPEG.
+
+    :return:    Garbage-collected pointer to the output buffer and its size
+    """
+    pdata = ffi.gc(ffi.new("unsigned char **"), _turbojpeg_cleanup)
+    psize = ffi.new("unsigned long*")
+    with handle_pool.handle() as tjhandle:
+        if lib.tjCompress2(tjhandle, pixels, width, 0, height, pixel_format,
+                           pdata, psize, subsampling, quality, flags) < 0:
+            raise Exception("Compression failed: {0}"
+                            .format(_turbojpeg_error(tjhandle)))
+    return pdata, psize[0]
+
+
+def search_quality(encode, max_bytes, max_quality=75, min_quality=1):
+    """ Find the highest JPEG quality at which an image is encoded within a
+    byte budget, with a binary search, assuming that the size of the
+    output grows with the quality.
+
+    ::
+
+        data, quality = search_quality(
+            lambda q: pil_encode(pixels, quality=q), 50*1024, 90)
+
+    :param encode:      function encoding the image at the given quality
+                        and returning an object with a length, e.g. bytes
+    :param max_bytes:   maximum size of the encoded image
+    :type max_bytes:    int
+    :param max_quality: highest quality to consider
+    :type max_quality:  int
+    :param min_quality: lowest quality to consider
+    :type min_quality:  int
+    :return:            the output of `encode` at the quality found and the
+                        quality
+    :rtype:             tuple
+    :raises ValueError: if the image does not fit even at `min_quality`
+
+    """
+    data = encode(max_quality)
+    if len(data) <= max_bytes:
+        return data, max_quality
+    best = None
+    low, high = min_quality, max_quality - 1
+    while low <= high:
+        quality = (low + high)//2
+        data = encode(quality)
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        raise ValueError("Image does not fit into {0} bytes at quality {1}"
+                         .format(max_bytes, min_quality))
+    return best
+
+
+def _encode_within(encode, quality, max_bytes):
+    if max_bytes is None:
+        return encode(quality), quality
+    return search_quality(encode, max_bytes, quality)
+
+
 class Transformation(object):
     def __init__(self, blob):
         self._data = blob
@@ -170,32 +1487,253 @@ class Transformation(object):
     def get_dimensions(self):
         width = ffi.new("int*")
         height = ffi.new("int*")
-        in_data_len = len(self._data)
-        in_data_p = ffi.new("unsigned char[]", in_data_len)
-        inbuf = ffi.buffer(in_data_p, in_data_len)
-        inbuf[:] = self._data
-        img = ffi.gc(lib.epeg_memory_open(in_data_p, in_data_len),
+        in_data = _from_buffer(self._data)
+        img = ffi.gc(lib.epeg_memory_open(in_data, len(in_data)),
                      lib.epeg_close)
         lib.epeg_size_get(img, width, height)
         return (width[0], height[0])
 
-    def scale(self, width, height, quality=75):
-        in_data_len = len(self._data)
-        in_data_p = ffi.new("unsigned char[]", in_data_len)
-        inbuf = ffi.buffer(in_data_p, in_data_len)
-        inbuf[:] = self._data
-        img = ffi.gc(lib.epeg_memory_open(in_data_p, in_data_len),
+    def scale(self, width, height, quality=75, region=None,
+              max_memory=None):
+        start = instrumentation.start()
+        in_data = _from_buffer(self._data)
+        start = instrumentation.record('epeg_scale', 'copy_in', start)
+        img = ffi.gc(lib.epeg_memory_open(in_data, len(in_data)),
                      lib.epeg_close)
         lib.epeg_decode_size_set(img, width, height)
+        if region is not None:
+            lib.epeg_decode_crop_set(img, *region)
+        if max_memory is not None:
+            lib.epeg_decode_memory_set(img, max_memory)
         lib.epeg_quality_set(img, quality)
 
         pdata = ffi.gc(ffi.new("unsigned char **"), _epeg_free_buffer)
         psize = ffi.new("int*")
         lib.epeg_memory_output_set(img, pdata, psize)
-        lib.epeg_encode(img)
+        rv = lib.epeg_encode(img)
+        if rv != 0:
+            raise Exception("Scaling failed: error code {0}".format(rv))
+        start = instrumentation.record('epeg_scale', 'native', start)
+
+        output = _native_buffer(pdata, psize[0])
+        instrumentation.record('epeg_scale', 'copy_out', start)
+        instrumentation.count('epeg_scale', len(in_data), len(output))
+        return output
+
+    def get_pixels(self, width, height, colorspace, region=None):
+        start = instrumentation.start()
+        in_data = _from_buffer(self._data)
+        start = instrumentation.record('decode', 'copy_in', start)
+        img = ffi.gc(lib.epeg_memory_open(in_data, len(in_data)),
+                     lib.epeg_close)
+        if img == ffi.NULL:
+            raise ValueError("Could not read JPEG header")
+        lib.epeg_decode_size_set(img, width, height)
+        if region is not None:
+            lib.epeg_decode_crop_set(img, *region)
+        lib.epeg_decode_colorspace_set(img, PIXEL_FORMATS[colorspace][0])
+        pixels = lib.epeg_pixels_get(img, 0, 0, width, height)
+        if pixels == ffi.NULL:
+            raise Exception("Decoding failed")
+        start = instrumentation.record('decode', 'native', start)
+        pointer = ffi.gc(ffi.new("unsigned char **"), _epeg_free_buffer)
+        pointer[0] = ffi.cast("unsigned char *", pixels)
+        output = _native_buffer(
+            pointer, width*height*PIXEL_FORMATS[colorspace][1])
+        instrumentation.record('decode', 'copy_out', start)
+        instrumentation.count('decode', len(in_data), len(output))
+        return output
+
+    def get_coefficients(self, component=0, dc_only=False):
+        """ Read the quantized DCT coefficients of a component.
+
+        :return:    buffer with the coefficients of every block as 16-bit
+                    integers (see ``read_coefficients`` in
+                    src/coefficients.c), the number of blocks per column
+                    and row, and the quantization table in natural order
+        :rtype:     (memoryview, int, int, list) tuple
+        """
+        start = instrumentation.start()
+        in_data = _from_buffer(self._data)
+        pdata = ffi.gc(ffi.new("short **"), _epeg_free_buffer)
+        width = ffi.new("int*")
+        height = ffi.new("int*")
+        quantval = ffi.new("unsigned short[64]")
+        start = instrumentation.record('coefficients', 'copy_in', start)
+        rv = lib.read_coefficients(in_data, len(in_data), component,
+                                   dc_only, pdata, width, height, quantval)
+        if rv == 2:
+            raise ValueError("Image has no component {0}".format(component))
+        elif rv != 0:
+            raise Exception("Reading coefficients failed")
+        start = instrumentation.record('coefficients', 'native', start)
+        output = _native_buffer(
+            pdata, width[0]*height[0]*(1 if dc_only else 64)*2)
+        instrumentation.record('coefficients', 'copy_out', start)
+        instrumentation.count('coefficients', len(in_data), len(output))
+        return output, height[0], width[0], list(quantval)
+
+    def get_dc_pixels(self, component=0):
+        """ Get the mean sample value of every block of a component, i.e.
+        the component at 1/8 of its size, from the DC coefficients.
+
+        :return:    8-bit samples, width and height
+        :rtype:     (cdata, int, int) tuple
+        """
+        coefficients, height, width, quantval = self.get_coefficients(
+            component, dc_only=True)
+        pixels = _alloc_uninitialized("unsigned char[]", width*height)
+        lib.dc_pixels(ffi.from_buffer("short[]", coefficients),
+                      width*height, quantval[0], pixels)
+        return pixels, width, height
 
-        _weak_keydict[pdata[0]] = pdata
-        return bytearray(ffi.buffer(pdata[0], psize[0])[:])
+    def validate(self):
+        """ Decode the entropy-coded data to check the image for
+        corruption, without producing any pixels.
+
+        :return:    None if the image is valid, otherwise libjpeg's error or
+                    (first) corrupt data warning
+        :rtype:     str
+        """
+        start = instrumentation.start()
+        in_data = _from_buffer(self._data)
+        message = ffi.new("char[]", lib.VALIDATE_MESSAGE_LENGTH)
+        start = instrumentation.record('validate', 'copy_in', start)
+        rv = lib.validate_jpeg(in_data, len(in_data), message)
+        instrumentation.record('validate', 'native', start)
+        instrumentation.count('validate', len(in_data), 0)
+        if rv == 0:
+            return None
+        return ffi.string(message).decode('ascii', 'replace')
+
+    def turbo_scale(self, width, height, quality=75, region=None,
+                    profile='balanced', max_memory=None):
+        return self.turbo_scale_many([(width, height)], [quality], region,
+                                     profile, max_memory)[0][0]
+
+    def turbo_scale_many(self, sizes, qualities, region=None,
+                         profile='balanced', max_memory=None, workers=1,
+                         max_bytes=None):
+        """ Scale the image to several sizes, decoding it only once, at the
+        DCT scale that suits the largest size.
+
+        :param sizes:       (width, height) tuples
+        :param qualities:   JPEG quality for every size, the maximum quality
+                            if a size has a byte budget
+        :param workers:     number of threads encoding the results
+        :param max_bytes:   byte budget for every size (or None) or None,
+                            see :py:func:`search_quality`
+        :return:            list with a (buffer, quality) tuple for every
+                            size
+        """
+        if max_bytes is None:
+            max_bytes = [None]*len(sizes)
+        try:
+            decompress_flags, compress_flags, oversample = \
+                SCALE_PROFILES[profile]
+        except KeyError:
+            raise ValueError("Invalid profile, must be one of {0}"
+                             .format(", ".join(sorted(SCALE_PROFILES))))
+        start = instrumentation.start()
+        in_data = _from_buffer(self._data)
+        src_width = ffi.new("int*")
+        src_height = ffi.new("int*")
+        subsampling = ffi.new("int*")
+        colorspace = ffi.new("int*")
+        with handle_pool.handle() as tjhandle:
+            start = instrumentation.record('turbo_scale', 'copy_in', start)
+            if lib.tjDecompressHeader3(tjhandle, in_data, len(in_data),
+                                       src_width, src_height, subsampling,
+                                       colorspace) < 0:
+                raise ValueError("Could not read JPEG header: {0}"
+                                 .format(_turbojpeg_error(tjhandle)))
+            if region is None:
+                region = (0, 0, src_width[0], src_height[0])
+            x, y, region_width, region_height = region
+
+            # Decode just large enough for the area filter
+            num, denom = _pick_scaling_factor(
+                _scaling_factors(), region_width, region_height,
+                max(w for w, _ in sizes)*oversample,
+                max(h for _, h in sizes)*oversample)
+            scaled_width = (src_width[0]*num + denom - 1)//denom
+            scaled_height = (src_height[0]*num + denom - 1)//denom
+            if colorspace[0] == lib.TJCS_GRAY:
+                pixel_format, components = lib.TJPF_GRAY, 1
+                subsampling[0] = lib.TJSAMP_GRAY
+            elif colorspace[0] in (lib.TJCS_CMYK, lib.TJCS_YCCK):
+                pixel_format, components = lib.TJPF_CMYK, 4
+            else:
+                pixel_format, components = lib.TJPF_RGB, 3
+            if subsampling[0] < 0:
+                subsampling[0] = lib.TJSAMP_420
+            if (max_memory is not None and
+                    scaled_width*scaled_height*components > max_memory):
+                # Fall back to epeg, which can decode a row at a time, but
+                # has to do so for every size and quality
+                return [_encode_within(
+                    lambda q: self.scale(width, height, q, region,
+                                         max_memory), quality, budget)
+                    for (width, height), quality, budget in zip(
+                        sizes, qualities, max_bytes)]
+
+            pixels = _alloc_uninitialized(
+                "unsigned char[]", scaled_width*scaled_height*components)
+            if lib.tjDecompress2(tjhandle, in_data, len(in_data), pixels,
+                                 scaled_width, 0, scaled_height,
+                                 pixel_format, decompress_flags) < 0:
+                raise Exception("Decompression failed: {0}"
+                                .format(_turbojpeg_error(tjhandle)))
+
+        scale = num/float(denom)
+        # Pixel buffers to scale from, with their dimensions and the area
+        # to scale
+        sources = [(pixels, scaled_width, scaled_height,
+                    (x*scale, y*scale, region_width*scale,
+                     region_height*scale))]
+        resized = [None]*len(sizes)
+        for idx in sorted(range(len(sizes)),
+                          key=lambda idx: -sizes[idx][0]*sizes[idx][1]):
+            width, height = sizes[idx]
+            # Filtering a result that is at least twice as large is cheaper
+            # than filtering the decoded image, and just as good
+            source = sources[0]
+            for candidate in sources[1:]:
+                if (candidate[1] >= 2*width and candidate[2] >= 2*height and
+                        candidate[1] < source[1]):
+                    source = candidate
+            src_pixels, src_width, src_height, area = source
+            resized[idx] = _alloc_uninitialized("unsigned char[]",
+                                                width*height*components)
+            if lib.resize_area(src_pixels, src_width, src_height,
+                               src_width*components, components,
+                               area[0], area[1], area[2], area[3],
+                               resized[idx], width, height) != 0:
+                raise MemoryError()
+            sources.append((resized[idx], width, height,
+                            (0, 0, width, height)))
+        del pixels, sources
+
+        def compress(idx):
+            # Only the encoder runs once per quality tried
+            width, height = sizes[idx]
+            return _encode_within(
+                lambda quality: _native_buffer(*_compress(
+                    resized[idx], width, height, pixel_format,
+                    subsampling[0], quality, compress_flags)),
+                qualities[idx], max_bytes[idx])
+
+        if workers > 1 and len(sizes) > 1:
+            # On Python 2 this requires the `futures` backport
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as executor:
+                outputs = list(executor.map(compress, range(len(sizes))))
+        else:
+            outputs = [compress(idx) for idx in range(len(sizes))]
+        instrumentation.record('turbo_scale', 'native', start)
+        instrumentation.count('turbo_scale', len(in_data),
+                              sum(len(data) for data, _ in outputs))
+        return outputs
 
     def _get_transformoptions(self, perfect=False, trim=False):
         # Initialize jpeg_transform_info struct
@@ -251,6 +1789,42 @@ class Transformation(object):
         options.op = lib.TJXOP_TRANSVERSE
         return options
 
+    def apply(self, chain, buffer=None):
+        return self.apply_many(
+            [chain], None if buffer is None else [buffer])[0]
+
+    def apply_many(self, chains, buffers=None):
+        options = ffi.new("tjtransform[]", len(chains))
+        for idx, chain in enumerate(chains):
+            self._set_chain_options(options[idx], chain)
+        try:
+            outputs = _transform(self._data, options, len(chains), buffers)
+        except Exception:
+            if buffers is None:
+                raise
+            # The worst case size does not account for large metadata
+            outputs = _transform(self._data, options, len(chains))
+        if not lib.TJXOPT_OPTIMIZE:
+            # Progressive output always has optimized Huffman tables
+            outputs = [_optimize_coding(data)
+                       if chain.optimize and not chain.progressive else data
+                       for chain, data in zip(chains, outputs)]
+        return outputs
+
+    def _set_chain_options(self, options, chain):
+        options.op = chain.op
+        if chain.gray:
+            options.options |= lib.TJXOPT_GRAY
+        if chain.region is not None:
+            options.r.x, options.r.y, options.r.w, options.r.h = chain.region
+            options.options |= lib.TJXOPT_CROP
+        if chain.progressive:
+            options.options |= lib.TJXOPT_PROGRESSIVE
+        if chain.optimize:
+            options.options |= lib.TJXOPT_OPTIMIZE
+        if chain.strip_metadata:
+            options.options |= lib.TJXOPT_COPYNONE
+
     @jpegtran_op
     def crop(self, x, y, width, height):
         options = self._get_transformoptions()
@@ -0,0 +1,160 @@
+from __future__ import division
+
+import math
+import os
+import time
+
+import jpegtran.lib as lib
+from jpegtran.transform import JPEGImage
+
+# Largest MCU size of images produced by downscaling
+_SCALED_MCU_SIZE = 16
+
+
+def _is_metadata(data, marker, offset):
+    if marker == lib.MARKER_APP14:
+        # Adobe marker, which tells decoders the color transform
+        return False
+    if (marker == lib.MARKER_APP2 and
+            data[offset+4:offset+16] == b'ICC_PROFILE\0'):
+        return False
+    return (lib.MARKER_APP0 <= marker <= lib.MARKER_APP15 or
+            marker == lib.MARKER_COM)
+
+
+def _strip_metadata(image):
+    """ Drop the APPn and COM segments, which are of no use for tiles and
+    would otherwise cause the EXIF thumbnail to be regenerated for every
+    single tile. The Adobe marker and ICC profiles are kept, since they
+    affect the colors.
+    """
+    view = memoryview(image.data)
+    segments = [(offset, length) for marker, offset, length
+                in image.header.segments
+                if _is_metadata(view, marker, offset)]
+    if not segments:
+        return image
+    data = bytearray()
+    end = 0
+    for offset, length in segments:
+        data += view[end:offset]
+        end = offset+length
+    data += view[end:]
+    return JPEGImage._from_result(data, (image.width, image.height))
+
+
+class DeepZoom(object):
+    """ Generator for Deep Zoom (DZI) tile pyramids.
+
+    The tiles of the full resolution level are cut losslessly from the
+    source image, several tiles at a time with a single native
+    transformation. Every lower level is obtained by downscaling the level
+    above it by half and is cut losslessly as well. Since lossless crops
+    have to start on MCU boundaries, the tile size is rounded up to a
+    multiple of the MCU size and tiles do not overlap.
+
+    :param image:       source image
+    :type image:        jpegtran.JPEGImage
+    :param tile_size:   edge length of the tiles in pixels
+    :type tile_size:    int
+    :param quality:     JPEG quality of the downscaled levels
+    :type quality:      int
+    :param batch_size:  maximum number of tiles cut in one transformation
+    :type batch_size:   int
+
+    """
+    def __init__(self, image, tile_size=256, quality=75, batch_size=64):
+        self.image = _strip_metadata(image)
+        mcu_size = max(self.image.header.mcu_size + (_SCALED_MCU_SIZE,))
+        self.tile_size = int(math.ceil(tile_size/mcu_size))*mcu_size
+        self.quality = quality
+        self.batch_size = batch_size
+        self.max_level = int(math.ceil(
+            math.log(max(self.image.width, self.image.height), 2)))
+
+    def level_size(self, level):
+        """ Get the dimensions of a level.
+
+        :param level:   pyramid level, 0 being a single pixel
+        :type level:    int
+        :return:        width and height of the level
+        :rtype:         (int, int) tuple
+
+        """
+        scale = 2**(self.max_level - level)
+        return (int(math.ceil(self.image.width/scale)),
+                int(math.ceil(self.image.height/scale)))
+
+    def tiles(self):
+        """ Generate the tiles of all levels, starting with the full
+        resolution level.
+
+        :return:    iterator over (level, column, row, tile) tuples
+        """
+        level_image = self.image
+        for level in range(self.max_level, -1, -1):
+            width, height = self.level_size(level)
+            if (width, height) != (level_image.width, level_image.height):
+                level_image = level_image.downscale(width, height,
+                                                    self.quality)
+            if width <= self.tile_size and height <= self.tile_size:
+                yield level, 0, 0, level_image
+                continue
+            for tile in self._cut(level, level_image):
+                yield tile
+
+    def _cut(self, level, image):
+        mcu_width, mcu_height = image.header.mcu_size
+        if self.tile_size % mcu_width or self.tile_size % mcu_height:
+            raise ValueError("Tile size must be a multiple of the MCU size "
+                             "({0}x{1}) on level {2}"
+                             .format(mcu_width, mcu_height, level))
+        positions = []
+        for row in range(int(math.ceil(image.height/self.tile_size))):
+            for col in range(int(math.ceil(image.width/self.tile_size))):
+                positions.append((col, row))
+        for start in range(0, len(positions), self.batch_size):
+            batch = positions[start:start+self.batch_size]
+            regions = []
+            for col, row in batch:
+                x, y = col*self.tile_size, row*self.tile_size
+                regions.append((x, y, min(self.tile_size, image.width-x),
+                                min(self.tile_size, image.height-y)))
+            for (col, row), tile in zip(batch, image.crop_many(regions)):
+                yield level, col, row, tile
+
+    def save(self, basename):
+        """ Write the pyramid in the Deep Zoom directory layout, i.e. the
+        descriptor to `basename.dzi` and the tiles to
+        `basename_files/<level>/<column>_<row>.jpg`.
+
+        :param basename:    path of the descriptor without the extension
+        :type basename:     unicode
+        :return:            number of tiles and levels, duration in seconds
+                            and throughput in tiles per second
+        :rtype:             dict
+
+        """
+        start = time.time()
+        num_tiles = 0
+        tile_dir = u"{0}_files".format(basename)
+        for level, col, row, tile in self.tiles():
+            level_dir = os.path.join(tile_dir, str(level))
+            if not os.path.isdir(level_dir):
+                os.makedirs(level_dir)
+            tile.save(os.path.join(level_dir,
+                                   "{0}_{1}.jpg".format(col, row)))
+            num_tiles += 1
+        with open(u"{0}.dzi".format(basename), 'w') as fp:
+            fp.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"\n'
+                '       Format="jpg" Overlap="0" TileSize="{0}">\n'
+                '  <Size Width="{1}" Height="{2}"/>\n'
+                '</Image>\n'.format(self.tile_size, self.image.width,
+                                    self.image.height))
+        duration = time.time() - start
+        return {'tiles': num_tiles,
+                'levels': self.max_level + 1,
+                'seconds': duration,
+                'tiles_per_second': num_tiles/duration if duration else None}
@@ -1,38 +1,287 @@
 from __future__ import division
 
+import io
+import mmap
+import os
 import re
 
+import jpegtran.hashing as hashing
 import jpegtran.lib as lib
 
 
+def _run_async(func, *args, **kwargs):
+    # Imported lazily, since the module is only available on Python 3
+    from jpegtran.aio import run
+    return run(func, *args, **kwargs)
+
+
+def _as_array(buf, shape, typecode='B'):
+    """ Wrap decoded pixel data (or other native data of the given struct
+    typecode) in a NumPy array if NumPy is available, otherwise in a
+    memoryview of the given shape (Python 3 only).
+    """
+    try:
+        import numpy
+    except ImportError:
+        if lib.PY2:
+            return buf
+        return buf.cast(typecode, shape)
+    return numpy.frombuffer(buf, dtype=numpy.dtype(typecode)).reshape(shape)
+
+
+def _per_size(value, sizes, name):
+    """ Expand a setting that is given either for all sizes or as a sequence
+    with a value for every size. """
+    if isinstance(value, (list, tuple)):
+        if len(value) != len(sizes):
+            raise ValueError("Number of {0} must match the number of sizes"
+                             .format(name))
+        return list(value)
+    return [value]*len(sizes)
+
+
+def _read_fd(fd, use_mmap):
+    """ Get the contents of a file, either mapped into memory (read-only) or
+    read into a bytearray.
+    """
+    if use_mmap:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    with io.open(fd, 'rb', closefd=False) as fp:
+        fp.seek(0)
+        data = bytearray(os.fstat(fd).st_size)
+        fp.readinto(data)
+    return data
+
+
+def _write_file(fp, data):
+    """ Write data to a file descriptor or file object, straight from the
+    buffer (e.g. the native output buffer of a transformation) if the file
+    has a descriptor.
+    """
+    if isinstance(fp, int):
+        fd = fp
+    else:
+        try:
+            fd = fp.fileno()
+        except (AttributeError, IOError, ValueError):
+            # e.g. BytesIO
+            fp.write(data)
+            return
+        fp.flush()
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+
 class JPEGImage(object):
+    #: How the EXIF thumbnail is maintained on transformations: 'update'
+    #: (transform it along with the image or regenerate it), 'keep' (leave
+    #: it untouched, even if it no longer matches the image) or 'strip'
+    #: (remove it). Can be set on the class or on an instance, in which case
+    #: it is passed on to all images derived from it.
+    thumbnail_policy = 'update'
+
+    #: Engine used for downscaling: 'epeg' (nearest neighbour scaling of the
+    #: image decoded at an integral fraction of its size) or 'turbo' (area
+    #: filtering of the image decoded at a multiple of 1/8 of its size).
+    #: Can be set on the class or on an instance, like `thumbnail_policy`.
+    scale_engine = 'epeg'
+
+    #: Speed/quality trade-off of the 'turbo' scaling engine: 'fast',
+    #: 'balanced' or 'quality', see :py:data:`jpegtran.lib.SCALE_PROFILES`
+    scale_profile = 'balanced'
+
+    #: Maximum number of bytes used for decoding when downscaling, None for
+    #: no limit. Larger images are decoded and scaled a row at a time by the
+    #: 'epeg' engine, which the 'turbo' engine falls back to as well.
+    max_memory = None
+
+    #: :py:class:`jpegtran.lib.BufferArena` that lossless transformations
+    #: take their output buffers from, e.g.
+    #: :py:data:`jpegtran.lib.buffer_arena`, or None to let turbojpeg
+    #: allocate them. Can be set on the class or on an instance, like
+    #: `thumbnail_policy`.
+    buffer_arena = None
+
     def __init__(self, fname=None, blob=None):
-        """ Initialize the image with either a filename or a string or
-        bytearray containing the JPEG image data.
+        """ Initialize the image with either a filename or an object
+        supporting the buffer protocol (e.g. bytes, bytearray, memoryview or
+        mmap) containing the JPEG image data.
+
+        The blob is not copied, the image only takes a private copy of the
+        data once it is modified in place (e.g. by setting the EXIF
+        orientation).
 
         :param fname:   Filename of JPEG file
         :type fname:    str
         :param blob:    JPEG image data
-        :type blob:     str/bytearray
+        :type blob:     str/bytearray/memoryview
 
         """
         if (not fname and not blob) or (fname and blob):
             raise Exception("Must initialize with either fname or blob.")
         if fname is not None:
             with open(fname, 'rb') as fp:
-                self.data = bytearray(fp.read())
+                self.data = bytearray(os.fstat(fp.fileno()).st_size)
+                fp.readinto(self.data)
+            self._owned = True
         elif blob is not None:
-            self.data = bytearray(blob)
+            self.data = blob
+            self._owned = False
+        self._header = None
+        self._exif = None
+        self._size = None
+
+    @classmethod
+    def open(cls, file, mmap=True):
+        """ Open an image file, by default by mapping it into memory.
+
+        The native routines read a mapped file directly, so the data is
+        never copied to the Python heap, unless the image is modified in
+        place (e.g. by setting the EXIF orientation). The file descriptor
+        is not needed once the file is mapped, the mapping is released when
+        the image and all images and views sharing its data are gone. The
+        file must not be truncated in the meantime.
+
+        :param file:    file name, or file descriptor or file object opened
+                        for reading, which is not closed, so it can be
+                        reused; the whole file is read regardless of its
+                        position
+        :type file:     str/int/file
+        :param mmap:    whether to map the file into memory instead of
+                        reading it
+        :type mmap:     bool
+        :return:        the image
+        :rtype:         jpegtran.JPEGImage
+
+        """
+        if isinstance(file, (str, type(u''))):
+            fd = os.open(file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                data = _read_fd(fd, mmap)
+            finally:
+                os.close(fd)
+        else:
+            data = _read_fd(file if isinstance(file, int) else file.fileno(),
+                            mmap)
+        img = cls(blob=data)
+        img._owned = not mmap
+        return img
+
+    @classmethod
+    def _from_result(cls, data, size=None, source=None):
+        """ Wrap the output buffer of a transformation, which is exclusively
+        owned by the new image and thus never needs to be copied.
+
+        :param size:    Dimensions of the result, if already known
+        :type size:     (int, int) tuple
+        :param source:  Image the result was obtained from, whose thumbnail
+                        policy and scaling settings are inherited if they
+                        were set on the instance
+
+        """
+        img = cls.__new__(cls)
+        img.data = data
+        img._owned = True
+        img._header = None
+        img._exif = None
+        img._size = size
+        if source is not None:
+            for name in ('thumbnail_policy', 'scale_engine', 'scale_profile',
+                         'max_memory', 'buffer_arena'):
+                if name in vars(source):
+                    setattr(img, name, getattr(source, name))
+        return img
+
+    def _writable_data(self, resizable=False):
+        """ Get the image data for modification in place, taking a private
+        copy first if the data is shared with the caller or read-only.
+
+        :param resizable:   Whether the length of the data needs to change
+        :type resizable:    bool
+
+        """
+        if isinstance(self.data, bytearray):
+            needs_copy = not self._owned
+        else:
+            needs_copy = (not self._owned or resizable or
+                          memoryview(self.data).readonly)
+        if needs_copy:
+            start = lib.instrumentation.start()
+            self.data = bytearray(self.data)
+            lib.instrumentation.record('private_copy', 'copy_in', start)
+            lib.instrumentation.count('private_copy', len(self.data),
+                                      len(self.data))
+            self._owned = True
+            self._exif = None
+        return self.data
+
+    def _writable_exif(self, resizable=False):
+        """ Get the EXIF index for modifications in place, see
+        :py:meth:`_writable_data`.
+        """
+        self._writable_data(resizable)
+        exif = self.exif
+        if exif is None:
+            raise lib.NoExifDataFound("Could not find EXIF data")
+        return exif
+
+    @property
+    def header(self):
+        """ Header information (dimensions, subsampling, colorspace,
+        progressive flag and marker segment offsets), parsed once and cached.
+
+        :rtype:     jpegtran.lib.JPEGHeader
+
+        """
+        if self._header is None:
+            self._header = lib.JPEGHeader(self.data)
+        return self._header
 
     @property
     def width(self):
         """ Width of the image in pixels. """
-        return lib.Transformation(self.data).get_dimensions()[0]
+        if self._size is None:
+            self._size = (self.header.width, self.header.height)
+        return self._size[0]
 
     @property
     def height(self):
         """ Height of the image in pixels. """
-        return lib.Transformation(self.data).get_dimensions()[1]
+        if self._size is None:
+            self._size = (self.header.width, self.header.height)
+        return self._size[1]
+
+    @property
+    def exif(self):
+        """ Index of the EXIF metadata, parsed once and cached, or None if
+        the image does not have EXIF metadata.
+
+        Tags can be read by name, number or (IFD, number) tuple, e.g.
+        ``image.exif['DateTimeOriginal']`` or ``image.exif[('GPS', 2)]``,
+        use :py:meth:`set_exif` for changing them.
+
+        :rtype:     jpegtran.lib.Exif
+        """
+        if self._exif is None:
+            try:
+                self._exif = lib.Exif(self.data,
+                                      self.header.find(lib.MARKER_APP1))
+            except lib.ExifException:
+                self._exif = False
+        return self._exif or None
+
+    def set_exif(self, tag, value):
+        """ Change the value of an EXIF tag in place.
+
+        The new value must fit into the space of the old one, see
+        :py:meth:`jpegtran.lib.Exif.__setitem__`.
+
+        :param tag:     tag name, number or (IFD, number) tuple
+        :param value:   new value
+
+        """
+        self._writable_exif()[tag] = value
 
     @property
     def exif_thumbnail(self):
@@ -42,8 +291,11 @@ class JPEGImage(object):
         :rtype:   str
 
         """
+        exif = self.exif
+        if exif is None:
+            return None
         try:
-            return JPEGImage(blob=lib.Exif(self.data).thumbnail)
+            return JPEGImage(blob=exif.thumbnail)
         except lib.ExifException:
             return None
 
@@ -57,7 +309,10 @@ class JPEGImage(object):
             data = image
         if not self.exif_thumbnail:
             raise ValueError("No pre-existing thumbnail found, cannot set.")
-        lib.Exif(self.data).thumbnail = data
+        self._writable_exif(resizable=True).thumbnail = data
+        # Segments following the EXIF data have moved
+        self._header = None
+        self._exif = None
 
     @property
     def exif_orientation(self):
@@ -65,8 +320,11 @@ class JPEGImage(object):
 
         Property is read/write
         """
+        exif = self.exif
+        if exif is None:
+            return None
         try:
-            return lib.Exif(self.data).orientation
+            return exif.orientation
         except lib.ExifException:
             return None
 
@@ -74,12 +332,13 @@ class JPEGImage(object):
     def exif_orientation(self, value):
         if not 0 < value < 9:
             raise ValueError("Orientation value must be between 1 and 8")
-        lib.Exif(self.data).orientation = value
+        self._writable_exif().orientation = value
 
-    def exif_autotransform(self):
+    def exif_autotransform(self, **options):
         """ Automatically transform the image according to its EXIF orientation
         tag.
 
+        :param options: output options, see :py:meth:`pipeline`
         :return:  transformed image
         :rtype:   jpegtran.JPEGImage
 
@@ -88,45 +347,42 @@ class JPEGImage(object):
         if orient is None:
             raise Exception("Could not find EXIF orientation")
         elif orient == 1:
-            return self
+            return self.pipeline(**options).execute()
         elif orient == 2:
-            return self.flip('horizontal')
+            return self.flip('horizontal', **options)
         elif orient == 3:
-            return self.rotate(180)
+            return self.rotate(180, **options)
         elif orient == 4:
-            return self.flip('vertical')
+            return self.flip('vertical', **options)
         elif orient == 5:
-            return self.transpose()
+            return self.transpose(**options)
         elif orient == 6:
-            return self.rotate(90)
+            return self.rotate(90, **options)
         elif orient == 7:
-            return self.transverse()
+            return self.transverse(**options)
         elif orient == 8:
-            return self.rotate(270)
+            return self.rotate(270, **options)
 
-    def rotate(self, angle):
+    def rotate(self, angle, **options):
         """ Rotate the image.
 
         :param angle:   rotation angle
         :type angle:    -90, 90, 180 or 270
+        :param options: output options, see :py:meth:`pipeline`
         :return:        rotated image
         :rtype:         jpegtran.JPEGImage
 
         """
         if angle not in (-90, 90, 180, 270):
             raise ValueError("Angle must be -90, 90, 180 or 270.")
-        img = JPEGImage(blob=lib.Transformation(self.data).rotate(angle))
-        # Set EXIF orientation to 'Normal' (== no rotation)
-        if img.exif_orientation not in (None, 1):
-            img.exif_orientation = 1
-        img._update_thumbnail()
-        return img
+        return self.pipeline(**options).rotate(angle).execute()
 
-    def flip(self, direction):
+    def flip(self, direction, **options):
         """ Flip the image in horizontal or vertical direction.
 
         :param direction: Flipping direction
         :type direction:  'vertical' or 'horizontal'
+        :param options: output options, see :py:meth:`pipeline`
         :return:        flipped image
         :rtype:         jpegtran.JPEGImage
 
@@ -134,34 +390,30 @@ class JPEGImage(object):
         if direction not in ('horizontal', 'vertical'):
             raise ValueError("Direction must be either 'vertical' or "
                              "'horizontal'")
-        new = JPEGImage(blob=lib.Transformation(self.data).flip(direction))
-        new._update_thumbnail()
-        return new
+        return self.pipeline(**options).flip(direction).execute()
 
-    def transpose(self):
+    def transpose(self, **options):
         """ Transpose the image (across  upper-right -> lower-left axis)
 
+        :param options: output options, see :py:meth:`pipeline`
         :return:        transposed image
         :rtype:         jpegtran.JPEGImage
 
         """
-        new = JPEGImage(blob=lib.Transformation(self.data).transpose())
-        new._update_thumbnail()
-        return new
+        return self.pipeline(**options).transpose().execute()
 
-    def transverse(self):
+    def transverse(self, **options):
         """ Transverse transpose the image (across  upper-left -> lower-right
         axis)
 
+        :param options: output options, see :py:meth:`pipeline`
         :return:        transverse transposed image
         :rtype:         jpegtran.JPEGImage
 
         """
-        new = JPEGImage(blob=lib.Transformation(self.data).transverse())
-        new._update_thumbnail()
-        return new
+        return self.pipeline(**options).transverse().execute()
 
-    def crop(self, x, y, width, height):
+    def crop(self, x, y, width, height, **options):
         """ Crop a rectangular area from the image.
 
         :param x:       horizontal coordinate of upper-left corner
@@ -172,6 +424,7 @@ class JPEGImage(object):
         :type width:    int
         :param height:  height of area
         :type height:   int
+        :param options: output options, see :py:meth:`pipeline`
         :return:        cropped image
         :rtype:         jpegtran.JPEGImage
 
@@ -180,45 +433,388 @@ class JPEGImage(object):
                       x+width <= self.width and y+height <= self.height)
         if not valid_crop:
             raise ValueError("Crop parameters point outside of the image")
-        new = JPEGImage(blob=lib.Transformation(self.data)
-                             .crop(x, y, width, height))
-        new._update_thumbnail()
-        return new
+        return self.pipeline(**options).crop(x, y, width, height).execute()
 
-    def downscale(self, width, height, quality=75):
+    def downscale(self, width, height, quality=75, region=None,
+                  engine=None, profile=None, max_memory=None,
+                  max_bytes=None):
         """ Downscale the image.
 
+        If a region is given, only that part of the image is scaled, which
+        is considerably faster than cropping the image first and does not
+        require the region to be aligned to the MCU size. The 'epeg' engine
+        only decodes the part of the image covered by the region.
+
+        With a byte budget, the image is decoded and scaled once and only
+        encoded again for every quality tried by
+        :py:func:`jpegtran.lib.search_quality`. This always uses the
+        'turbo' engine, since 'epeg' scales as part of encoding. The
+        quality found is available as the `quality` attribute of the
+        result.
+
         :param width:   Scaled image width
         :type width:    int
         :param height:  Scaled image height
         :type height:   int
-        :param quality: JPEG quality of scaled image (default: 75)
+        :param quality: JPEG quality of scaled image (default: 75), the
+                        maximum quality if there is a byte budget
         :type quality:  int
+        :param region:  area to scale as a (x, y, width, height) tuple,
+                        defaults to the whole image
+        :type region:   tuple
+        :param engine:  'epeg' or 'turbo', defaults to `scale_engine`
+        :type engine:   str
+        :param profile: 'fast', 'balanced' or 'quality', only used by the
+                        'turbo' engine, defaults to `scale_profile`
+        :type profile:  str
+        :param max_memory:  maximum number of bytes used for decoding,
+                            defaults to the `max_memory` attribute, fails
+                            for progressive images that do not fit
+        :type max_memory:   int
+        :param max_bytes:   maximum size of the scaled image in bytes,
+                            raises ValueError if it does not fit even at
+                            quality 1
+        :type max_bytes:    int
         :return:        downscaled image
         :rtype:         jpegtran.JPEGImage
 
         """
-        if width == self.width and height == self.height:
+        if max_bytes is not None:
+            return self.downscale_many([(width, height)], quality, region,
+                                       profile, max_memory,
+                                       max_bytes=max_bytes)[0]
+        region, region_width, region_height = self._check_region(region)
+        if region is None and width == self.width and height == self.height:
             return self
-        if width > self.width or height > self.height:
+        if width > region_width or height > region_height:
             raise ValueError("jpegtran can only downscale JPEGs")
-        new = JPEGImage(blob=lib.Transformation(self.data)
-                        .scale(width, height, quality))
+        if engine is None:
+            engine = self.scale_engine
+        if max_memory is None:
+            max_memory = self.max_memory
+        if engine == 'epeg':
+            data = lib.Transformation(self.data).scale(
+                width, height, quality, region, max_memory)
+        elif engine == 'turbo':
+            data = lib.Transformation(self.data).turbo_scale(
+                width, height, quality, region,
+                profile or self.scale_profile, max_memory)
+        else:
+            raise ValueError("Invalid engine, must be 'epeg' or 'turbo'")
+        new = JPEGImage._from_result(data, (width, height), self)
+        start = lib.instrumentation.start()
         new._update_thumbnail()
+        lib.instrumentation.record(engine + '_scale', 'thumbnail', start)
         return new
 
+    def downscale_many(self, sizes, quality=75, region=None, profile=None,
+                       max_memory=None, workers=1, max_bytes=None):
+        """ Downscale the image to several sizes at once, e.g. a set of
+        renditions for responsive images.
+
+        The image is decoded only once, at the smallest DCT scale that
+        suits the largest size. Every rendition is then area filtered from
+        the decoded image or, if there is one at least twice its size, from
+        a larger rendition, like with the 'turbo' engine of
+        :py:meth:`downscale` (regardless of `scale_engine`).
+
+        ::
+
+            renditions = img.downscale_many(
+                [(2048, 1536), (1024, 768), (320, 240)], quality=[85, 80, 70])
+
+        :param sizes:   (width, height) tuples
+        :type sizes:    iterable
+        :param quality: JPEG quality of all renditions, or a sequence with
+                        the quality of every size, the maximum quality for
+                        sizes with a byte budget
+        :type quality:  int or sequence
+        :param region:  area to scale, see :py:meth:`downscale`
+        :type region:   tuple
+        :param profile: 'fast', 'balanced' or 'quality', defaults to
+                        `scale_profile`
+        :type profile:  str
+        :param max_memory:  maximum number of bytes used for decoding, see
+                            :py:meth:`downscale`, larger images are decoded
+                            once per size by the 'epeg' engine
+        :type max_memory:   int
+        :param workers: number of threads encoding the renditions
+        :type workers:  int
+        :param max_bytes:   byte budget of all renditions, or a sequence
+                            with the budget (or None) of every size, see
+                            :py:meth:`downscale`
+        :type max_bytes:    int or sequence
+        :return:        downscaled images, in the order of the sizes
+        :rtype:         list of jpegtran.JPEGImage
+
+        """
+        sizes = [tuple(size) for size in sizes]
+        qualities = _per_size(quality, sizes, "qualities")
+        budgets = _per_size(max_bytes, sizes, "byte budgets")
+        region, region_width, region_height = self._check_region(region)
+        if any(width > region_width or height > region_height
+               for width, height in sizes):
+            raise ValueError("jpegtran can only downscale JPEGs")
+        if max_memory is None:
+            max_memory = self.max_memory
+        pending = [idx for idx, size in enumerate(sizes)
+                   if region is not None or budgets[idx] is not None or
+                   size != (self.width, self.height)]
+        results = [self]*len(sizes)
+        if not pending:
+            return results
+        outputs = lib.Transformation(self.data).turbo_scale_many(
+            [sizes[idx] for idx in pending],
+            [qualities[idx] for idx in pending], region,
+            profile or self.scale_profile, max_memory, workers,
+            [budgets[idx] for idx in pending])
+        for idx, (data, quality) in zip(pending, outputs):
+            new = JPEGImage._from_result(data, sizes[idx], self)
+            start = lib.instrumentation.start()
+            new._update_thumbnail()
+            lib.instrumentation.record('turbo_scale', 'thumbnail', start)
+            if budgets[idx] is not None:
+                new.quality = quality
+            results[idx] = new
+        return results
+
+    def to_array(self, size=None, colorspace='RGB', region=None):
+        """ Decode the image to raw pixels.
+
+        The image is decoded at the smallest DCT scale that covers the
+        requested size and then scaled with nearest neighbour sampling,
+        like with the 'epeg' engine of :py:meth:`downscale`, but without
+        encoding the result.
+
+        :param size:        (width, height) of the result, defaults to the
+                            size of the image or region, can only be smaller
+        :type size:         tuple
+        :param colorspace:  'RGB', 'GRAY', 'YUV' or 'CMYK'
+        :type colorspace:   str
+        :param region:      area to decode as a (x, y, width, height) tuple,
+                            defaults to the whole image
+        :type region:       tuple
+        :return:            pixels of shape (height, width, components), as a
+                            NumPy array if NumPy is installed, otherwise as a
+                            memoryview (flat on Python 2)
+
+        """
+        if colorspace not in lib.PIXEL_FORMATS:
+            raise ValueError("Invalid colorspace, must be one of {0}"
+                             .format(", ".join(sorted(lib.PIXEL_FORMATS))))
+        region, region_width, region_height = self._check_region(region)
+        if size is None:
+            width, height = region_width, region_height
+        else:
+            width, height = size
+        if not (0 < width <= region_width and 0 < height <= region_height):
+            raise ValueError("jpegtran can only downscale JPEGs")
+        pixels = lib.Transformation(self.data).get_pixels(
+            width, height, colorspace, region)
+        return _as_array(pixels, (height, width,
+                                  lib.PIXEL_FORMATS[colorspace][1]))
+
+    def dct_coefficients(self, component=0, dc_only=False):
+        """ Read the quantized DCT coefficients of a component, without
+        decoding the image any further.
+
+        The DC coefficient of a block is 8 times the mean of its (level
+        shifted) samples divided by the first value of the quantization
+        table, so the DC coefficients alone form the component at 1/8 of
+        its size.
+
+        :param component:   index of the component, e.g. 0 for luma
+        :type component:    int
+        :param dc_only:     only read the DC coefficient of every block,
+                            which for progressive images stops after the
+                            first DC scan (so the lowest bits refined by
+                            later scans may be missing)
+        :type dc_only:      bool
+        :return:            coefficients of shape (rows, columns, 8, 8) in
+                            blocks, or (rows, columns) with `dc_only`, and
+                            the quantization table of shape (8, 8), as NumPy
+                            arrays of (signed and unsigned) 16-bit integers
+                            if NumPy is installed, otherwise as memoryviews
+                            (flat on Python 2); changing them does not
+                            affect the image
+        :rtype:             tuple
+
+        """
+        coefficients, rows, columns, quantval = lib.Transformation(
+            self.data).get_coefficients(component, dc_only)
+        shape = (rows, columns) if dc_only else (rows, columns, 8, 8)
+        quantization = memoryview(bytearray(
+            lib.ffi.buffer(lib.ffi.new("unsigned short[]", quantval))))
+        return (_as_array(coefficients, shape, 'h'),
+                _as_array(quantization, (8, 8), 'H'))
+
+    def phash(self, size=8):
+        """ Compute the perceptual hash of the image from its DC
+        coefficients, see :py:func:`jpegtran.hashing.phash`.
+
+        :param size:    number of bits per row and column
+        :type size:     int
+        :return:        hash with size*size bits
+        :rtype:         int
+
+        """
+        return hashing.phash(self.data, size)
+
+    def dhash(self, size=8):
+        """ Compute the difference hash of the image from its DC
+        coefficients, see :py:func:`jpegtran.hashing.dhash`.
+
+        :param size:    number of bits per row and column
+        :type size:     int
+        :return:        hash with size*size bits
+        :rtype:         int
+
+        """
+        return hashing.dhash(self.data, size)
+
+    def _check_region(self, region):
+        """ Validate a (x, y, width, height) region.
+
+        :return:    region, None if it covers the whole image, and its
+                    width and height
+        """
+        if region is None:
+            return None, self.width, self.height
+        x, y, region_width, region_height = region
+        valid_crop = (0 <= x < self.width and 0 <= y < self.height and
+                      region_width > 0 and region_height > 0 and
+                      x+region_width <= self.width and
+                      y+region_height <= self.height)
+        if not valid_crop:
+            raise ValueError("Crop parameters point outside of the image")
+        if tuple(region) == (0, 0, self.width, self.height):
+            region = None
+        return region, region_width, region_height
+
+    def pipeline(self, progressive=False, optimize=False,
+                 strip_metadata=False):
+        """ Start a lazily evaluated chain of lossless transformations.
+
+        All rotations, flips, transpositions and crops recorded on the
+        pipeline are collapsed into a single native transformation once
+        :py:meth:`Pipeline.execute` is called, and the EXIF thumbnail is only
+        updated once.
+
+        ::
+
+            img.pipeline().rotate(90).flip('horizontal').crop(0, 0, 64, 64)\
+               .execute()
+
+        The output options only change how the result is encoded, not the
+        image itself, and are accepted by all lossless transformations.
+
+        :param progressive:     write a progressive JPEG, which also has
+                                optimized Huffman tables
+        :type progressive:      bool
+        :param optimize:        write optimized Huffman tables
+        :type optimize:         bool
+        :param strip_metadata:  drop all APPn and COM markers, i.e. EXIF
+                                data (including the thumbnail), ICC profiles
+                                and comments
+        :type strip_metadata:   bool
+        :return:        transformation pipeline
+        :rtype:         jpegtran.transform.Pipeline
+
+        """
+        return Pipeline(self, progressive, optimize, strip_metadata)
+
+    def optimize(self, progressive=None, strip_metadata=False):
+        """ Losslessly reduce the size of the image by only redoing the
+        entropy coding with optimized Huffman tables.
+
+        The number of bytes saved is available as the `bytes_saved`
+        attribute of the result. It can be negative, e.g. when a
+        progressive image is converted to a baseline one.
+
+        :param progressive:     write a progressive JPEG, which is usually
+                                a few percent smaller, or None to keep the
+                                encoding of the image
+        :type progressive:      bool
+        :param strip_metadata:  drop all APPn and COM markers, see
+                                :py:meth:`pipeline`
+        :type strip_metadata:   bool
+        :return:        optimized image
+        :rtype:         jpegtran.JPEGImage
+
+        """
+        if progressive is None:
+            progressive = self.header.progressive
+        img = self.pipeline(progressive, True, strip_metadata).execute()
+        img.bytes_saved = len(self.data) - len(img.data)
+        return img
+
+    def multi_transform(self, pipelines):
+        """ Execute several transformation pipelines on the image at once.
+
+        All pipelines are run by a single native transformation, so the
+        image data only has to be read once, no matter how many results
+        are produced.
+
+        :param pipelines:   pipelines obtained from :py:meth:`pipeline`
+        :type pipelines:    iterable of jpegtran.transform.Pipeline
+        :return:            transformed images, in the order of the
+                            pipelines
+        :rtype:             list of jpegtran.JPEGImage
+
+        """
+        pipelines = list(pipelines)
+        if any(p._image is not self for p in pipelines):
+            raise ValueError("Pipelines must have been created from this "
+                             "image")
+        pending = [p for p in pipelines if not p._chain.is_noop]
+        results = {}
+        for pipeline in [p for p in pending if p._chain.passes]:
+            # Needs the results of earlier passes
+            results[id(pipeline)] = pipeline.execute()
+            pending.remove(pipeline)
+        if pending:
+            buffers = [p._lease_buffer() for p in pending]
+            if None in buffers:
+                buffers = None
+            outputs = (lib.Transformation(self.data)
+                       .apply_many([p._chain for p in pending], buffers))
+            for pipeline, data in zip(pending, outputs):
+                results[id(pipeline)] = pipeline._finish(data)
+        return [results.get(id(p), self) for p in pipelines]
+
+    def crop_many(self, regions, **options):
+        """ Crop several rectangular areas from the image at once.
+
+        :param regions: (x, y, width, height) tuples, see :py:meth:`crop`
+        :type regions:  iterable of tuples
+        :param options: output options, see :py:meth:`pipeline`
+        :return:        cropped images, in the order of the regions
+        :rtype:         list of jpegtran.JPEGImage
+
+        """
+        return self.multi_transform(self.pipeline(**options).crop(*region)
+                                    for region in regions)
+
     def save(self, fname):
-        """ Save the image to a file
+        """ Save the image to a file.
+
+        The data is written straight from its buffer, e.g. the native output
+        buffer of a transformation, without copying it.
 
-        :param fname:   Path to file
-        :type fname:    unicode
+        :param fname:   Path to file, or file descriptor or file object
+                        opened for writing, which is written to at its
+                        current position and not closed
+        :type fname:    unicode/int/file
 
         """
+        if isinstance(fname, int) or hasattr(fname, 'write'):
+            _write_file(fname, self.data)
+            return
         if not re.match(r'^.*\.jp[e]*g$', str(fname).lower()):
             raise ValueError("fname must refer to a JPEG file, i.e. end with "
                              "'.jpg' or '.jpeg'")
         with open(fname, 'wb') as fp:
-            fp.write(self.data)
+            _write_file(fp, self.data)
 
     def as_blob(self):
         """ Get the image data as a string
@@ -227,11 +823,86 @@ class JPEGImage(object):
         :rtype:     bytes
 
         """
-        return bytes(self.data)
+        start = lib.instrumentation.start()
+        blob = bytes(self.data)
+        lib.instrumentation.record('as_blob', 'copy_out', start)
+        lib.instrumentation.count('as_blob', len(blob), len(blob))
+        return blob
 
-    def _update_thumbnail(self):
-        if not self.exif_thumbnail:
+    @classmethod
+    def aopen(cls, fname):
+        """ Awaitable version of :py:meth:`__init__` for reading an image
+        from a file. See :py:mod:`jpegtran.aio` for the executor the
+        awaitable methods run on.
+
+        :param fname:   Filename of JPEG file
+        :type fname:    str
+        :return:        awaitable for the image
+        """
+        return _run_async(cls, fname)
+
+    def arotate(self, angle, **options):
+        """ Awaitable version of :py:meth:`rotate`. """
+        return _run_async(self.rotate, angle, **options)
+
+    def aflip(self, direction, **options):
+        """ Awaitable version of :py:meth:`flip`. """
+        return _run_async(self.flip, direction, **options)
+
+    def atranspose(self, **options):
+        """ Awaitable version of :py:meth:`transpose`. """
+        return _run_async(self.transpose, **options)
+
+    def atransverse(self, **options):
+        """ Awaitable version of :py:meth:`transverse`. """
+        return _run_async(self.transverse, **options)
+
+    def acrop(self, x, y, width, height, **options):
+        """ Awaitable version of :py:meth:`crop`. """
+        return _run_async(self.crop, x, y, width, height, **options)
+
+    def adownscale(self, width, height, quality=75, region=None,
+                   engine=None, profile=None, max_memory=None,
+                   max_bytes=None):
+        """ Awaitable version of :py:meth:`downscale`. """
+        return _run_async(self.downscale, width, height, quality, region,
+                          engine, profile, max_memory, max_bytes)
+
+    def aexif_autotransform(self, **options):
+        """ Awaitable version of :py:meth:`exif_autotransform`. """
+        return _run_async(self.exif_autotransform, **options)
+
+    def asave(self, fname):
+        """ Awaitable version of :py:meth:`save`. """
+        return _run_async(self.save, fname)
+
+    def _update_thumbnail(self, chain=None):
+        """ Bring the EXIF thumbnail in line with the image.
+
+        :param chain:   lossless transformations the image was derived
+                        with, if they consist only of orientation changes
+                        and can be applied to the thumbnail perfectly, the
+                        thumbnail is transformed instead of regenerated
+        :type chain:    jpegtran.lib.TransformChain
+
+        """
+        if self.thumbnail_policy == 'keep':
+            return
+        thumbnail = self.exif_thumbnail
+        if not thumbnail:
             return
+        if self.thumbnail_policy == 'strip':
+            self._writable_exif(resizable=True).remove_thumbnail()
+            self._header = None
+            self._exif = None
+            return
+        if chain is not None and chain.region is None:
+            header = thumbnail.header
+            if lib.is_perfect(chain.op, header.width, header.height,
+                              header.mcu_size):
+                self.exif_thumbnail = JPEGImage._from_result(
+                    lib.Transformation(thumbnail.data).apply(chain))
+                return
         target_width = None
         target_height = None
         if self.width > self.height:
@@ -246,3 +917,123 @@ class JPEGImage(object):
             return
         updated = self.downscale(target_width, target_height)
         self.exif_thumbnail = updated
+
+
+class Pipeline(object):
+    """ Chain of lossless transformations on a :py:class:`JPEGImage` that is
+    executed as a single native transformation.
+
+    The transformation methods have the same semantics as their
+    counterparts on :py:class:`JPEGImage`, but only record the
+    transformation and return the pipeline itself. Crop offsets must be
+    multiples of the MCU size of the image they apply to, as for
+    :py:meth:`JPEGImage.crop`. Transformations following a crop that
+    cannot be folded into it without changing the result, e.g. a flip
+    after a crop whose width is not a multiple of the MCU width, start
+    another native pass on the cropped image. See
+    :py:meth:`JPEGImage.pipeline` for the output options.
+    """
+    def __init__(self, image, progressive=False, optimize=False,
+                 strip_metadata=False):
+        self._image = image
+        self._chain = lib.TransformChain(image.width, image.height,
+                                         progressive, optimize,
+                                         strip_metadata,
+                                         image.header.mcu_size)
+
+    @property
+    def width(self):
+        """ Width of the resulting image in pixels. """
+        return self._chain.width
+
+    @property
+    def height(self):
+        """ Height of the resulting image in pixels. """
+        return self._chain.height
+
+    def rotate(self, angle):
+        self._chain.rotate(angle)
+        return self
+
+    def flip(self, direction):
+        self._chain.flip(direction)
+        return self
+
+    def transpose(self):
+        self._chain.transpose()
+        return self
+
+    def transverse(self):
+        self._chain.transverse()
+        return self
+
+    def crop(self, x, y, width, height):
+        self._chain.crop(x, y, width, height)
+        return self
+
+    def grayscale(self):
+        self._chain.grayscale()
+        return self
+
+    def execute(self):
+        """ Execute all recorded transformations.
+
+        :return:        transformed image
+        :rtype:         jpegtran.JPEGImage
+
+        """
+        if self._chain.is_noop:
+            return self._image
+        image = self._image
+        for chain in self._chain.passes:
+            image = self._finish(
+                lib.Transformation(image.data).apply(chain), chain, image)
+        return self._finish(
+            lib.Transformation(image.data).apply(self._chain,
+                                                 self._lease_buffer()),
+            source=image)
+
+    def save(self, fname):
+        """ Execute all recorded transformations and save the result to a
+        file, writing it straight from the native output buffer.
+
+        :param fname:   path to file, file descriptor or file object, see
+                        :py:meth:`JPEGImage.save`
+        :return:        transformed image
+        :rtype:         jpegtran.JPEGImage
+
+        """
+        img = self.execute()
+        img.save(fname)
+        return img
+
+    @property
+    def buffer_size(self):
+        """ Size of an output buffer that is guaranteed to hold the result,
+        or None if it cannot be bounded. """
+        return lib.buffer_size(self.width, self.height,
+                               self._image.header.subsampling)
+
+    def _lease_buffer(self):
+        arena = self._image.buffer_arena
+        if arena is None:
+            return None
+        size = self.buffer_size
+        if size is None:
+            return None
+        return arena.lease(size)
+
+    def _finish(self, data, chain=None, source=None):
+        if chain is None:
+            chain = self._chain
+        size = None
+        if chain.region is None:
+            size = (chain.width, chain.height)
+        img = JPEGImage._from_result(data, size, source or self._image)
+        start = lib.instrumentation.start()
+        # Set EXIF orientation to 'Normal' (== no rotation)
+        if chain.rotated and img.exif_orientation not in (None, 1):
+            img.exif_orientation = 1
+        img._update_thumbnail(chain)
+        lib.instrumentation.record('transform', 'thumbnail', start)
+        return img
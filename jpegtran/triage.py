@@ -0,0 +1,184 @@
+import collections
+import mmap
+import multiprocessing
+import os
+import struct
+
+import jpegtran.lib as lib
+
+# Number of bytes read at a time until the header is complete
+_CHUNK_SIZE = 16384
+
+
+class ScanRecord(collections.namedtuple(
+        'ScanRecord', ['index', 'path', 'size', 'width', 'height',
+                       'subsampling', 'colorspace', 'progressive',
+                       'orientation', 'thumbnail', 'truncated', 'valid',
+                       'error'])):
+    """ Header information of a single file, see :py:func:`scan`.
+
+    :ivar index:        position of the file in the inputs
+    :ivar path:         the file name
+    :ivar size:         size of the file in bytes
+    :ivar width:        width of the image in pixels
+    :ivar height:       height of the image in pixels
+    :ivar subsampling:  chroma subsampling, see
+                        :py:class:`jpegtran.lib.JPEGHeader`
+    :ivar colorspace:   'GRAY', 'YCbCr', 'RGB', 'CMYK' or 'YCCK'
+    :ivar progressive:  whether the image is progressively encoded
+    :ivar orientation:  EXIF orientation or None
+    :ivar thumbnail:    whether the image has an EXIF thumbnail
+    :ivar truncated:    whether the file does not end with an EOI marker
+    :ivar valid:        whether the entropy-coded data decodes without
+                        errors or warnings, None if it was not validated
+    :ivar error:        exception raised while reading the file, e.g. a
+                        ValueError for files that are not JPEG images (the
+                        other fields are None then), or a ValueError with
+                        libjpeg's message for invalid data
+    """
+    __slots__ = ()
+
+
+def _read_header(fp):
+    """ Read the beginning of a file up to the end of the first SOS
+    segment, or as much as there is of a broken header.
+    """
+    buf = bytearray()
+    while True:
+        chunk = fp.read(max(_CHUNK_SIZE, len(buf)))
+        if not chunk:
+            return buf
+        buf += chunk
+        last = None
+        for last in lib._iter_segments(buf):
+            pass
+        if last is None:
+            return buf
+        marker, offset, length = last
+        end = offset + length
+        if marker in (lib.MARKER_SOS, lib.MARKER_EOI) and end <= len(buf):
+            return buf
+        if end + 4 <= len(buf):
+            # The markers stopped before the end of the data read so far
+            return buf
+
+
+def _header_end(data):
+    """ Get the end of the first SOS segment of mapped file data. """
+    end = 0
+    for _, offset, length in lib._iter_segments(data):
+        end = offset + length
+    return end
+
+
+def _image_info(header_data, truncated):
+    header = lib.JPEGHeader(header_data)
+    orientation, thumbnail = None, False
+    try:
+        exif = lib.Exif(header_data, header.find(lib.MARKER_APP1))
+    except lib.ExifException:
+        pass
+    else:
+        try:
+            orientation = exif.orientation
+        except lib.ExifException:
+            pass
+        try:
+            thumbnail = len(exif.thumbnail) > 0
+        except lib.ExifException:
+            pass
+    return dict(width=header.width, height=header.height,
+                subsampling=header.subsampling,
+                colorspace=header.colorspace,
+                progressive=header.progressive, orientation=orientation,
+                thumbnail=thumbnail, truncated=truncated)
+
+
+def scan_file(path, validate=False, index=0):
+    """ Read the header information of a JPEG file, see :py:func:`scan`.
+
+    :rtype: ScanRecord
+    """
+    info = dict((field, None) for field in ScanRecord._fields)
+    info.update(index=index, path=path)
+    try:
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            info['size'] = size
+            if validate:
+                if not size:
+                    raise ValueError("File is empty")
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    info.update(_image_info(data[:_header_end(data)],
+                                            data[-2:] != b'\xff\xd9'))
+                    message = lib.Transformation(data).validate()
+                finally:
+                    data.close()
+                info['valid'] = message is None
+                if message is not None:
+                    info['error'] = ValueError(message)
+            else:
+                header_data = _read_header(fp)
+                fp.seek(max(0, size - 2))
+                info.update(_image_info(header_data,
+                                        fp.read(2) != b'\xff\xd9'))
+    except (EnvironmentError, ValueError, struct.error,
+            lib.ExifException) as e:
+        # struct.error for headers cut short in a way the parser misses
+        info['error'] = e
+    return ScanRecord(**info)
+
+
+def scan(paths, workers=None, validate=False, max_pending=None):
+    """ Triage many JPEG files by their headers, e.g. for sorting a corpus
+    by dimensions and encoding before processing it.
+
+    Only the marker segments preceding the entropy-coded data and the last
+    two bytes (for finding truncated files) of every file are read, the
+    image data is neither read nor decoded. With `validate`, the
+    entropy-coded data of every file is decoded as well, at 1/8 scale into
+    a single row, so hardly anything but the Huffman decoding is done and
+    no image-sized buffers are allocated (except by libjpeg for
+    progressive images).
+
+    Files are read on a pool of threads and the records are yielded in the
+    order in which they complete. A broken file does not stop the scan but
+    is reported through the `error` field of its record. At most
+    `max_pending` files are read at the same time.
+
+    :param paths:       file names
+    :type paths:        iterable
+    :param workers:     number of threads, defaults to the number of CPUs
+    :type workers:      int
+    :param validate:    decode the entropy-coded data to check it for
+                        corruption
+    :type validate:     bool
+    :param max_pending: maximum number of files in flight, defaults to
+                        twice the number of workers
+    :type max_pending:  int
+    :return:            iterator over :py:class:`ScanRecord` instances
+    """
+    # On Python 2 this requires the `futures` backport
+    from concurrent.futures import ThreadPoolExecutor
+    from jpegtran.batch import _imap_unordered
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 2*workers
+
+    jobs = ((index, (path, validate, index))
+            for index, path in enumerate(paths))
+    executor = ThreadPoolExecutor(workers)
+    results = _imap_unordered(executor, scan_file, jobs, max_pending)
+    try:
+        for _, record, error in results:
+            if error is not None:
+                # Unexpected, scan_file reports broken files in the record
+                raise error
+            yield record
+    finally:
+        # Cancel the pending files before waiting for the running ones
+        results.close()
+        executor.shutdown(wait=True)
@@ -30,7 +30,10 @@ setup(
     license='MIT',
     packages=['jpegtran'],
     package_data={'jpegtran': ['jpegtran.cdef']},
-    setup_requires=['cffi >= 1.0'],
-    install_requires=['cffi >= 1.0'],
-    cffi_modules=["jpegtran/jpegtran_build.py:ffi"]
+    setup_requires=['cffi >= 1.12'],
+    install_requires=['cffi >= 1.12', 'futures; python_version < "3"'],
+    cffi_modules=["jpegtran/jpegtran_build.py:ffi"],
+    entry_points={
+        'console_scripts': ['jpegtran-cffi = jpegtran.cli:main'],
+    }
 )
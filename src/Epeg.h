@@ -54,8 +54,11 @@ extern "C" {
    EAPI Epeg_Image   *epeg_memory_open               (unsigned char *data, int size);
    EAPI void          epeg_size_get                  (Epeg_Image *im, int *w, int *h);
    EAPI void          epeg_decode_size_set           (Epeg_Image *im, int w, int h);
+   EAPI void          epeg_decode_bounds_set         (Epeg_Image *im, int x, int y, int w, int h);
+   EAPI void          epeg_decode_crop_set           (Epeg_Image *im, int x, int y, int w, int h);
    EAPI void          epeg_colorspace_get            (Epeg_Image *im, int *space);
    EAPI void          epeg_decode_colorspace_set     (Epeg_Image *im, Epeg_Colorspace colorspace);
+   EAPI void          epeg_decode_memory_set         (Epeg_Image *im, unsigned long bytes);
    EAPI const void   *epeg_pixels_get                (Epeg_Image *im, int x, int y, int w, int h);
    EAPI void          epeg_pixels_free               (Epeg_Image *im, const void *data);
    EAPI const char   *epeg_comment_get               (Epeg_Image *im);
@@ -0,0 +1,207 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <setjmp.h>
+#include <jpeglib.h>
+#include <jerror.h>
+
+#include "coefficients.h"
+
+/* Start of scan marker */
+#define _MARKER_SOS 0xDA
+
+struct _coefficients_error_mgr
+{
+   struct jpeg_error_mgr pub;
+   jmp_buf               setjmp_buffer;
+};
+
+static void
+_coefficients_error_exit(j_common_ptr cinfo)
+{
+   struct _coefficients_error_mgr *err =
+     (struct _coefficients_error_mgr *) cinfo->err;
+
+   longjmp(err->setjmp_buffer, 1);
+}
+
+static void
+_coefficients_emit_message(j_common_ptr cinfo, int msg_level)
+{
+   /* Corrupt data warnings are not fatal, like in tjTransform */
+}
+
+/*
+ * Find the end of the first progressive scan with the DC coefficients of a
+ * component, i.e. the offset of the marker following its entropy-coded
+ * data. Returns 0 if there is no such scan.
+ */
+static unsigned long
+_first_dc_scan_end(const unsigned char *src, unsigned long size,
+                   int component_id)
+{
+   unsigned long pos = 2;
+
+   while (pos + 4 <= size)
+     {
+        int marker, length, i, count, covered = 0;
+
+        if (src[pos] != 0xFF)
+          return 0;
+        marker = src[pos + 1];
+        if (marker == 0xFF)
+          {
+             /* Fill byte */
+             pos++;
+             continue;
+          }
+        if (marker == JPEG_EOI)
+          return 0;
+        length = (src[pos + 2] << 8) | src[pos + 3];
+        if (marker != _MARKER_SOS)
+          {
+             pos += 2 + length;
+             continue;
+          }
+
+        count = src[pos + 4];
+        if (pos + 8 + 2 * count > size)
+          return 0;
+        for (i = 0; i < count; i++)
+          if (src[pos + 5 + 2 * i] == component_id)
+            covered = 1;
+        /* Spectral selection start and successive approximation high bit */
+        covered = covered && src[pos + 5 + 2 * count] == 0 &&
+          (src[pos + 7 + 2 * count] >> 4) == 0;
+
+        /* Skip the entropy-coded data, in which 0xFF is either stuffed
+           with 0x00 or starts a restart marker */
+        pos += 2 + length;
+        while (pos + 1 < size &&
+               !(src[pos] == 0xFF && src[pos + 1] != 0 &&
+                 (src[pos + 1] < JPEG_RST0 || src[pos + 1] > JPEG_RST0 + 7)))
+          pos++;
+        if (covered)
+          return pos;
+     }
+   return 0;
+}
+
+/**
+ * Read the quantized DCT coefficients of one component of a JPEG image,
+ * without decoding it any further (no IDCT, upsampling or color
+ * conversion).
+ *
+ * The blocks are stored row by row, each with its 64 coefficients in
+ * natural (row-major) order, or only with its DC coefficient if dc_only is
+ * set, which for progressive images only requires reading the first scan
+ * (later scans refine the DC coefficients by a few bits at most). The
+ * buffer is allocated with malloc and must be freed by the caller. The
+ * quantization table of the component is copied to quantval, in natural
+ * order as well.
+ *
+ * Returns 0 on success, 1 on failure and 2 if there is no such component.
+ */
+int
+read_coefficients(const unsigned char *src, unsigned long src_size,
+                  int component, int dc_only, short **dst,
+                  int *width_in_blocks, int *height_in_blocks,
+                  unsigned short *quantval)
+{
+   struct jpeg_decompress_struct   dinfo;
+   struct _coefficients_error_mgr  err;
+   jpeg_component_info            *comp;
+   JQUANT_TBL                     *qtable;
+   jvirt_barray_ptr               *coefs;
+   JCOEF                          *out = NULL;
+   JDIMENSION                      row, col, width, height;
+   int                             i, per_block = dc_only ? 1 : DCTSIZE2;
+
+   dinfo.err = jpeg_std_error(&(err.pub));
+   err.pub.error_exit = _coefficients_error_exit;
+   err.pub.emit_message = _coefficients_emit_message;
+   jpeg_create_decompress(&dinfo);
+   if (setjmp(err.setjmp_buffer))
+     {
+        jpeg_destroy_decompress(&dinfo);
+        free(out);
+        return 1;
+     }
+
+   jpeg_mem_src(&dinfo, (unsigned char *) src, src_size);
+   jpeg_read_header(&dinfo, TRUE);
+   if (component < 0 || component >= dinfo.num_components)
+     {
+        jpeg_destroy_decompress(&dinfo);
+        return 2;
+     }
+   if (dc_only && dinfo.progressive_mode)
+     {
+        unsigned long end = _first_dc_scan_end(
+          src, src_size, dinfo.comp_info[component].component_id);
+
+        if (end)
+          {
+             /* Start over with the data up to the end of the scan, the
+                source manager ends it with a fake EOI marker */
+             jpeg_abort_decompress(&dinfo);
+             jpeg_mem_src(&dinfo, (unsigned char *) src, end);
+             jpeg_read_header(&dinfo, TRUE);
+          }
+     }
+   coefs = jpeg_read_coefficients(&dinfo);
+
+   comp = dinfo.comp_info + component;
+   width = comp->width_in_blocks;
+   height = comp->height_in_blocks;
+   qtable = comp->quant_table;
+   if (!qtable)
+     qtable = dinfo.quant_tbl_ptrs[comp->quant_tbl_no];
+   if (!qtable)
+     ERREXIT1(&dinfo, JERR_NO_QUANT_TABLE, comp->quant_tbl_no);
+   for (i = 0; i < DCTSIZE2; i++)
+     quantval[i] = qtable->quantval[i];
+
+   out = malloc((size_t) width * height * per_block * sizeof(JCOEF));
+   if (!out)
+     ERREXIT1(&dinfo, JERR_OUT_OF_MEMORY, 11);
+   for (row = 0; row < height; row++)
+     {
+        JBLOCKARRAY blocks = (*dinfo.mem->access_virt_barray)
+          ((j_common_ptr) &dinfo, coefs[component], row, 1, FALSE);
+        JCOEF *out_row = out + (size_t) row * width * per_block;
+
+        if (dc_only)
+          for (col = 0; col < width; col++)
+            out_row[col] = blocks[0][col][0];
+        else
+          memcpy(out_row, blocks[0], width * DCTSIZE2 * sizeof(JCOEF));
+     }
+
+   jpeg_finish_decompress(&dinfo);
+   jpeg_destroy_decompress(&dinfo);
+   *dst = out;
+   *width_in_blocks = width;
+   *height_in_blocks = height;
+   return 0;
+}
+
+/**
+ * Convert DC coefficients to the mean sample values of their blocks, i.e.
+ * an image at 1/8 of the size of the component.
+ */
+void
+dc_pixels(const short *dc, int count, int quantval, unsigned char *pixels)
+{
+   int i;
+
+   for (i = 0; i < count; i++)
+     {
+        /* The DC coefficient is 8 times the mean of the level shifted
+           samples */
+        int value = dc[i] * quantval;
+        int mean = 128 + (value >= 0 ? (value + 4) / 8 : -((4 - value) / 8));
+
+        pixels[i] = mean < 0 ? 0 : (mean > 255 ? 255 : mean);
+     }
+}
@@ -0,0 +1,11 @@
+#ifndef _COEFFICIENTS_H
+#define _COEFFICIENTS_H
+
+int read_coefficients(const unsigned char *src, unsigned long src_size,
+                      int component, int dc_only, short **dst,
+                      int *width_in_blocks, int *height_in_blocks,
+                      unsigned short *quantval);
+void dc_pixels(const short *dc, int count, int quantval,
+               unsigned char *pixels);
+
+#endif
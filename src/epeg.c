@@ -3,8 +3,12 @@
 #include <jerror.h>
 
 static Epeg_Image   *_epeg_open_header         (Epeg_Image *im);
-static int           _epeg_decode              (Epeg_Image *im);
+static int           _epeg_decode              (Epeg_Image *im, int streaming);
+static int           _epeg_decode_crop         (Epeg_Image *im);
+static int           _epeg_decode_stream       (Epeg_Image *im);
+static JSAMPROW      _epeg_stream_line         (Epeg_Image *im, int y);
 static int           _epeg_scale               (Epeg_Image *im);
+static int           _epeg_scale_crop          (Epeg_Image *im);
 static int           _epeg_decode_for_trim     (Epeg_Image *im);
 static int           _epeg_trim                (Epeg_Image *im);
 static int           _epeg_encode              (Epeg_Image *im);
@@ -157,6 +161,60 @@ epeg_decode_bounds_set(Epeg_Image *im, int x, int y, int w, int h)
    im->out.y = y;
 }
 
+/**
+ * Set the region of the image to decode, in pixels.
+ * @param im A handle to an opened Epeg image.
+ * @param x Region X.
+ * @param y Region Y.
+ * @param w Region width.
+ * @param h Region height.
+ *
+ * Restricts decoding to the given region, which is then scaled to the size
+ * set with epeg_decode_size_set(). Call this after setting the decode size,
+ * it is clamped to the size of the region. With libjpeg-turbo only the rows
+ * and iMCU columns covering the region are decoded.
+ *
+ */
+EAPI void
+epeg_decode_crop_set(Epeg_Image *im, int x, int y, int w, int h)
+{
+   if      (im->pixels) return;
+   if      (x < 0)               x = 0;
+   else if (x > im->in.w - 1)    x = im->in.w - 1;
+   if      (y < 0)               y = 0;
+   else if (y > im->in.h - 1)    y = im->in.h - 1;
+   if      (w < 1)               w = 1;
+   else if (w > im->in.w - x)    w = im->in.w - x;
+   if      (h < 1)               h = 1;
+   else if (h > im->in.h - y)    h = im->in.h - y;
+   im->crop.x = x;
+   im->crop.y = y;
+   im->crop.w = w;
+   im->crop.h = h;
+   if (im->out.w > w) im->out.w = w;
+   if (im->out.h > h) im->out.h = h;
+}
+
+/**
+ * Limit the memory used for decoding the image.
+ * @param im A handle to an opened Epeg image.
+ * @param bytes The maximum number of bytes, 0 for no limit.
+ *
+ * If the decoded image would not fit into the limit, epeg_encode() decodes
+ * it a row at a time and scales each row straight into the encoder instead
+ * of decoding the whole image first. The limit is passed on to libjpeg as
+ * well, so decoding fails rather than exceeding it for images that need a
+ * full image buffer anyway, like progressive JPEGs.
+ *
+ */
+EAPI void
+epeg_decode_memory_set(Epeg_Image *im, unsigned long bytes)
+{
+   if (im->pixels) return;
+   im->stream.max_memory = bytes;
+   im->in.jinfo.mem->max_memory_to_use = bytes;
+}
+
 /**
  * Set the colorspace in which to decode the image.
  * @param im A handle to an opened Epeg image.
@@ -201,7 +259,7 @@ epeg_pixels_get(Epeg_Image *im, int x, int y,  int w, int h)
    
    if (!im->pixels)
      {
-	if (_epeg_decode(im) != 0) return NULL;
+	if (_epeg_decode(im, 0) != 0) return NULL;
      }
    
    if (!im->pixels) return NULL;
@@ -449,7 +507,7 @@ epeg_pixels_get_as_RGB8(Epeg_Image *im, int x, int y,  int w, int h)
    
    if (!im->pixels)
      {
-	if (_epeg_decode(im) != 0) return NULL;
+	if (_epeg_decode(im, 0) != 0) return NULL;
      }
 	
    if (!im->pixels) return NULL;
@@ -721,7 +779,7 @@ EAPI int
 epeg_encode(Epeg_Image *im)
 {
    int ret;
-   if ((ret = _epeg_decode(im)) != 0)
+   if ((ret = _epeg_decode(im, 1)) != 0)
      return (ret == 2 ? 4 : 3);
    if (_epeg_scale(im) != 0)
      return 1;
@@ -887,7 +945,7 @@ _epeg_open_header(Epeg_Image *im)
          2 - setjmp error
 */
 static int
-_epeg_decode(Epeg_Image *im)
+_epeg_decode(Epeg_Image *im, int streaming)
 {
    int scale, scalew, scaleh, y;
    JDIMENSION old_output_scanline = 1;
@@ -895,8 +953,16 @@ _epeg_decode(Epeg_Image *im)
    if (im->pixels) return 1;
    if ((im->out.w < 1) || (im->out.h < 1)) return 1;
    
-   scalew = im->in.w / im->out.w;
-   scaleh = im->in.h / im->out.h;
+   if (im->crop.w > 0)
+     {
+	scalew = im->crop.w / im->out.w;
+	scaleh = im->crop.h / im->out.h;
+     }
+   else
+     {
+	scalew = im->in.w / im->out.w;
+	scaleh = im->in.h / im->out.h;
+     }
    
    scale = scalew;   
    if (scaleh < scalew) scale = scaleh;
@@ -950,6 +1016,21 @@ _epeg_decode(Epeg_Image *im)
      return 2;
 
    jpeg_calc_output_dimensions(&(im->in.jinfo));
+
+   if (streaming && im->stream.max_memory > 0)
+     {
+	unsigned long size = (unsigned long) im->in.jinfo.output_width *
+	   im->in.jinfo.output_height * im->in.jinfo.output_components;
+
+	if (im->crop.w > 0)
+	  size = (long long) size * im->crop.w * im->crop.h /
+	     ((long long) im->in.w * im->in.h);
+	if (size > im->stream.max_memory)
+	  return _epeg_decode_stream(im);
+     }
+
+   if (im->crop.w > 0)
+     return _epeg_decode_crop(im);
    
    im->pixels = malloc(im->in.jinfo.output_width * im->in.jinfo.output_height * im->in.jinfo.output_components);
    if (!im->pixels) return 1;
@@ -985,12 +1066,198 @@ _epeg_decode(Epeg_Image *im)
    return 0;
 }
 
+/**
+  Decode only the rows of the crop region and, with libjpeg-turbo, only the
+  iMCU columns covering it. Must be called with the decompressor set up and
+  the error handler armed.
+
+  retval 1 - malloc or other
+*/
+static int
+_epeg_decode_crop(Epeg_Image *im)
+{
+   struct jpeg_decompress_struct *jinfo = &(im->in.jinfo);
+   JDIMENSION x0, x1, y0, y1, xoffset, width, y;
+   JDIMENSION old_output_scanline;
+
+   jpeg_start_decompress(jinfo);
+
+   /* Region in the coordinates of the scaled output */
+   x0 = ((long long) im->crop.x * jinfo->output_width) / im->in.w;
+   y0 = ((long long) im->crop.y * jinfo->output_height) / im->in.h;
+   x1 = (((long long) (im->crop.x + im->crop.w) * jinfo->output_width)
+	 + im->in.w - 1) / im->in.w;
+   y1 = (((long long) (im->crop.y + im->crop.h) * jinfo->output_height)
+	 + im->in.h - 1) / im->in.h;
+   x1 = MIN(x1, jinfo->output_width);
+   y1 = MIN(y1, jinfo->output_height);
+
+   im->crop.width = jinfo->output_width;
+   xoffset = 0;
+#if defined(LIBJPEG_TURBO_VERSION_NUMBER) && LIBJPEG_TURBO_VERSION_NUMBER >= 1005000
+   /* Aligns the offset to the iMCU boundary left of it */
+   xoffset = x0;
+   width = x1 - x0;
+   jpeg_crop_scanline(jinfo, &xoffset, &width);
+#endif
+   im->crop.left = xoffset;
+   im->crop.top = y0;
+
+   im->pixels = malloc(jinfo->output_width * (y1 - y0) * jinfo->output_components);
+   if (!im->pixels)
+     {
+	jpeg_abort_decompress(jinfo);
+	return 1;
+     }
+   im->lines = malloc((y1 - y0) * sizeof(char *));
+   if (!im->lines)
+     {
+	free(im->pixels);
+	im->pixels = NULL;
+	jpeg_abort_decompress(jinfo);
+	return 1;
+     }
+   for (y = 0; y < y1 - y0; y++)
+     im->lines[y] = im->pixels + (y * jinfo->output_components * jinfo->output_width);
+
+#if defined(LIBJPEG_TURBO_VERSION_NUMBER) && LIBJPEG_TURBO_VERSION_NUMBER >= 1005000
+   if (y0 > 0 && jpeg_skip_scanlines(jinfo, y0) != y0)
+     {
+	jpeg_abort_decompress(jinfo);
+	return 1;
+     }
+#else
+   /* Rows above the region are decoded into the first line and dropped */
+   while (jinfo->output_scanline < y0)
+     jpeg_read_scanlines(jinfo, &(im->lines[0]), 1);
+#endif
+
+   old_output_scanline = jinfo->output_scanline + 1;
+   while (jinfo->output_scanline < y1)
+     {
+	if (old_output_scanline == jinfo->output_scanline)
+	  {
+	     jpeg_abort_decompress(jinfo);
+	     return 1;
+	  }
+	old_output_scanline = jinfo->output_scanline;
+	jpeg_read_scanlines(jinfo,
+			    &(im->lines[jinfo->output_scanline - y0]),
+			    MIN(jinfo->rec_outbuf_height,
+				y1 - jinfo->output_scanline));
+     }
+
+   /* The rows below the region are never decoded */
+   jpeg_abort_decompress(jinfo);
+
+   return 0;
+}
+
+/**
+  Prepare decoding a row at a time, the rows are decoded and scaled by
+  _epeg_stream_line() while encoding. Must be called with the decompressor
+  set up and the error handler armed.
+
+  retval 1 - malloc or other
+*/
+static int
+_epeg_decode_stream(Epeg_Image *im)
+{
+   struct jpeg_decompress_struct *jinfo = &(im->in.jinfo);
+   JDIMENSION x0, x1, xoffset, width;
+
+   if (im->crop.w < 1)
+     {
+	im->crop.x = 0;
+	im->crop.y = 0;
+	im->crop.w = im->in.w;
+	im->crop.h = im->in.h;
+     }
+
+   jpeg_start_decompress(jinfo);
+   im->crop.width = jinfo->output_width;
+   im->crop.top = 0;
+   xoffset = 0;
+#if defined(LIBJPEG_TURBO_VERSION_NUMBER) && LIBJPEG_TURBO_VERSION_NUMBER >= 1005000
+   x0 = ((long long) im->crop.x * jinfo->output_width) / im->in.w;
+   x1 = (((long long) (im->crop.x + im->crop.w) * jinfo->output_width)
+	 + im->in.w - 1) / im->in.w;
+   x1 = MIN(x1, jinfo->output_width);
+   xoffset = x0;
+   width = x1 - x0;
+   if (xoffset > 0 || width < jinfo->output_width)
+     jpeg_crop_scanline(jinfo, &xoffset, &width);
+#endif
+   im->crop.left = xoffset;
+
+   /* One decoded row followed by one scaled row */
+   im->pixels = malloc((jinfo->output_width + im->out.w) * jinfo->output_components);
+   if (!im->pixels)
+     {
+	jpeg_abort_decompress(jinfo);
+	return 1;
+     }
+   im->lines = malloc(2 * sizeof(char *));
+   if (!im->lines)
+     {
+	free(im->pixels);
+	im->pixels = NULL;
+	jpeg_abort_decompress(jinfo);
+	return 1;
+     }
+   im->lines[0] = im->pixels;
+   im->lines[1] = im->pixels + jinfo->output_width * jinfo->output_components;
+   im->stream.active = 1;
+   im->scaled = 1;
+   return 0;
+}
+
+/* Decode the source row of output row y, which must be requested in
+   ascending order, and scale it. Uses the same nearest neighbour sampling
+   as _epeg_scale_crop(), so the result is identical to decoding the whole
+   image first. */
+static JSAMPROW
+_epeg_stream_line(Epeg_Image *im, int y)
+{
+   struct jpeg_decompress_struct *jinfo = &(im->in.jinfo);
+   unsigned char *dst, *src;
+   JDIMENSION     sy;
+   int            x, i, comps;
+
+   comps = jinfo->output_components;
+   sy = ((im->crop.y * (long long) im->out.h + y * (long long) im->crop.h)
+	 * jinfo->output_height) / ((long long) im->in.h * im->out.h);
+   /* Consecutive output rows may share their source row */
+   if (sy + 1 != jinfo->output_scanline)
+     {
+#if defined(LIBJPEG_TURBO_VERSION_NUMBER) && LIBJPEG_TURBO_VERSION_NUMBER >= 1005000
+	if (sy > jinfo->output_scanline)
+	  jpeg_skip_scanlines(jinfo, sy - jinfo->output_scanline);
+#endif
+	while (jinfo->output_scanline <= sy)
+	  jpeg_read_scanlines(jinfo, &(im->lines[0]), 1);
+     }
+
+   dst = im->lines[1];
+   for (x = 0; x < im->out.w; x++)
+     {
+	src = im->lines[0] + ((((im->crop.x * (long long) im->out.w + x * (long long) im->crop.w)
+				* im->crop.width) / ((long long) im->in.w * im->out.w))
+			      - im->crop.left) * comps;
+	for (i = 0; i < comps; i++)
+	  dst[i] = src[i];
+	dst += comps;
+     }
+   return im->lines[1];
+}
+
 static int
 _epeg_scale(Epeg_Image *im)
 {
    unsigned char *dst, *row, *src;
    int            x, y, w, h, i;
    
+   if (im->crop.w > 0) return _epeg_scale_crop(im);
    if ((im->in.w == im->out.w) && (im->in.h == im->out.h)) return 0;
    if (im->scaled) return 0;
    
@@ -1015,6 +1282,45 @@ _epeg_scale(Epeg_Image *im)
    return 0;
 }
 
+/* Nearest neighbour scaling of the crop region, in place. Since the region
+   is never decoded at a smaller size than the output, every source pixel
+   lies at or after its destination. */
+static int
+_epeg_scale_crop(Epeg_Image *im)
+{
+   unsigned char *dst, *row, *src;
+   int            x, y, i, sy, comps;
+   long long      iw, ih, ow, oh;
+
+   if (im->scaled) return 0;
+   if ((im->out.w < 1) || (im->out.h < 1)) return 0;
+
+   im->scaled = 1;
+   comps = im->in.jinfo.output_components;
+   /* Size of the whole image as decoded, output_width only covers the
+      cropped columns */
+   ow = im->crop.width;
+   oh = im->in.jinfo.output_height;
+   iw = im->in.w;
+   ih = im->in.h;
+   for (y = 0; y < im->out.h; y++)
+     {
+	sy = ((im->crop.y * (long long) im->out.h + y * (long long) im->crop.h) * oh)
+	     / (ih * im->out.h);
+	row = im->lines[sy - im->crop.top];
+	dst = im->lines[y];
+	for (x = 0; x < im->out.w; x++)
+	  {
+	     src = row + ((((im->crop.x * (long long) im->out.w + x * (long long) im->crop.w) * ow)
+			   / (iw * im->out.w)) - im->crop.left) * comps;
+	     for (i = 0; i < comps; i++)
+	       dst[i] = src[i];
+	     dst += comps;
+	  }
+     }
+   return 0;
+}
+
 static int
 _epeg_decode_for_trim(Epeg_Image *im)
 {
@@ -1222,8 +1528,21 @@ _epeg_encode(Epeg_Image *im)
 	jpeg_write_marker(&(im->out.jinfo), JPEG_APP0 + 7, buf, strlen(buf));
      }
    
-   while (im->out.jinfo.next_scanline < im->out.h)
-     jpeg_write_scanlines(&(im->out.jinfo), &(im->lines[im->out.jinfo.next_scanline]), 1);
+   if (im->stream.active)
+     {
+	while (im->out.jinfo.next_scanline < im->out.h)
+	  {
+	     JSAMPROW row = _epeg_stream_line(im, im->out.jinfo.next_scanline);
+
+	     jpeg_write_scanlines(&(im->out.jinfo), &row, 1);
+	  }
+	jpeg_abort_decompress(&(im->in.jinfo));
+     }
+   else
+     {
+	while (im->out.jinfo.next_scanline < im->out.h)
+	  jpeg_write_scanlines(&(im->out.jinfo), &(im->lines[im->out.jinfo.next_scanline]), 1);
+     }
    jpeg_finish_compress(&(im->out.jinfo));
 
    done:
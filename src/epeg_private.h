@@ -33,6 +33,17 @@ struct _Epeg_Image
    
    Epeg_Colorspace                 color_space;
    
+   struct {
+      int                            x, y;
+      int                            w, h;
+      JDIMENSION                     left, top, width;
+   } crop;
+   
+   struct {
+      unsigned long                  max_memory;
+      char                           active : 1;
+   } stream;
+   
    struct {
       char                          *file;
       struct {
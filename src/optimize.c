@@ -0,0 +1,156 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <setjmp.h>
+#include <jpeglib.h>
+#include <jerror.h>
+
+#include "optimize.h"
+
+struct _optimize_error_mgr
+{
+   struct jpeg_error_mgr pub;
+   jmp_buf               setjmp_buffer;
+};
+
+static void
+_optimize_error_exit(j_common_ptr cinfo)
+{
+   struct _optimize_error_mgr *err = (struct _optimize_error_mgr *) cinfo->err;
+
+   longjmp(err->setjmp_buffer, 1);
+}
+
+/* Destination manager writing to a growing malloc'ed buffer */
+struct _optimize_destination_mgr
+{
+   struct jpeg_destination_mgr pub;
+   unsigned char              *buffer;
+   size_t                      size;
+};
+
+static void
+_optimize_init_destination(j_compress_ptr cinfo)
+{
+}
+
+static boolean
+_optimize_empty_output_buffer(j_compress_ptr cinfo)
+{
+   struct _optimize_destination_mgr *dest =
+     (struct _optimize_destination_mgr *) cinfo->dest;
+   unsigned char *buffer = realloc(dest->buffer, dest->size * 2);
+
+   if (!buffer)
+     ERREXIT1(cinfo, JERR_OUT_OF_MEMORY, 10);
+   dest->pub.next_output_byte = buffer + dest->size;
+   dest->pub.free_in_buffer = dest->size;
+   dest->buffer = buffer;
+   dest->size *= 2;
+   return TRUE;
+}
+
+static void
+_optimize_term_destination(j_compress_ptr cinfo)
+{
+}
+
+static void
+_optimize_emit_message(j_common_ptr cinfo, int msg_level)
+{
+   /* Corrupt data warnings are not fatal, like in tjTransform */
+}
+
+/*
+ * Copy the saved APPn and COM markers to the output, except for the JFIF
+ * and Adobe markers which libjpeg already writes itself.
+ */
+static void
+_optimize_copy_markers(j_decompress_ptr src, j_compress_ptr dst)
+{
+   jpeg_saved_marker_ptr marker;
+
+   for (marker = src->marker_list; marker; marker = marker->next)
+     {
+        if (dst->write_JFIF_header && marker->marker == JPEG_APP0 &&
+            marker->data_length >= 5 && marker->data[0] == 'J' &&
+            marker->data[1] == 'F' && marker->data[2] == 'I' &&
+            marker->data[3] == 'F' && marker->data[4] == 0)
+          continue;
+        if (dst->write_Adobe_marker && marker->marker == JPEG_APP0 + 14 &&
+            marker->data_length >= 5 && marker->data[0] == 'A' &&
+            marker->data[1] == 'd' && marker->data[2] == 'o' &&
+            marker->data[3] == 'b' && marker->data[4] == 'e')
+          continue;
+        jpeg_write_marker(dst, marker->marker, marker->data,
+                          marker->data_length);
+     }
+}
+
+/**
+ * Losslessly re-encode a JPEG image with optimized Huffman tables.
+ *
+ * Only the entropy coding is redone, the DCT coefficients and all APPn and
+ * COM markers are copied as they are. This is what TJXOPT_OPTIMIZE does in
+ * turbojpeg 3.0 and later.
+ *
+ * The output buffer is allocated with malloc and must be freed by the
+ * caller. Returns 0 on success and 1 on failure.
+ */
+int
+optimize_coding(const unsigned char *src, unsigned long src_size,
+                unsigned char **dst, unsigned long *dst_size)
+{
+   struct jpeg_decompress_struct  dinfo;
+   struct jpeg_compress_struct    cinfo;
+   struct _optimize_error_mgr        err;
+   struct _optimize_destination_mgr  dest;
+   jvirt_barray_ptr                 *coefs;
+   int                               i;
+
+   /* Most of the time the output is slightly smaller than the input */
+   dest.size = src_size > 4096 ? src_size : 4096;
+   dest.buffer = malloc(dest.size);
+   if (!dest.buffer)
+     return 1;
+   dest.pub.init_destination = _optimize_init_destination;
+   dest.pub.empty_output_buffer = _optimize_empty_output_buffer;
+   dest.pub.term_destination = _optimize_term_destination;
+   dest.pub.next_output_byte = dest.buffer;
+   dest.pub.free_in_buffer = dest.size;
+
+   /* Both objects share the error manager */
+   dinfo.err = jpeg_std_error(&(err.pub));
+   cinfo.err = &(err.pub);
+   err.pub.error_exit = _optimize_error_exit;
+   err.pub.emit_message = _optimize_emit_message;
+   jpeg_create_decompress(&dinfo);
+   jpeg_create_compress(&cinfo);
+   if (setjmp(err.setjmp_buffer))
+     {
+        jpeg_destroy_compress(&cinfo);
+        jpeg_destroy_decompress(&dinfo);
+        free(dest.buffer);
+        return 1;
+     }
+
+   jpeg_mem_src(&dinfo, (unsigned char *) src, src_size);
+   jpeg_save_markers(&dinfo, JPEG_COM, 0xFFFF);
+   for (i = 0; i < 16; i++)
+     jpeg_save_markers(&dinfo, JPEG_APP0 + i, 0xFFFF);
+   jpeg_read_header(&dinfo, TRUE);
+   coefs = jpeg_read_coefficients(&dinfo);
+
+   jpeg_copy_critical_parameters(&dinfo, &cinfo);
+   cinfo.optimize_coding = TRUE;
+   cinfo.dest = &(dest.pub);
+   jpeg_write_coefficients(&cinfo, coefs);
+   _optimize_copy_markers(&dinfo, &cinfo);
+   jpeg_finish_compress(&cinfo);
+
+   jpeg_destroy_compress(&cinfo);
+   jpeg_finish_decompress(&dinfo);
+   jpeg_destroy_decompress(&dinfo);
+   *dst = dest.buffer;
+   *dst_size = dest.size - dest.pub.free_in_buffer;
+   return 0;
+}
@@ -0,0 +1,7 @@
+#ifndef _OPTIMIZE_H
+#define _OPTIMIZE_H
+
+int optimize_coding(const unsigned char *src, unsigned long src_size,
+                    unsigned char **dst, unsigned long *dst_size);
+
+#endif
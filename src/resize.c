@@ -0,0 +1,161 @@
+#include <stdlib.h>
+#include <math.h>
+
+#include "resize.h"
+
+/* Fixed point precision of the filter weights */
+#define WEIGHT_BITS 14
+#define WEIGHT_ONE  (1 << WEIGHT_BITS)
+/* Extra precision kept between the horizontal and the vertical pass */
+#define EXTRA_BITS  4
+
+typedef struct
+{
+   int  *start;
+   int  *count;
+   int  *weights;
+   int   max_count;
+} Contributions;
+
+static void
+_contributions_free(Contributions *c)
+{
+   free(c->start);
+   free(c->count);
+   free(c->weights);
+}
+
+/*
+ * Compute which source pixels contribute to every destination pixel along
+ * one axis and by how much, i.e. the area of the source pixel covered by
+ * the destination pixel. The weights of a destination pixel add up to
+ * exactly WEIGHT_ONE.
+ */
+static int
+_contributions_init(Contributions *c, int src_size, double offset,
+                    double size, int dst_size)
+{
+   double scale = size / dst_size;
+   int    i, j;
+
+   c->max_count = (int) ceil(scale) + 1;
+   c->start = malloc(dst_size * sizeof(int));
+   c->count = malloc(dst_size * sizeof(int));
+   c->weights = malloc(dst_size * c->max_count * sizeof(int));
+   if (!c->start || !c->count || !c->weights)
+     {
+        _contributions_free(c);
+        return 1;
+     }
+
+   for (i = 0; i < dst_size; i++)
+     {
+        double lo = offset + i * scale;
+        double hi = lo + scale;
+        int    first = (int) floor(lo);
+        int    last = (int) ceil(hi) - 1;
+        int   *weights = c->weights + i * c->max_count;
+        int    total = 0, largest = 0;
+
+        if (first < 0) first = 0;
+        if (last > src_size - 1) last = src_size - 1;
+        if (last < first) last = first;
+        if (last - first + 1 > c->max_count) last = first + c->max_count - 1;
+        c->start[i] = first;
+        c->count[i] = last - first + 1;
+        for (j = 0; j < c->count[i]; j++)
+          {
+             double pixel_lo = first + j, pixel_hi = first + j + 1;
+             double overlap = (hi < pixel_hi ? hi : pixel_hi) -
+                              (lo > pixel_lo ? lo : pixel_lo);
+
+             if (overlap < 0) overlap = 0;
+             weights[j] = (int) (overlap / scale * WEIGHT_ONE + 0.5);
+             total += weights[j];
+             if (weights[j] > weights[largest]) largest = j;
+          }
+        /* Rounding errors go to the most significant pixel */
+        weights[largest] += WEIGHT_ONE - total;
+     }
+   return 0;
+}
+
+/**
+ * Resize a rectangle of an interleaved 8 bit image with an area (box)
+ * filter.
+ *
+ * The rectangle given by x, y, w and h may have fractional bounds and is
+ * mapped onto the whole destination image, which is written without row
+ * padding. Every destination pixel is the average of the source area it
+ * covers, which avoids the aliasing of nearest neighbour sampling.
+ *
+ * Returns 0 on success and 1 if memory could not be allocated.
+ */
+int
+resize_area(const unsigned char *src, int src_w, int src_h, int pitch,
+            int comps, double x, double y, double w, double h,
+            unsigned char *dst, int dst_w, int dst_h)
+{
+   Contributions   cx, cy;
+   unsigned int   *row, *acc;
+   int             X, Y, i, j, k, ret = 1;
+
+   if (_contributions_init(&cx, src_w, x, w, dst_w) != 0)
+     return 1;
+   if (_contributions_init(&cy, src_h, y, h, dst_h) != 0)
+     {
+        _contributions_free(&cx);
+        return 1;
+     }
+   row = malloc(dst_w * comps * sizeof(unsigned int));
+   acc = malloc(dst_w * comps * sizeof(unsigned int));
+   if (!row || !acc) goto done;
+
+   for (Y = 0; Y < dst_h; Y++)
+     {
+        const int *wy = cy.weights + Y * cy.max_count;
+
+        for (i = 0; i < dst_w * comps; i++)
+          acc[i] = 0;
+        for (j = 0; j < cy.count[Y]; j++)
+          {
+             const unsigned char *line =
+                src + (size_t) (cy.start[Y] + j) * pitch;
+
+             if (wy[j] == 0) continue;
+             /* Horizontal pass over one source line */
+             for (X = 0; X < dst_w; X++)
+               {
+                  const int           *wx = cx.weights + X * cx.max_count;
+                  const unsigned char *p = line + cx.start[X] * comps;
+
+                  for (k = 0; k < comps; k++)
+                    {
+                       unsigned int sum = 0;
+
+                       for (i = 0; i < cx.count[X]; i++)
+                         sum += p[i * comps + k] * wx[i];
+                       row[X * comps + k] =
+                          (sum + (1 << (WEIGHT_BITS - EXTRA_BITS - 1)))
+                          >> (WEIGHT_BITS - EXTRA_BITS);
+                    }
+               }
+             for (i = 0; i < dst_w * comps; i++)
+               acc[i] += row[i] * wy[j];
+          }
+        for (i = 0; i < dst_w * comps; i++)
+          {
+             unsigned int v = (acc[i] + (1 << (WEIGHT_BITS + EXTRA_BITS - 1)))
+                              >> (WEIGHT_BITS + EXTRA_BITS);
+             dst[(size_t) Y * dst_w * comps + i] = v > 255 ? 255 : v;
+          }
+     }
+   ret = 0;
+
+done:
+   free(row);
+   free(acc);
+   _contributions_free(&cx);
+   _contributions_free(&cy);
+   return ret;
+}
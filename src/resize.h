@@ -0,0 +1,8 @@
+#ifndef _RESIZE_H
+#define _RESIZE_H
+
+int resize_area(const unsigned char *src, int src_w, int src_h, int pitch,
+                int comps, double x, double y, double w, double h,
+                unsigned char *dst, int dst_w, int dst_h);
+
+#endif
@@ -0,0 +1,89 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <setjmp.h>
+#include <jpeglib.h>
+#include <jerror.h>
+
+#include "validate.h"
+
+struct _validate_error_mgr
+{
+   struct jpeg_error_mgr pub;
+   jmp_buf               setjmp_buffer;
+   char                 *message;
+};
+
+static void
+_validate_error_exit(j_common_ptr cinfo)
+{
+   struct _validate_error_mgr *err = (struct _validate_error_mgr *) cinfo->err;
+
+   (*cinfo->err->format_message)(cinfo, err->message);
+   longjmp(err->setjmp_buffer, 1);
+}
+
+static void
+_validate_emit_message(j_common_ptr cinfo, int msg_level)
+{
+   struct _validate_error_mgr *err = (struct _validate_error_mgr *) cinfo->err;
+
+   /* Warnings are reported with level -1, only the first one is kept */
+   if (msg_level < 0 && err->pub.num_warnings++ == 0)
+     (*cinfo->err->format_message)(cinfo, err->message);
+}
+
+/**
+ * Decode the entropy-coded data of an image to check it for corruption.
+ *
+ * The image is decompressed at 1/8 scale (i.e. from the DC coefficients)
+ * into a single row, so every Huffman code is decoded but hardly anything
+ * else is done. No image-sized buffers are allocated for baseline images,
+ * progressive images need libjpeg's coefficient buffer regardless.
+ *
+ * Returns 0 if the image is valid, 1 if libjpeg warned about corrupt data
+ * and 2 if decoding failed, in both cases with the (first) message written
+ * to message, which must hold VALIDATE_MESSAGE_LENGTH bytes.
+ */
+int
+validate_jpeg(const unsigned char *src, unsigned long src_size,
+              char *message)
+{
+   struct jpeg_decompress_struct dinfo;
+   struct _validate_error_mgr jerr;
+   JSAMPARRAY row;
+   int rv;
+
+   message[0] = '\0';
+   dinfo.err = jpeg_std_error(&jerr.pub);
+   jerr.pub.error_exit = _validate_error_exit;
+   jerr.pub.emit_message = _validate_emit_message;
+   jerr.message = message;
+   if (setjmp(jerr.setjmp_buffer))
+     {
+        jpeg_destroy_decompress(&dinfo);
+        return 2;
+     }
+
+   jpeg_create_decompress(&dinfo);
+   jpeg_mem_src(&dinfo, (unsigned char *) src, src_size);
+   jpeg_read_header(&dinfo, TRUE);
+   dinfo.scale_num = 1;
+   dinfo.scale_denom = 8;
+   dinfo.dct_method = JDCT_IFAST;
+   dinfo.do_fancy_upsampling = FALSE;
+   /* The chroma components are still entropy decoded, but not converted */
+   if (dinfo.jpeg_color_space == JCS_YCbCr)
+     dinfo.out_color_space = JCS_GRAYSCALE;
+   jpeg_start_decompress(&dinfo);
+
+   row = (*dinfo.mem->alloc_sarray)((j_common_ptr) &dinfo, JPOOL_IMAGE,
+                                    dinfo.output_width *
+                                    dinfo.output_components, 1);
+   while (dinfo.output_scanline < dinfo.output_height)
+     jpeg_read_scanlines(&dinfo, row, 1);
+   jpeg_finish_decompress(&dinfo);
+
+   rv = jerr.pub.num_warnings ? 1 : 0;
+   jpeg_destroy_decompress(&dinfo);
+   return rv;
+}
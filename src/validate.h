@@ -0,0 +1,10 @@
+#ifndef _VALIDATE_H
+#define _VALIDATE_H
+
+/* Size of the message buffer, see JMSG_LENGTH_MAX in jpeglib.h */
+#define VALIDATE_MESSAGE_LENGTH 200
+
+int validate_jpeg(const unsigned char *src, unsigned long src_size,
+                  char *message);
+
+#endif
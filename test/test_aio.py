@@ -0,0 +1,56 @@
+import pytest
+
+from jpegtran import JPEGImage
+
+asyncio = pytest.importorskip('asyncio')
+
+
+@pytest.fixture
+def image():
+    with open('test/test.jpg', 'rb') as fp:
+        return JPEGImage(blob=fp.read())
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_aopen(loop):
+    image = loop.run_until_complete(JPEGImage.aopen('test/test.jpg'))
+    assert image.width == 480
+
+
+def test_arotate(image, loop):
+    rotated = loop.run_until_complete(image.arotate(90))
+    assert rotated.width == image.height
+    assert rotated.height == image.width
+    progressive = loop.run_until_complete(
+        image.acrop(0, 0, 160, 160, progressive=True))
+    assert progressive.header.progressive
+    assert progressive.as_blob() == image.crop(
+        0, 0, 160, 160, progressive=True).as_blob()
+
+
+def test_concurrent(image, loop):
+    from jpegtran import aio
+    limit = aio.get_limit()
+    aio.set_limit(2)
+    try:
+        tasks = [loop.create_task(image.adownscale(240, 180))
+                 for _ in range(4)]
+        results = loop.run_until_complete(asyncio.gather(*tasks))
+        assert [r.width for r in results] == [240]*4
+        assert aio.get_limit() == 2
+        assert aio.pending() == 0
+    finally:
+        aio.set_limit(limit)
+
+
+def test_cancel(image, loop):
+    task = loop.create_task(image.arotate(90))
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        loop.run_until_complete(task)
@@ -0,0 +1,85 @@
+import sys
+
+import pytest
+
+from jpegtran import JPEGImage, batch
+
+
+@pytest.fixture
+def image():
+    with open('test/test.jpg', 'rb') as fp:
+        return JPEGImage(blob=fp.read())
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_map(image, backend):
+    inputs = ['test/test.jpg', image.as_blob(), image]
+    results = list(batch.map([('rotate', 90), 'transpose'], inputs,
+                             workers=2, backend=backend))
+    assert sorted(r.index for r in results) == [0, 1, 2]
+    for result in results:
+        assert result.error is None
+        assert result.image.width == image.width
+        assert result.image.height == image.height
+
+
+def _rotate(image):
+    return image.rotate(90)
+
+
+@pytest.mark.parametrize('backend', ['thread', 'auto'])
+def test_map_callable(image, backend):
+    # Lambdas cannot be pickled, so they run on threads
+    for ops in (lambda im: im.rotate(90), _rotate):
+        results = list(batch.map(ops, ['test/test.jpg'], workers=1,
+                                 backend=backend))
+        assert results[0].error is None
+        assert results[0].image.width == image.height
+
+
+def test_map_errors(image):
+    results = sorted(batch.map([('rotate', 90)], [b'garbage', image],
+                               workers=1, max_pending=1))
+    assert results[0].image is None
+    assert isinstance(results[0].error, ValueError)
+    assert results[1].error is None
+    # Invalid arguments are rejected by the call, not on iteration
+    for kwargs in ({'backend': 'fork'}, {'workers': 0},
+                   {'max_pending': 0}):
+        with pytest.raises(ValueError):
+            batch.map([('rotate', 90)], [image], **kwargs)
+
+
+def test_map_output(image, tmpdir):
+    results = list(batch.map([('flip', 'vertical')], ['test/test.jpg'],
+                             output=str(tmpdir)))
+    assert results[0].image is None
+    assert JPEGImage(str(tmpdir.join('test.jpg'))).width == image.width
+
+
+def test_apply_ops(image):
+    assert batch.apply_ops(['exif_autotransform'], image) is image
+    with pytest.raises(ValueError):
+        batch.apply_ops(['_update_thumbnail'], image)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 0), reason="Python 3 only")
+def test_to_arrays(image):
+    data = bytearray(3*90*120*3)
+    out = memoryview(data).cast('B', (3, 90, 120, 3))
+    batch.to_arrays(['test/test.jpg', image.as_blob(), image], out,
+                    workers=2)
+    frame = memoryview(image.to_array((120, 90))).tobytes()
+    assert data == frame*3
+    with pytest.raises(ValueError):
+        batch.to_arrays([image], out)
+    with pytest.raises(ValueError):
+        batch.to_arrays([image]*3, out, colorspace='GRAY')
+
+
+def test_hashes(image):
+    hashes = batch.hashes(['test/test.jpg', image.rotate(90)], workers=2)
+    assert hashes == [image.phash(), image.rotate(90).phash()]
+    assert batch.hashes([image], 'dhash') == [image.dhash()]
+    with pytest.raises(ValueError):
+        batch.hashes([image], 'ahash')
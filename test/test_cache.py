@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+from jpegtran import JPEGImage, batch
+from jpegtran.cache import (DiskCache, MemoryCache, ResultCache,
+                            normalize_ops)
+
+
+@pytest.fixture
+def image():
+    with open('test/test.jpg', 'rb') as fp:
+        return JPEGImage(blob=fp.read())
+
+
+def test_normalize_ops():
+    assert (normalize_ops([('rotate', -90)]) ==
+            normalize_ops([('rotate', 270)]))
+    assert (normalize_ops([('downscale', 320, 240)]) ==
+            normalize_ops([('downscale', 320, 240, 75)]))
+    assert (normalize_ops(['transpose']) == normalize_ops([('transpose',)]))
+    assert (normalize_ops([('downscale', 320, 240, 80)]) !=
+            normalize_ops([('downscale', 320, 240, 75)]))
+    with pytest.raises(ValueError):
+        normalize_ops([('_update_thumbnail',)])
+    with pytest.raises(ValueError):
+        normalize_ops(lambda img: img)
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_bytes=10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    assert cache.get('a') == b'12345'
+    cache.put('c', b'123')
+    # 'b' is the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    cache.put('d', b'12345678901')
+    assert cache.get('d') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes']) == (2, 8)
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 2, 1)
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=10)
+    cache.put('aa01', b'12345')
+    cache.put('bb02', b'12345')
+    os.utime(cache._path('aa01'), (0, 0))
+    cache.put('cc03', b'123')
+    # Evicted down to 90% of the limit, oldest first
+    assert cache.get('aa01') is None
+    assert cache.get('bb02') == b'12345'
+    assert cache.get('cc03') == b'123'
+    # Another process sees the same entries
+    assert DiskCache(str(tmpdir)).get('cc03') == b'123'
+    assert cache.stats()['evictions'] == 1
+    cache.clear()
+    assert cache.get('bb02') is None
+
+
+def test_result_cache(image, tmpdir):
+    cache = ResultCache(directory=str(tmpdir))
+    ops = [('rotate', 90), ('downscale', 180, 240)]
+    result = cache.apply(ops, image)
+    assert cache.stats()['misses'] == 1
+    cached = cache.apply([('rotate', 90), ('downscale', 180, 240, 75)],
+                         JPEGImage(blob=bytearray(image.data)))
+    assert cached.as_blob() == result.as_blob()
+    assert cache.stats()['memory']['hits'] == 1
+    # Disk hit from a fresh memory tier
+    cache.memory.clear()
+    assert cache.apply(ops, image).as_blob() == result.as_blob()
+    assert cache.stats()['disk']['hits'] == 1
+    # Settings that change the result are part of the key
+    image.scale_engine = 'turbo'
+    assert cache.key(ops, image) != cache.key(ops, JPEGImage(blob=image.data))
+    assert cache.apply(ops, image).scale_engine == 'turbo'
+
+
+def test_result_cache_class_settings(image):
+    cache = ResultCache()
+    ops = [('downscale', 180, 240)]
+    key = cache.key(ops, image)
+    engine, JPEGImage.scale_engine = JPEGImage.scale_engine, 'turbo'
+    try:
+        assert cache.key(ops, image) != key
+    finally:
+        JPEGImage.scale_engine = engine
+    assert cache.key(ops, image) == key
+
+
+def test_result_cache_attributes(image, tmpdir):
+    cache = ResultCache(directory=str(tmpdir))
+    thumb_op = ('downscale', 180, 240, 90, None, None, None, None, 4000)
+    optimized = cache.apply(['optimize'], image)
+    thumb = cache.apply([thumb_op], image)
+    for _ in range(2):
+        cached = cache.apply(['optimize'], image)
+        assert cached.bytes_saved == optimized.bytes_saved
+        assert cached.as_blob() == optimized.as_blob()
+        cached = cache.apply([thumb_op], image)
+        assert cached.quality == thumb.quality
+        assert cached.as_blob() == thumb.as_blob()
+        cache.memory.clear()
+    assert cache.stats()['disk']['hits'] == 2
+    # Results without attributes are stored as they are
+    cache.apply([('rotate', 90)], image)
+    assert not hasattr(cache.apply([('rotate', 90)], image), 'bytes_saved')
+
+
+def test_result_cache_batch(image, tmpdir):
+    cache = ResultCache(directory=str(tmpdir))
+    for _ in range(2):
+        results = list(batch.map([('rotate', 90)], [image, image],
+                                 workers=2, backend='process', cache=cache))
+        assert all(r.error is None for r in results)
+    # The disk tier is shared with the worker processes
+    assert len(tmpdir.listdir()) == 1
+    assert cache.apply([('rotate', 90)], image).width == image.height
+    assert cache.stats()['disk']['hits'] == 1
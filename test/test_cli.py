@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from jpegtran import JPEGImage
+from jpegtran.cli import expand_inputs, main, parse_operation
+
+
+@pytest.fixture
+def corpus(tmpdir):
+    tmpdir.mkdir('in').mkdir('sub')
+    shutil.copy('test/test.jpg', str(tmpdir.join('in', 'a.jpg')))
+    shutil.copy('test/test.jpg', str(tmpdir.join('in', 'sub', 'b.jpeg')))
+    tmpdir.join('in', 'sub', 'broken.jpg').write(b'garbage', 'wb')
+    tmpdir.join('in', 'notes.txt').write('not an image')
+    return tmpdir
+
+
+def test_parse_operation():
+    assert parse_operation('autotransform') == ('exif_autotransform', (), {})
+    assert parse_operation('downscale:320,240,85') == (
+        'downscale', (320, 240, 85), {})
+    assert parse_operation('rotate:90,progressive=true') == (
+        'rotate', (90,), {'progressive': True})
+    assert parse_operation('flip:vertical')[1] == ('vertical',)
+    with pytest.raises(ValueError):
+        parse_operation('save:x.jpg')
+    with pytest.raises(ValueError):
+        parse_operation('crop:x=1,2')
+
+
+def test_expand_inputs(corpus):
+    inputs = sorted(rel for _, rel in expand_inputs([str(corpus.join('in'))]))
+    assert inputs == ['a.jpg', os.path.join('sub', 'b.jpeg'),
+                      os.path.join('sub', 'broken.jpg')]
+    pattern = str(corpus.join('in', 's*', '*.jpeg'))
+    assert list(expand_inputs([pattern])) == [
+        (str(corpus.join('in', 'sub', 'b.jpeg')),
+         os.path.join('sub', 'b.jpeg'))]
+
+
+def test_output(corpus, capsys):
+    manifest = str(corpus.join('manifest.jsonl'))
+    args = ['--output', str(corpus.join('out')), '-o', 'rotate:90',
+            '-o', 'optimize', '--manifest', manifest, '-j', '2',
+            str(corpus.join('in'))]
+    assert main(args) == 1
+    out, err = capsys.readouterr()
+    assert '2 files processed, 1 failed, 0 skipped' in out
+    assert 'files/s' in out and 'MB/s' in out and 'bytes saved' in out
+    assert 'broken.jpg' in err
+    expected = JPEGImage('test/test.jpg').rotate(90).optimize().as_blob()
+    assert corpus.join('out', 'sub', 'b.jpeg').read('rb') == expected
+    with open(manifest) as fp:
+        entries = [json.loads(line) for line in fp]
+    assert sorted(e['error'] is None for e in entries) == [False, True, True]
+
+    # Resuming only retries the failed file, even after an interrupted write
+    with open(manifest, 'a') as fp:
+        fp.write('{"source": ')
+    assert main(args) == 1
+    assert '0 files processed, 1 failed, 2 skipped' in capsys.readouterr()[0]
+    assert main(args) == 1
+    assert '0 files processed, 1 failed, 2 skipped' in capsys.readouterr()[0]
+
+
+def test_autotransform_without_exif(corpus, capsys):
+    image = JPEGImage('test/test.jpg')
+    stripped = image.pipeline(strip_metadata=True).execute()
+    assert stripped.exif_orientation is None
+    stripped.save(str(corpus.join('in', 'a.jpg')))
+    manifest = str(corpus.join('manifest.jsonl'))
+    assert main(['--output', str(corpus.join('out')), '-q', '--manifest',
+                 manifest, '-o', 'autotransform', '-o', 'rotate:90',
+                 str(corpus.join('in', 'a.jpg'))]) == 0
+    assert corpus.join('out', 'a.jpg').read('rb') == \
+        stripped.rotate(90).as_blob()
+    with open(manifest) as fp:
+        assert json.loads(fp.readline())['error'] is None
+    # Written to the output directory even if nothing changed
+    assert main(['--output', str(corpus.join('copy')), '-q', '-o',
+                 'autotransform', str(corpus.join('in', 'a.jpg'))]) == 0
+    assert corpus.join('copy', 'a.jpg').read('rb') == stripped.as_blob()
+
+
+def test_in_place(corpus, capsys):
+    fname = str(corpus.join('in', 'a.jpg'))
+    os.chmod(fname, 0o640)
+    assert main(['--in-place', '-q', '-o', 'rotate:180', fname]) == 0
+    assert not capsys.readouterr()[0]
+    assert JPEGImage(fname).as_blob() == \
+        JPEGImage('test/test.jpg').rotate(180).as_blob()
+    assert os.stat(fname).st_mode & 0o777 == 0o640
+    # No temporary files are left behind
+    assert sorted(os.listdir(str(corpus.join('in')))) == [
+        'a.jpg', 'notes.txt', 'sub']
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from jpegtran import JPEGImage
+from jpegtran.tiles import DeepZoom
+
+
+@pytest.fixture
+def image():
+    with open('test/test.jpg', 'rb') as fp:
+        return JPEGImage(blob=fp.read())
+
+
+def test_levels(image):
+    pyramid = DeepZoom(image, tile_size=200)
+    assert pyramid.tile_size == 208
+    assert pyramid.max_level == 9
+    assert pyramid.level_size(9) == (480, 360)
+    assert pyramid.level_size(8) == (240, 180)
+    assert pyramid.level_size(0) == (1, 1)
+
+
+def test_tiles(image):
+    tiles = dict(((level, col, row), tile) for level, col, row, tile
+                 in DeepZoom(image, tile_size=128).tiles())
+    assert tiles[(9, 3, 2)].width == 480 - 3*128
+    assert tiles[(9, 3, 2)].height == 360 - 2*128
+    assert tiles[(9, 0, 0)].exif_thumbnail is None
+    assert (9, 4, 0) not in tiles
+    assert tiles[(8, 1, 1)].width == 240 - 128
+    assert tiles[(0, 0, 0)].width == 1
+
+
+def test_tiles_color_segments(image):
+    # An Adobe marker without color transform, i.e. RGB, and an ICC
+    # profile are kept, unlike the other metadata
+    adobe = b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+    icc = b'\xff\xe2\x00\x14ICC_PROFILE\x00\x01\x01fake'
+    data = image.as_blob()
+    image = JPEGImage(blob=data[:2] + adobe + icc + data[2:])
+    assert image.header.colorspace == 'RGB'
+    tile = next(t for level, _, _, t in DeepZoom(image).tiles()
+                if level == 9)
+    assert tile.header.colorspace == 'RGB'
+    assert tile.exif is None
+    assert icc in tile.as_blob()
+
+
+def test_save(image, tmpdir):
+    basename = str(tmpdir.join('test'))
+    stats = DeepZoom(image).save(basename)
+    assert stats['levels'] == 10
+    tiles = list(tmpdir.join('test_files').visit('*.jpg'))
+    assert stats['tiles'] == len(tiles)
+    assert os.path.exists(basename + '.dzi')
+    assert JPEGImage(str(tmpdir.join('test_files', '9', '1_1.jpg'))).width \
+        == 480 - 256
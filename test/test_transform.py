@@ -1,3 +1,5 @@
+import io
+
 import pytest
 
 from jpegtran import JPEGImage
@@ -23,6 +25,33 @@ def test_set_orientation(image):
     assert image.exif_orientation == 6
 
 
+def test_exif_tags(image):
+    exif = image.exif
+    assert exif is image.exif
+    assert exif['Model'] == 'Canon PowerShot S40'
+    assert exif['DateTimeOriginal'] == '2003:12:14 12:01:44'
+    assert exif['ExposureTime'] == (1, 500)
+    assert exif[0x112] == exif[('IFD0', 0x112)] == 1
+    assert 'GPSLatitude' not in exif
+    assert exif.get('GPSLatitude') is None
+    assert ('Exif', 0x9003) in exif.keys()
+
+
+def test_set_exif(image):
+    blob = image.as_blob()
+    image.set_exif('DateTimeOriginal', '2020:01:02 03:04:05')
+    image.set_exif('Model', 'S40')
+    image.set_exif('XResolution', (300, 1))
+    assert image.exif['DateTimeOriginal'] == '2020:01:02 03:04:05'
+    assert image.exif['Model'] == 'S40'
+    assert JPEGImage(blob=image.as_blob()).exif['XResolution'] == (300, 1)
+    assert image.data != blob
+    with pytest.raises(ValueError):
+        image.set_exif('DateTimeOriginal', '2020:01:02 03:04:05 and more')
+    with pytest.raises(ValueError):
+        image.set_exif('XResolution', ((300, 1), (300, 1)))
+
+
 def test_get_exif_thumbnail(image):
     thumb = image.exif_thumbnail
     assert thumb.width == 160
@@ -105,3 +134,446 @@ def test_downscale(image):
     scaled = image.downscale(240, 180)
     assert scaled.width == 240
     assert scaled.height == 180
+
+
+def test_downscale_region(image):
+    scaled = image.downscale(64, 32, quality=100, region=(64, 32, 256, 128))
+    assert scaled.width == 64
+    assert scaled.height == 32
+    # Aligned with the DCT scaling, so the region is decoded exactly as the
+    # corresponding part of the whole image
+    reference = image.downscale(120, 90, quality=100).crop(16, 8, 64, 32)
+    assert (scaled.downscale(8, 4, quality=100).as_blob() ==
+            reference.downscale(8, 4, quality=100).as_blob())
+    with pytest.raises(ValueError):
+        image.downscale(10, 10, region=(470, 0, 20, 20))
+    with pytest.raises(ValueError):
+        image.downscale(200, 100, region=(0, 0, 100, 100))
+
+
+@pytest.mark.parametrize('profile', ['fast', 'balanced', 'quality'])
+def test_downscale_turbo(image, profile):
+    scaled = image.downscale(111, 83, engine='turbo', profile=profile)
+    assert scaled.width == 111
+    assert scaled.height == 83
+    assert scaled.header.subsampling == image.header.subsampling
+    scaled = image.downscale(50, 25, region=(13, 7, 300, 201),
+                             engine='turbo', profile=profile)
+    assert scaled.width == 50
+    assert scaled.height == 25
+
+
+def test_downscale_turbo_default(image):
+    image.scale_engine = 'turbo'
+    image.scale_profile = 'fast'
+    scaled = image.downscale(240, 180)
+    assert scaled.scale_engine == 'turbo'
+    assert scaled.scale_profile == 'fast'
+    assert JPEGImage.scale_engine == 'epeg'
+    with pytest.raises(ValueError):
+        image.downscale(240, 180, engine='pillow')
+    with pytest.raises(ValueError):
+        image.downscale(240, 180, profile='best')
+
+
+@pytest.mark.parametrize('engine', ['epeg', 'turbo'])
+def test_downscale_max_memory(image, engine):
+    for size, region in (((111, 83), None), ((50, 25), (13, 7, 300, 201))):
+        streamed = image.downscale(size[0], size[1], region=region,
+                                   engine=engine, max_memory=1024)
+        assert streamed.width == size[0]
+        assert (streamed.as_blob() ==
+                image.downscale(size[0], size[1], region=region).as_blob())
+    # Progressive images need a buffer for the whole image
+    with open('test/test_thumb.jpg', 'rb') as fp:
+        progressive = JPEGImage(blob=fp.read())
+    with pytest.raises(Exception):
+        progressive.downscale(100, 66, engine=engine, max_memory=1024)
+
+
+def test_downscale_many(image):
+    sizes = [(320, 240), (160, 120), (80, 60)]
+    renditions = image.downscale_many(sizes, quality=[90, 80, 70])
+    assert [(r.width, r.height) for r in renditions] == sizes
+    # The largest one is scaled from the decoded image like by downscale
+    assert (renditions[0].as_blob() ==
+            image.downscale(320, 240, 90, engine='turbo').as_blob())
+    parallel = image.downscale_many(sizes, quality=[90, 80, 70], workers=3)
+    assert ([r.as_blob() for r in parallel] ==
+            [r.as_blob() for r in renditions])
+    region = (16, 16, 200, 100)
+    cropped = image.downscale_many([(100, 50)], region=region)[0]
+    assert (cropped.as_blob() ==
+            image.downscale(100, 50, region=region, engine='turbo').as_blob())
+    assert image.downscale_many([(480, 360)]) == [image]
+    with pytest.raises(ValueError):
+        image.downscale_many([(960, 720)])
+    with pytest.raises(ValueError):
+        image.downscale_many(sizes, quality=[90, 80])
+
+
+def test_downscale_max_bytes(image):
+    scaled = image.downscale(320, 240, quality=90, max_bytes=8000)
+    assert len(scaled.data) <= 8000
+    assert 1 <= scaled.quality < 90
+    # The next quality does not fit
+    assert len(image.downscale(320, 240, scaled.quality + 1,
+                               engine='turbo').data) > 8000
+    assert image.downscale(320, 240, 60, max_bytes=10**6).quality == 60
+    with pytest.raises(ValueError):
+        image.downscale(320, 240, max_bytes=100)
+    renditions = image.downscale_many([(320, 240), (160, 120)],
+                                      max_bytes=[8000, None])
+    assert renditions[0].quality == scaled.quality
+    assert not hasattr(renditions[1], 'quality')
+
+
+def test_search_quality():
+    from jpegtran.lib import search_quality
+    calls = []
+
+    def encode(quality):
+        calls.append(quality)
+        return b'x'*(quality*10)
+    assert search_quality(encode, 555, 90) == (b'x'*550, 55)
+    assert len(calls) <= 8
+    assert search_quality(encode, 1000, 90)[1] == 90
+    with pytest.raises(ValueError):
+        search_quality(encode, 5, 90)
+
+
+def test_dct_coefficients(image):
+    coefficients, quantization = image.dct_coefficients()
+    coefficients = memoryview(coefficients)
+    assert coefficients.shape == (45, 60, 8, 8)
+    assert coefficients.format in ('h', '<h')
+    assert memoryview(quantization).shape == (8, 8)
+    dc, _ = image.dct_coefficients(dc_only=True)
+    assert memoryview(dc).shape == (45, 60)
+    assert memoryview(dc).tolist() == [[block[0][0] for block in row]
+                                       for row in coefficients.tolist()]
+    assert memoryview(image.dct_coefficients(1)[0]).shape == (23, 30, 8, 8)
+    # Only the first DC scan of a progressive image is read
+    progressive, _ = image.optimize(progressive=True).dct_coefficients(
+        dc_only=True)
+    assert all(abs(a - b) <= 1 for a, b in zip(
+        memoryview(progressive).tolist()[0], memoryview(dc).tolist()[0]))
+    with pytest.raises(ValueError):
+        image.dct_coefficients(3)
+
+
+def test_hashes(image):
+    from jpegtran.hashing import distance
+    for method in ('phash', 'dhash'):
+        value = getattr(image, method)()
+        assert 0 < value < 2**64
+        assert value == getattr(JPEGImage(blob=image.as_blob()), method)()
+        assert distance(value, getattr(image.downscale(240, 180),
+                                       method)()) <= 8
+        assert distance(value, getattr(image.rotate(90), method)()) > 16
+    assert image.phash(16) < 2**256
+
+
+def test_to_array(image):
+    pixels = memoryview(image.to_array())
+    assert pixels.shape == (360, 480, 3)
+    assert memoryview(image.to_array((120, 90), 'GRAY')).shape == (90, 120, 1)
+    pixels = memoryview(image.to_array((50, 25), region=(13, 7, 300, 150)))
+    assert pixels.shape == (25, 50, 3)
+    with pytest.raises(ValueError):
+        image.to_array((960, 720))
+    with pytest.raises(ValueError):
+        image.to_array(colorspace='HSV')
+
+
+def test_blob_buffer_types(image):
+    blob = image.as_blob()
+    for buf in (bytearray(blob), memoryview(blob)):
+        rotated = JPEGImage(blob=buf).rotate(90)
+        assert rotated.width == image.height
+        assert rotated.as_blob() == image.rotate(90).as_blob()
+
+
+def test_blob_not_modified(image):
+    blob = bytearray(image.as_blob())
+    img = JPEGImage(blob=blob)
+    img.exif_orientation = 6
+    assert img.exif_orientation == 6
+    assert JPEGImage(blob=blob).exif_orientation == 1
+
+
+def test_modify_result(image):
+    rotated = image.rotate(90)
+    rotated.exif_orientation = 3
+    assert rotated.exif_orientation == 3
+
+
+def test_handle_pool(image):
+    from jpegtran.lib import handle_pool
+    image.rotate(90)
+    hits = handle_pool.hits
+    image.flip('horizontal')
+    assert handle_pool.hits > hits
+    assert 0 < handle_pool.size <= handle_pool.maxsize
+
+
+def test_buffer_arena(image):
+    from jpegtran.lib import BufferArena
+    arena = BufferArena(maxsize=2)
+    image.buffer_arena = arena
+    image.thumbnail_policy = 'keep'
+    assert image.pipeline().rotate(90).buffer_size >= 480*360
+    reference = JPEGImage(blob=image.data)
+    reference.thumbnail_policy = 'keep'
+    rotated = image.rotate(90)
+    assert rotated.buffer_arena is arena
+    assert rotated.as_blob() == reference.rotate(90).as_blob()
+    assert arena.stats()['misses'] == 1
+    # The buffer is only returned once the image is gone
+    assert arena.size == 0
+    del rotated
+    assert arena.size == 1
+    for _ in range(3):
+        image.flip('vertical')
+    crops = image.crop_many([(0, 0, 160, 160), (160, 0, 320, 160)])
+    assert [c.width for c in crops] == [160, 320]
+    stats = arena.stats()
+    assert (stats['hits'], stats['misses']) == (4, 2)
+    del crops
+    assert arena.size == 2
+    arena.clear()
+    assert arena.stats()['capacity'] == 0
+
+
+def test_instrumentation(image):
+    from jpegtran.lib import instrumentation
+    assert not instrumentation.enabled
+    events = []
+    hook = lambda *event: events.append(event)
+    with instrumentation.profile() as prof:
+        assert instrumentation.enabled
+        rotated = image.rotate(90)
+        image.downscale(320, 240, engine='epeg')
+        pixels = image.to_array((120, 90))
+    assert not instrumentation.enabled
+    stats = prof.stats()
+    transform = stats['operations']['transform']
+    # The image and its thumbnail
+    assert transform['calls'] == 2
+    assert transform['bytes_in'] > len(image.data)
+    assert transform['bytes_out'] > len(rotated.data)
+    assert transform['native'] > 0 and transform['thumbnail'] > 0
+    assert stats['operations']['epeg_scale']['calls'] == 1
+    assert stats['native_allocations'] >= 3
+    assert stats['peak_native_bytes'] >= len(rotated.data)
+    # Buffers are counted until they are freed
+    native_bytes = instrumentation.stats()['native_bytes']
+    assert native_bytes >= 120*90*3
+    del pixels
+    assert instrumentation.stats()['native_bytes'] == native_bytes - 120*90*3
+    assert 'transform' in prof.report()
+
+    instrumentation.add_hook(hook)
+    try:
+        image.flip('vertical')
+    finally:
+        instrumentation.remove_hook(hook)
+    assert ('transform', 'calls', 1) in events
+    assert set(e[1] for e in events) >= set(['copy_in', 'native', 'copy_out',
+                                            'bytes_in', 'bytes_out'])
+    del events[:]
+    image.flip('vertical')
+    assert not events
+
+
+def test_open_mmap(image):
+    mapped = JPEGImage.open('test/test.jpg')
+    assert mapped.as_blob() == image.as_blob()
+    assert mapped.exif_orientation == image.exif_orientation
+    rotated = mapped.rotate(90)
+    assert rotated.as_blob() == image.rotate(90).as_blob()
+    # Modifications do not reach the file
+    mapped.exif_orientation = 3
+    assert JPEGImage(fname='test/test.jpg').exif_orientation == 1
+    with open('test/test.jpg', 'rb') as fp:
+        fp.seek(100)
+        assert JPEGImage.open(fp).as_blob() == image.as_blob()
+        assert JPEGImage.open(fp.fileno(), mmap=False).data == image.data
+
+
+def test_save_file(image, tmpdir):
+    rotated = image.rotate(90)
+    with open(str(tmpdir.join('out.jpg')), 'wb') as fp:
+        fp.write(b'xx')
+        rotated.save(fp)
+    assert tmpdir.join('out.jpg').read('rb') == b'xx' + rotated.as_blob()
+    buf = io.BytesIO()
+    rotated.save(buf)
+    assert buf.getvalue() == rotated.as_blob()
+    fname = str(tmpdir.join('pipeline.jpg'))
+    result = image.pipeline().rotate(90).save(fname)
+    assert JPEGImage(fname=fname).as_blob() == result.as_blob()
+
+
+def test_header(image):
+    header = image.header
+    assert (header.width, header.height) == (480, 360)
+    assert header.subsampling == '4:2:0'
+    assert header.colorspace == 'YCbCr'
+    assert header.mcu_size == (16, 16)
+    assert not header.progressive
+    markers = [marker for marker, _, _ in header.segments]
+    assert markers[0] == 0xd8
+    assert markers[-2:] == [0xda, 0xd9]
+    assert JPEGImage(fname='test/test_thumb.jpg').header.progressive
+
+
+def test_header_truncated(image):
+    import jpegtran.lib as lib
+    data = image.as_blob()
+    sof = image.header.find(lib.MARKER_SOF0)
+    for size in (sof + 7, sof + 12):
+        with pytest.raises(ValueError):
+            lib.JPEGHeader(data[:size])
+    # Claims 200 components in a 17 byte segment
+    broken = bytearray(data)
+    broken[sof+9] = 200
+    with pytest.raises(ValueError):
+        lib.JPEGHeader(broken)
+    # The IFD0 entries are complete, the value of the Make tag is not
+    app1 = image.header.find(lib.MARKER_APP1)
+    exif = lib.Exif(bytearray(data[:app1+60]), app1)
+    assert exif.orientation == 1
+    with pytest.raises(lib.InvalidExifData):
+        exif['Make']
+    with pytest.raises(lib.ExifException):
+        exif.thumbnail
+
+
+def test_header_after_transform(image):
+    rotated = image.rotate(90)
+    assert rotated.header.width == image.height
+    assert rotated.header.height == image.width
+
+
+def test_output_options(image):
+    rotated = image.rotate(90, progressive=True)
+    assert rotated.header.progressive
+    assert rotated.exif_thumbnail.width == 120
+    stripped = image.crop(0, 0, 160, 160, strip_metadata=True)
+    assert stripped.exif is None
+    # Only the JFIF marker written by libjpeg is left
+    assert not any(0xe1 <= marker <= 0xef or marker == 0xfe
+                   for marker, _, _ in stripped.header.segments)
+    optimized = image.flip('vertical', optimize=True)
+    assert len(optimized.as_blob()) < len(image.flip('vertical').as_blob())
+    assert not optimized.header.progressive
+    assert optimized.exif_orientation == 1
+
+
+def test_optimize(image):
+    optimized = image.optimize()
+    assert 0 < optimized.bytes_saved == len(image.data) - len(optimized.data)
+    assert (optimized.width, optimized.height) == (480, 360)
+    assert optimized.exif_thumbnail.width == 160
+    # Only the entropy coding changes
+    assert (optimized.downscale(60, 45, quality=100).as_blob() ==
+            image.downscale(60, 45, quality=100).as_blob())
+    assert image.optimize(progressive=True).header.progressive
+    assert (image.optimize(strip_metadata=True).bytes_saved >
+            optimized.bytes_saved)
+    progressive = JPEGImage(fname='test/test_thumb.jpg')
+    assert progressive.optimize().header.progressive
+
+
+def test_pipeline(image):
+    fused = image.pipeline().rotate(90).flip('horizontal').execute()
+    assert fused.width == image.height
+    assert fused.height == image.width
+    # Rotating clockwise and flipping horizontally amounts to transposing
+    assert fused.as_blob() == image.transpose().as_blob()
+
+
+def test_pipeline_crop(image):
+    fused = image.pipeline().rotate(180).crop(0, 0, 160, 160).execute()
+    assert fused.width == 160
+    assert fused.height == 160
+    assert fused.exif_thumbnail.width == 160
+
+
+def test_pipeline_unaligned_crop(image):
+    fused = (image.pipeline().rotate(270).crop(224, 80, 112, 220)
+             .flip('horizontal').execute())
+    expected = image.rotate(270).crop(224, 80, 112, 220).flip('horizontal')
+    assert fused.as_blob() == expected.as_blob()
+    # Crops whose size is not a multiple of the 16x16 MCUs, followed by
+    # transformations that would move them off the MCU grid (the
+    # thumbnails of fused crops are regenerated, so compare without them)
+    ops = [('rotate', 90), ('rotate', 180), ('rotate', 270),
+           ('flip', 'horizontal'), ('flip', 'vertical'), ('transpose',),
+           ('transverse',)]
+    for region in ((16, 32, 100, 90), (0, 0, 48, 36), (448, 352, 32, 8)):
+        for op in ops:
+            pipeline = image.pipeline(strip_metadata=True).crop(*region)
+            fused = getattr(pipeline, op[0])(*op[1:]).execute()
+            cropped = image.crop(*region, strip_metadata=True)
+            expected = getattr(cropped, op[0])(*op[1:])
+            assert fused.as_blob() == expected.as_blob()
+    pipeline = image.pipeline().crop(0, 0, 48, 36).rotate(90)
+    assert image.multi_transform([pipeline])[0].as_blob() == \
+        image.crop(0, 0, 48, 36).rotate(90).as_blob()
+
+
+def test_pipeline_noop(image):
+    assert image.pipeline().rotate(90).rotate(-90).execute() is image
+
+
+def test_crop_many(image):
+    regions = [(0, 0, 160, 160), (160, 0, 320, 160), (0, 160, 480, 200)]
+    crops = image.crop_many(regions)
+    assert [(c.width, c.height) for c in crops] == [r[2:] for r in regions]
+    assert crops[0].as_blob() == image.crop(0, 0, 160, 160).as_blob()
+
+
+def test_multi_transform(image):
+    rotated, flipped, same = image.multi_transform([
+        image.pipeline().rotate(90), image.pipeline().flip('vertical'),
+        image.pipeline()])
+    assert rotated.as_blob() == image.rotate(90).as_blob()
+    assert flipped.as_blob() == image.flip('vertical').as_blob()
+    assert same is image
+
+
+def test_transform_exif_thumbnail(image):
+    # The 160x120 4:2:2 thumbnail can be flipped vertically and transposed
+    # losslessly, but a regenerated thumbnail would be 4:2:0
+    assert image.exif_thumbnail.header.subsampling == '4:2:2'
+    flipped = image.flip('vertical').exif_thumbnail
+    assert flipped.header.subsampling == '4:2:2'
+    transposed = image.transpose().exif_thumbnail
+    assert transposed.width == 120
+    assert transposed.header.subsampling == '4:4:0'
+    cropped = image.crop(0, 0, 240, 240).exif_thumbnail
+    assert cropped.header.subsampling == '4:2:0'
+
+
+def test_thumbnail_policy(image):
+    image.thumbnail_policy = 'strip'
+    rotated = image.rotate(90)
+    assert rotated.exif_thumbnail is None
+    assert rotated.exif_orientation == 1
+    assert rotated.width == image.height
+    assert rotated.rotate(90).thumbnail_policy == 'strip'
+    image.thumbnail_policy = 'keep'
+    thumb = image.exif_thumbnail
+    kept = image.rotate(90)
+    assert kept.exif_thumbnail.as_blob() == thumb.as_blob()
+    # The thumbnail data is removed, not only unlinked
+    assert len(rotated.data) <= len(kept.data) - len(thumb.data)
+    exif, kept_exif = rotated.exif, kept.exif
+    assert ('IFD1', 0x201) not in exif
+    assert sorted(exif.keys()) == sorted(k for k in kept_exif.keys()
+                                         if k[0] != 'IFD1')
+    for key in exif.keys():
+        assert exif[key] == kept_exif[key]
+    assert rotated.downscale(90, 120).width == 90
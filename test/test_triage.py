@@ -0,0 +1,75 @@
+import pytest
+
+import jpegtran
+import jpegtran.lib as lib
+from jpegtran.triage import scan_file
+
+
+@pytest.fixture
+def corpus(tmpdir):
+    with open('test/test.jpg', 'rb') as fp:
+        data = fp.read()
+    tmpdir.join('truncated.jpg').write(data[:len(data)//2], 'wb')
+    tmpdir.join('garbage.jpg').write(b'garbage', 'wb')
+    return ['test/test.jpg', 'test/test_thumb.jpg',
+            str(tmpdir.join('truncated.jpg')), str(tmpdir.join('garbage.jpg')),
+            str(tmpdir.join('missing.jpg'))]
+
+
+def test_scan(corpus):
+    records = sorted(jpegtran.scan(corpus, workers=2, max_pending=2))
+    assert [r.index for r in records] == list(range(5))
+    image, progressive, truncated, garbage, missing = records
+    assert image.path == 'test/test.jpg'
+    assert (image.width, image.height) == (480, 360)
+    assert image.subsampling == '4:2:0'
+    assert image.colorspace == 'YCbCr'
+    assert image.orientation == 1
+    assert image.thumbnail
+    assert not image.progressive and not image.truncated
+    assert image.valid is None and image.error is None
+    assert progressive.progressive and progressive.subsampling == '4:4:4'
+    assert truncated.truncated and truncated.width == 480
+    assert truncated.error is None
+    assert isinstance(garbage.error, ValueError) and garbage.width is None
+    assert isinstance(missing.error, EnvironmentError)
+
+
+def test_scan_validate(corpus):
+    records = sorted(jpegtran.scan(corpus, workers=2, validate=True))
+    assert [r.valid for r in records] == [True, True, False, None, None]
+    assert 'Premature end' in str(records[2].error)
+    assert records[2].width == 480
+
+
+def test_scan_truncated_header(tmpdir):
+    image = jpegtran.JPEGImage('test/test.jpg')
+    data = image.as_blob()
+    sof = image.header.find(lib.MARKER_SOF0)
+    tmpdir.join('sof.jpg').write(data[:sof+7], 'wb')
+    # Claims 200 components in a 17 byte segment
+    components = bytearray(data)
+    components[sof+9] = 200
+    tmpdir.join('components.jpg').write(bytes(components), 'wb')
+    paths = [str(tmpdir.join('sof.jpg')), 'test/test.jpg',
+             str(tmpdir.join('components.jpg'))]
+    records = sorted(jpegtran.scan(paths, workers=2))
+    assert [r.index for r in records] == [0, 1, 2]
+    assert 'Truncated' in str(records[0].error)
+    assert 'components' in str(records[2].error)
+    for record in (records[0], records[2]):
+        assert isinstance(record.error, ValueError)
+        assert record.width is None
+    assert records[1].error is None and records[1].width == 480
+
+
+def test_scan_large_header(tmpdir):
+    # The header does not fit into the first chunk
+    image = jpegtran.JPEGImage('test/test.jpg')
+    data = image.as_blob()
+    comment = b'\xff\xfe' + b'\xff\xf0' + b'x'*(0xfff0 - 2)
+    tmpdir.join('comment.jpg').write(data[:2] + comment*2 + data[2:], 'wb')
+    record = scan_file(str(tmpdir.join('comment.jpg')))
+    assert record.error is None
+    assert (record.width, record.height) == (480, 360)
+    assert record.orientation == 1